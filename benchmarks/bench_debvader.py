@@ -0,0 +1,53 @@
+"""Benchmark the throughput of the amortized (debvader) inference path."""
+
+import argparse
+import time
+
+import numpy as np
+
+from madness_deblender.deblender import Deblender
+
+
+def main():
+    """Time the amortized inference on random fields with random weights."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-fields", type=int, default=200)
+    parser.add_argument("--max-number", type=int, default=20)
+    parser.add_argument("--field-size", type=int, default=241)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    deb = Deblender(load_weights=False)
+
+    rng = np.random.default_rng(0)
+    fields = rng.random(
+        (args.num_fields, args.field_size, args.field_size, 6), dtype=np.float32
+    )
+    positions = rng.uniform(
+        22, args.field_size - 23, size=(args.num_fields, args.max_number, 2)
+    )
+    num_components = np.full(args.num_fields, args.max_number)
+    num_galaxies = num_components.sum()
+
+    # warm-up to trace the graph
+    deb.debvader(fields[:1], positions[:1], num_components[:1], channel_last=True)
+
+    for _ in range(args.repeats):
+        t0 = time.perf_counter()
+        deb.debvader(
+            fields,
+            positions,
+            num_components,
+            batch_size=args.batch_size,
+            channel_last=True,
+        )
+        time_taken = time.perf_counter() - t0
+        print(
+            f"{num_galaxies} galaxies in {time_taken:.2f}s: "
+            f"{num_galaxies / time_taken:.0f} galaxies/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark the import time of the package modules, each in a fresh interpreter."""
+
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = [
+    "madness_deblender",
+    "madness_deblender.extraction",
+    "madness_deblender.blend_groups",
+    "madness_deblender.results",
+    "madness_deblender.runtime",
+    "madness_deblender.cli",
+    "madness_deblender.detection",
+    "madness_deblender.coadd",
+    "madness_deblender.service",
+    "madness_deblender.deblender",
+]
+
+HEAVY_MODULES = ["tensorflow", "tensorflow_probability", "galcheat", "sep", "astropy"]
+
+SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+print(json.dumps({{
+    "time": time.perf_counter() - t0,
+    "loaded": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def time_import(module):
+    """Import a module in a fresh interpreter.
+
+    Parameters
+    ----------
+    module: str
+        name of the module.
+
+    Returns
+    -------
+    result: dict
+        import "time" (s) and heavy modules "loaded" by the import.
+
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    """Time the import of each module, keeping the best of several runs."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        results = [time_import(module) for _ in range(args.repeats)]
+        best = min(result["time"] for result in results)
+        loaded = ", ".join(results[0]["loaded"]) or "-"
+        print(f"{module:40s} {best * 1000:8.1f} ms   heavy modules: {loaded}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Benchmark the training losses with and without XLA compilation, and the fused SSIM."""
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from madness_deblender.callbacks import changeAlpha
+from madness_deblender.losses import (
+    deblender_encoder_cached_loss_wrapper,
+    deblender_loss_fn_wrapper,
+    flow_loss_fn,
+    ssim,
+    vae_loss_fn_mse,
+)
+
+tfd = tfp.distributions
+
+
+def time_loss(loss_fn, y, prediction, repeats):
+    """Time the loss and its gradient wrt the prediction, returning the loss value."""
+
+    @tf.function
+    def step(y, prediction):
+        with tf.GradientTape() as tape:
+            tape.watch(prediction)
+            loss = loss_fn(y, prediction)
+        return loss, tape.gradient(loss, prediction)
+
+    loss, _ = step(y, prediction)  # warm-up to trace and compile
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        step(y, prediction)[0].numpy()
+    return loss.numpy(), (time.perf_counter() - t0) / repeats
+
+
+def main():
+    """Compare the time and value of each loss with and without XLA."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--stamp-size", type=int, default=45)
+    parser.add_argument("--latent-dim", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.batch_size, args.stamp_size, args.stamp_size, 6)
+    y = tf.constant(rng.random(shape, dtype=np.float32))
+    predicted_galaxy = y + 0.1 * tf.constant(rng.normal(size=shape), tf.float32)
+    num_params = tfp.layers.MultivariateNormalTriL.params_size(args.latent_dim)
+    params = tf.constant(
+        rng.normal(size=(args.batch_size, num_params)), dtype=tf.float32
+    )
+    log_prob = tf.constant(rng.normal(size=(args.batch_size,)), dtype=tf.float32)
+
+    ch_alpha = changeAlpha(max_epochs=1)
+    benchmarks = {
+        "deblender_loss": lambda jit: (
+            deblender_loss_fn_wrapper(
+                np.array([1e-3] * 6), linear_norm_coeff=1, jit_compile=jit
+            ),
+            y,
+            predicted_galaxy,
+        ),
+        "deblender_ssim_loss": lambda jit: (
+            deblender_loss_fn_wrapper(
+                np.array([1e-3] * 6),
+                use_ssim=True,
+                ch_alpha=ch_alpha,
+                linear_norm_coeff=1,
+                jit_compile=jit,
+            ),
+            y,
+            predicted_galaxy,
+        ),
+        "flow_loss": lambda jit: (
+            flow_loss_fn if jit else tf.function(flow_loss_fn.python_function),
+            log_prob,
+            log_prob,
+        ),
+        "vae_loss_mse": lambda jit: (
+            lambda x, prediction: (
+                tf.function(
+                    vae_loss_fn_mse.python_function, autograph=False, jit_compile=True
+                )
+                if jit
+                else vae_loss_fn_mse
+            )(x, tfd.Deterministic(prediction)),
+            y,
+            predicted_galaxy,
+        ),
+        "deblender_encoder_cached_loss": lambda jit: (
+            tf.function(
+                deblender_encoder_cached_loss_wrapper(args.latent_dim).python_function,
+                jit_compile=jit,
+            ),
+            params,
+            params + 0.1,
+        ),
+    }
+
+    value_fused, time_fused = time_loss(
+        lambda x, prediction: tf.reduce_mean(ssim(x, prediction)),
+        y,
+        predicted_galaxy,
+        args.repeats,
+    )
+    value_tf, time_tf = time_loss(
+        lambda x, prediction: tf.reduce_mean(tf.image.ssim(x, prediction, max_val=1)),
+        y,
+        predicted_galaxy,
+        args.repeats,
+    )
+    print(
+        f"ssim: tf.image.ssim {1e3 * time_tf:.2f}ms, fused {1e3 * time_fused:.2f}ms "
+        f"(x{time_tf / time_fused:.2f}), relative difference of the values "
+        f"{abs(value_fused - value_tf) / abs(value_tf):.1e}"
+    )
+
+    # the values of the losses drawing samples differ because of the random draws
+    for name, benchmark in benchmarks.items():
+        results = {
+            jit: time_loss(*benchmark(jit), args.repeats) for jit in [False, True]
+        }
+        (value, time_graph), (value_xla, time_xla) = results[False], results[True]
+        print(
+            f"{name}: graph {1e3 * time_graph:.2f}ms, XLA {1e3 * time_xla:.2f}ms "
+            f"(x{time_graph / time_xla:.2f}), relative difference of the values "
+            f"{abs(value_xla - value) / abs(value):.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
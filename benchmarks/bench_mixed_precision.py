@@ -0,0 +1,69 @@
+"""Benchmark mixed precision training of the VAE against the float32 baseline."""
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from madness_deblender.FlowVAEnet import FlowVAEnet
+from madness_deblender.losses import deblender_loss_fn_wrapper
+
+
+def main():
+    """Time VAE epochs on random stamps and compare the validation losses."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-samples", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--policies", nargs="+", default=["float32", "mixed_bfloat16"])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = rng.random((args.num_samples, 45, 45, 6), dtype=np.float32)
+    train, validation = data[: -args.batch_size], data[-args.batch_size :]
+
+    weights = None
+    baseline = None
+    for dtype_policy in args.policies:
+        f_net = FlowVAEnet(dtype_policy=dtype_policy)
+        if weights is None:
+            weights = f_net.vae_model.get_weights()
+        f_net.vae_model.set_weights(weights)
+
+        class EpochTimer(tf.keras.callbacks.Callback):
+            def on_train_begin(self, logs=None):
+                self.times = []
+
+            def on_epoch_begin(self, epoch, logs=None):
+                self.t0 = time.perf_counter()
+
+            def on_epoch_end(self, epoch, logs=None):
+                self.times.append(time.perf_counter() - self.t0)
+
+        timer = EpochTimer()
+        tf.random.set_seed(0)
+        hist = f_net.train_vae(
+            tf.data.Dataset.from_tensor_slices((train, train)).batch(args.batch_size),
+            (validation, validation),
+            callbacks=[timer],
+            epochs=args.epochs,
+            optimizer=tf.keras.optimizers.Adam(1e-4),
+            loss_function=deblender_loss_fn_wrapper(
+                sigma_cutoff=np.array([1e-3] * 6), linear_norm_coeff=1
+            ),
+            verbose=0,
+        )
+        val_loss = hist.history["val_loss"][-1]
+        if baseline is None:
+            baseline = val_loss
+        # the first epoch includes tracing
+        epoch_time = np.mean(timer.times[1:] or timer.times)
+        print(
+            f"{dtype_policy}: {epoch_time:.2f}s/epoch, val_loss {val_loss:.4g} "
+            f"({100 * (val_loss - baseline) / baseline:+.2f}% wrt {args.policies[0]})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,55 @@
 
 import logging
 
-import galcheat
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras.backend as K
 import tensorflow_probability as tfp
 
+from madness_deblender.callbacks import PerformanceMonitor
+from madness_deblender.distributed import get_strategy, is_chief
 from madness_deblender.losses import flow_loss_fn
 from madness_deblender.model import create_encoder, create_model_fvae
+from madness_deblender.utils import get_survey
 
 tfd = tfp.distributions
 tfb = tfp.bijectors
-logging.basicConfig(format="%(message)s", level=logging.INFO)
-
 LOG = logging.getLogger(__name__)
 
 
+class _LatentFlowModel(tf.keras.Model):
+    """Flow trained on cached latent vectors, saving its weights as the flow_model.
+
+    The checkpoints written by `save_weights` (e.g. by the ModelCheckpoint callbacks)
+    have the same structure as the ones of the flow_model trained on images,
+    so that both are loaded by `FlowVAEnet.load_flow_weights`.
+    """
+
+    def __init__(self, flow, flow_model):
+        """Wrap the flow.
+
+        Parameters
+        ----------
+        flow: tf.keras.Model
+            flow network, trained by this model.
+        flow_model: tf.keras.Model
+            model of the encoder and the flow, whose weights are saved.
+
+        """
+        super().__init__(name="latent_flow")
+        self.flow = flow
+        # a bound method is not tracked, so the encoder is not part of this model
+        self._save_flow_model_weights = flow_model.save_weights
+
+    def call(self, z):
+        """Compute the log probability of latent vectors."""
+        return self.flow(z)
+
+    def save_weights(self, *args, **kwargs):
+        """Save the weights of the flow_model, see `tf.keras.Model.save_weights`."""
+        return self._save_flow_model_weights(*args, **kwargs)
+
+
 class FlowVAEnet:
     """Initialize and train the Neural Network model."""
 
@@ -32,7 +66,9 @@ class FlowVAEnet:
         num_nf_layers=6,
         kl_prior=None,
         kl_weight=None,
-        survey=galcheat.get_survey("LSST"),
+        survey=None,
+        dtype_policy=None,
+        strategy=None,
     ):
         """Create the required models according to the specifications.
 
@@ -56,12 +92,25 @@ class FlowVAEnet:
             KL prior to be applied to the latent space.
         kl_weight: float
             Weight to be multiplied tot he kl_prior
-        survey: galcheat.survey object
-            galcheat survey object to fetch survey details
+        survey: galcheat.survey object or str
+            galcheat survey object to fetch survey details, or its name. Defaults to LSST.
         dense_layer_units: int
             number of units in the dense layer
+        dtype_policy: str
+            dtype policy of the encoder and decoder, "float32" (default), "mixed_bfloat16" or "mixed_float16".
+            With mixed precision, the convolutions run in 16 bits while the variables,
+            the output layers, the latent space distribution and the flow are kept in float32.
+            "mixed_float16" also requires loss scaling, which is applied by the `train_*` methods.
+        strategy: str or tf.distribute.Strategy
+            data-parallel strategy used to create and train the models (see `madness_deblender.distributed.get_strategy`).
+            "multi_worker" trains on the workers defined by the `TF_CONFIG` environment variable.
+            Callbacks holding variables (e.g. `changeAlpha`) should be created under `self.strategy.scope()`.
+            If None, the default single replica strategy is used.
 
         """
+        survey = get_survey(survey)
+        self.strategy = get_strategy(strategy)
+        self.dtype_policy = tf.keras.mixed_precision.Policy(dtype_policy or "float32")
         self.input_shape = [stamp_shape, stamp_shape, len(survey.available_filters)]
         self.latent_dim = latent_dim
 
@@ -74,25 +123,27 @@ class FlowVAEnet:
         self.nb_of_bands = len(survey.available_filters)
         self.num_nf_layers = num_nf_layers
 
-        (
-            self.vae_model,
-            self.flow_model,
-            self.encoder,
-            self.decoder,
-            self.flow,
-            self.td,
-        ) = create_model_fvae(
-            input_shape=self.input_shape,
-            latent_dim=self.latent_dim,
-            filters_encoder=self.filters_encoder,
-            kernels_encoder=self.kernels_encoder,
-            filters_decoder=self.filters_decoder,
-            kernels_decoder=self.kernels_decoder,
-            dense_layer_units=dense_layer_units,
-            num_nf_layers=self.num_nf_layers,
-            kl_prior=kl_prior,
-            kl_weight=kl_weight,
-        )
+        with self.strategy.scope():
+            (
+                self.vae_model,
+                self.flow_model,
+                self.encoder,
+                self.decoder,
+                self.flow,
+                self.td,
+            ) = create_model_fvae(
+                input_shape=self.input_shape,
+                latent_dim=self.latent_dim,
+                filters_encoder=self.filters_encoder,
+                kernels_encoder=self.kernels_encoder,
+                filters_decoder=self.filters_decoder,
+                kernels_decoder=self.kernels_decoder,
+                dense_layer_units=dense_layer_units,
+                num_nf_layers=self.num_nf_layers,
+                kl_prior=kl_prior,
+                kl_weight=kl_weight,
+                dtype=self.dtype_policy,
+            )
 
         self.optimizer = None
         self.callbacks = None
@@ -105,7 +156,7 @@ class FlowVAEnet:
         loss_function,
         train_encoder=True,
         train_decoder=True,
-        optimizer=tf.keras.optimizers.Adam(1e-4),
+        optimizer=None,
         track_kl=False,
         epochs=35,
         verbose=1,
@@ -116,10 +167,11 @@ class FlowVAEnet:
         ----------
         train_generator:
             generator to be used for training the network.
-            keras.utils.Sequence returning (inputs, targets) or (inputs, targets, sample_weights)
+            tf.data.Dataset (see madness_deblender.pipeline.build_training_dataset),
+            keras.utils.Sequence or tuple of arrays, returning (inputs, targets) or (inputs, targets, sample_weights)
         validation_generator:
             generator to be used for validation
-            keras.utils.Sequence returning (inputs, targets) or (inputs, targets, sample_weights)
+            tf.data.Dataset, keras.utils.Sequence or tuple of arrays, returning (inputs, targets) or (inputs, targets, sample_weights)
         callbacks: list
             List of keras.callbacks.Callback instances.
             List of callbacks to apply during training.
@@ -132,6 +184,7 @@ class FlowVAEnet:
             Flag to decide if the decoder is to be trained.
         optimizer: str or tf.keras.optimizers
             String (name of optimizer) or optimizer instance. See tf.keras.optimizers.
+            If None, Adam with a learning rate of 1e-4 is used.
         track_kl:bool
             To decide if the KL loss is to be tracked through the iterations.
         epochs: int
@@ -170,27 +223,21 @@ class FlowVAEnet:
 
         if loss_function is None:
             print("pass valid loss function")
-        self.vae_model.compile(
-            optimizer=optimizer,
-            loss={"decoder": loss_function},
-            experimental_run_tf_function=False,
-            metrics=metrics,
-        )
+        with self.strategy.scope():
+            self.vae_model.compile(
+                optimizer=self._get_optimizer(optimizer),
+                loss={"decoder": loss_function},
+                experimental_run_tf_function=False,
+                metrics=metrics,
+            )
 
-        hist = self.vae_model.fit(
-            x=(
-                train_generator[0]
-                if isinstance(train_generator, tuple)
-                else train_generator
-            ),
-            y=train_generator[1] if isinstance(train_generator, tuple) else None,
+        hist = self._fit(
+            self.vae_model,
+            train_generator,
+            validation_generator,
+            callbacks=callbacks,
             epochs=epochs,
             verbose=verbose,
-            shuffle=True,
-            validation_data=validation_generator,
-            callbacks=callbacks,
-            workers=8,
-            use_multiprocessing=True,
         )
         return hist
 
@@ -200,9 +247,10 @@ class FlowVAEnet:
         validation_generator,
         callbacks,
         loss_function,
-        optimizer=tf.keras.optimizers.Adam(1e-4),
+        optimizer=None,
         epochs=35,
         verbose=1,
+        jit_compile=False,
     ):
         """Train only the the components of VAE model (the encoder and/or decoder).
 
@@ -210,10 +258,11 @@ class FlowVAEnet:
         ----------
         train_generator:
             generator to be used for training the network.
-            keras.utils.Sequence returning (inputs, targets) or (inputs, targets, sample_weights)
+            tf.data.Dataset (see madness_deblender.pipeline.build_training_dataset),
+            keras.utils.Sequence or tuple of arrays, returning (inputs, targets) or (inputs, targets, sample_weights)
         validation_generator:
             generator to be used for validation
-            keras.utils.Sequence returning (inputs, targets) or (inputs, targets, sample_weights)
+            tf.data.Dataset, keras.utils.Sequence or tuple of arrays, returning (inputs, targets) or (inputs, targets, sample_weights)
         callbacks: list
             List of keras.callbacks.Callback instances.
             List of callbacks to apply during training.
@@ -222,6 +271,7 @@ class FlowVAEnet:
             function that can compute the loss.
         optimizer: str or tf.keras.optimizers
             String (name of optimizer) or optimizer instance. See tf.keras.optimizers.
+            If None, Adam with a learning rate of 1e-4 is used.
         epochs: int
             number of epochs for which the model is going to be trained
         verbose: int
@@ -229,6 +279,8 @@ class FlowVAEnet:
             'auto', 0, 1, or 2. Verbosity mode. 0 = silent, 1 = progress bar, 2 = one line per epoch.
             'auto' defaults to 1 for most cases, but 2 when used with ParameterServerStrategy.
             Note that the progress bar is not particularly useful when logged to a file, so verbose=2 is recommended when not running interactively (eg, in a production environment).
+        jit_compile: bool
+            to compile the training step, including the loss, with XLA.
 
         """
         self.encoder.summary()
@@ -237,25 +289,20 @@ class FlowVAEnet:
 
         if loss_function is None:
             print("pass valid loss function")
-        self.encoder.compile(
-            optimizer=optimizer,
-            loss=loss_function,
-            experimental_run_tf_function=False,
-        )
-        hist = self.encoder.fit(
-            x=(
-                train_generator[0]
-                if isinstance(train_generator, tuple)
-                else train_generator
-            ),
-            y=train_generator[1] if isinstance(train_generator, tuple) else None,
+        with self.strategy.scope():
+            self.encoder.compile(
+                optimizer=self._get_optimizer(optimizer),
+                loss=loss_function,
+                experimental_run_tf_function=False,
+                jit_compile=jit_compile,
+            )
+        hist = self._fit(
+            self.encoder,
+            train_generator,
+            validation_generator,
+            callbacks=callbacks,
             epochs=epochs,
             verbose=verbose,
-            shuffle=True,
-            validation_data=validation_generator,
-            callbacks=callbacks,
-            workers=8,
-            use_multiprocessing=True,
         )
         return hist
 
@@ -264,26 +311,36 @@ class FlowVAEnet:
         train_generator,
         validation_generator,
         callbacks,
-        optimizer=tf.keras.optimizers.Adam(1e-4),
+        optimizer=None,
         epochs=35,
         verbose=1,
+        jit_compile=False,
+        cache_latents=False,
+        num_latent_samples=1,
+        batch_size=100,
     ):
         """Train only the flow part of the flow_model while keeping the encoder constant.
 
+        With `cache_latents`, the training and validation sets are encoded once
+        (see `encode_latents`) and the flow is trained directly on the latent vectors,
+        so that epochs no longer run the convolutional encoder.
+
         Parameters
         ----------
         train_generator:
             generator to be used for training the network.
-            keras.utils.Sequence returning (inputs, targets) or (inputs, targets, sample_weights)
+            tf.data.Dataset (see madness_deblender.pipeline.build_training_dataset),
+            keras.utils.Sequence or tuple of arrays, returning (inputs, targets) or (inputs, targets, sample_weights)
         validation_generator:
             generator to be used for validation
-            keras.utils.Sequence returning (inputs, targets) or (inputs, targets, sample_weights)
+            tf.data.Dataset, keras.utils.Sequence or tuple of arrays, returning (inputs, targets) or (inputs, targets, sample_weights)
         callbacks: list
             List of keras.callbacks.Callback instances.
             List of callbacks to apply during training.
             See tf.keras.callbacks
         optimizer: str or tf.keras.optimizers
             String (name of optimizer) or optimizer instance. See tf.keras.optimizers.
+            If None, Adam with a learning rate of 1e-4 is used.
         epochs: int
             number of epochs for which the model is going to be trained
         num_scheduler_epochs: int
@@ -293,21 +350,201 @@ class FlowVAEnet:
             'auto', 0, 1, or 2. Verbosity mode. 0 = silent, 1 = progress bar, 2 = one line per epoch.
             'auto' defaults to 1 for most cases, but 2 when used with ParameterServerStrategy.
             Note that the progress bar is not particularly useful when logged to a file, so verbose=2 is recommended when not running interactively (eg, in a production environment).
+        jit_compile: bool
+            to compile the training step, including the loss, with XLA.
+            Requires `cache_latents`, as the latent space layer of the flow_model cannot be compiled.
+        cache_latents: bool
+            to encode the images once and train the flow on the cached latent vectors.
+            The checkpoints saved by the callbacks are still the ones of the flow_model.
+        num_latent_samples: int
+            number of samples drawn from the latent distribution of each image when caching.
+            If 0, the mean of the distribution is used.
+        batch_size: int
+            batch size used to train on the cached latent vectors.
 
         """
+        if jit_compile and not cache_latents:
+            raise ValueError(
+                "jit_compile requires cache_latents, the latent space layer of the flow_model cannot be compiled with XLA"
+            )
+
         self.flow.trainable = True
         self.encoder.trainable = False
-        self.flow_model.compile(
-            optimizer=optimizer,
-            loss={"flow": flow_loss_fn},
-            experimental_run_tf_function=False,
-        )
-        self.flow_model.summary()
+
+        if cache_latents:
+            with self.strategy.scope():
+                model = _LatentFlowModel(self.flow, self.flow_model)
+                model(tf.zeros([1, self.latent_dim]))
+        else:
+            model = self.flow_model
+        with self.strategy.scope():
+            model.compile(
+                optimizer=self._get_optimizer(optimizer),
+                loss=flow_loss_fn if cache_latents else {"flow": flow_loss_fn},
+                experimental_run_tf_function=False,
+                jit_compile=jit_compile,
+            )
+        model.summary()
 
         LOG.info("\n--- Training only FLOW network ---")
         LOG.info("Number of epochs: " + str(epochs))
 
-        hist = self.flow_model.fit(
+        if cache_latents:
+            z_train = self.encode_latents(train_generator, num_latent_samples)
+            LOG.info(f"Cached {len(z_train)} training latent vectors")
+            # the targets are ignored by the flow loss
+            train_generator = (
+                tf.data.Dataset.from_tensor_slices((z_train, z_train))
+                .shuffle(len(z_train))
+                .batch(batch_size)
+                .prefetch(tf.data.AUTOTUNE)
+            )
+            if validation_generator is not None:
+                z_validation = self.encode_latents(
+                    validation_generator, num_latent_samples
+                )
+                validation_generator = (
+                    tf.data.Dataset.from_tensor_slices((z_validation, z_validation))
+                    .batch(batch_size)
+                    .prefetch(tf.data.AUTOTUNE)
+                )
+
+        hist = self._fit(
+            model,
+            train_generator,
+            validation_generator,
+            callbacks=callbacks,
+            epochs=epochs,
+            verbose=verbose,
+        )
+
+        return hist
+
+    def encode_latents(self, generator, num_samples=1):
+        """Encode images into latent vectors, to cache them for training the flow.
+
+        Parameters
+        ----------
+        generator:
+            tf.data.Dataset, keras.utils.Sequence or tuple of arrays, returning batches of (inputs, ...).
+            A tuple of arrays is encoded in batches of 100 images.
+        num_samples: int
+            number of samples drawn from the latent distribution of each image.
+            If 0, the mean of the distribution is used.
+
+        Returns
+        -------
+        z: np.ndarray
+            latent vectors of shape (num_images * max(num_samples, 1), latent_dim).
+
+        """
+        if isinstance(generator, tuple):
+            generator = tf.data.Dataset.from_tensor_slices(
+                np.asarray(generator[0], dtype=np.float32)
+            ).batch(100)
+        elif isinstance(generator, tf.keras.utils.Sequence):
+            generator = (generator[i] for i in range(len(generator)))
+
+        @tf.function(reduce_retracing=True)
+        def encode(x):
+            distribution = tfp.layers.MultivariateNormalTriL.new(
+                tf.cast(self.encoder(x, training=False), tf.float32),
+                self.latent_dim,
+            )
+            if num_samples == 0:
+                return distribution.mean()
+            # (num_samples, batch, latent_dim) -> (batch * num_samples, latent_dim)
+            z = tf.transpose(distribution.sample(num_samples), [1, 0, 2])
+            return tf.reshape(z, [-1, self.latent_dim])
+
+        z = []
+        for batch in generator:
+            x = batch[0] if isinstance(batch, (tuple, list)) else batch
+            z.append(encode(x).numpy())
+
+        return np.concatenate(z).astype(np.float32)
+
+    def _get_optimizer(self, optimizer):
+        """Prepare the optimizer for the distribution strategy and the dtype policy.
+
+        Parameters
+        ----------
+        optimizer: str or tf.keras.optimizers
+            String (name of optimizer) or optimizer instance. See tf.keras.optimizers.
+
+        Returns
+        -------
+        optimizer: tf.keras.optimizers
+            optimizer instance, created under the strategy scope, wrapped in a LossScaleOptimizer for "mixed_float16".
+            bfloat16 has the same exponent range as float32 and needs no loss scaling.
+
+        """
+        if optimizer is None:
+            optimizer = tf.keras.optimizers.Adam(1e-4)
+        optimizer = tf.keras.optimizers.get(optimizer)
+        if (
+            tf.distribute.has_strategy()
+            and getattr(optimizer, "_distribution_strategy", None) is not self.strategy
+        ):
+            # optimizers must be created under the scope of the strategy of the model
+            with self.strategy.scope():
+                optimizer = optimizer.__class__.from_config(optimizer.get_config())
+        if self.dtype_policy.name == "mixed_float16" and not isinstance(
+            optimizer, tf.keras.mixed_precision.LossScaleOptimizer
+        ):
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        return optimizer
+
+    def _fit(
+        self,
+        model,
+        train_generator,
+        validation_generator,
+        callbacks,
+        epochs,
+        verbose,
+    ):
+        """Fit a model on a tf.data.Dataset, a keras.utils.Sequence or a tuple of arrays.
+
+        Parameters
+        ----------
+        model: tf.keras.Model
+            compiled model to be trained.
+        train_generator:
+            data to be used for training the network.
+        validation_generator:
+            data to be used for validation.
+        callbacks: list
+            List of keras.callbacks.Callback instances.
+        epochs: int
+            number of epochs for which the model is going to be trained
+        verbose: int
+            verbose option for training.
+
+        Returns
+        -------
+        hist: tf.keras.callbacks.History
+            training history.
+
+        """
+        if not is_chief(self.strategy):
+            # only the chief logs the progress
+            verbose = 0
+
+        fit_kwargs = {}
+        if isinstance(train_generator, tf.keras.utils.Sequence):
+            # legacy multiprocessing loader, tf.data pipelines run in the TF runtime
+            fit_kwargs = {"workers": 8, "use_multiprocessing": True}
+        elif (
+            isinstance(train_generator, tf.data.Dataset)
+            and self.strategy.num_replicas_in_sync == 1
+        ):
+            # let the performance monitors measure the input wait and the batch sizes
+            for callback in callbacks or []:
+                if isinstance(callback, PerformanceMonitor):
+                    train_generator = callback.wrap_dataset(train_generator)
+
+        return model.fit(
             x=(
                 train_generator[0]
                 if isinstance(train_generator, tuple)
@@ -319,12 +556,9 @@ class FlowVAEnet:
             shuffle=True,
             validation_data=validation_generator,
             callbacks=callbacks,
-            workers=8,
-            use_multiprocessing=True,
+            **fit_kwargs,
         )
 
-        return hist
-
     def load_vae_weights(self, weights_path, is_folder=True):
         """Load the trained weights of the VAE model (encoder and decoder).
 
@@ -0,0 +1,236 @@
+"""Amortized inference of the galaxies with the encoder (debvader)."""
+
+import logging
+import time
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+LOG = logging.getLogger(__name__)
+
+
+def get_cutout_starts(detected_positions, num_components, cutout_size=45):
+    """Compute the starting pixel of the cutout of each galaxy in the batch.
+
+    Parameters
+    ----------
+    detected_positions: np.ndarray
+        detected positions of shape (num_fields, max_number, 2).
+        as in array and not image
+    num_components: list
+        number of galaxies present in each field.
+    cutout_size: int
+        size of the stamps in pixels.
+
+    Returns
+    -------
+    field_ids: np.ndarray
+        field of each galaxy (padded slots are skipped).
+    slot_ids: np.ndarray
+        slot of each galaxy in its field.
+    starts: np.ndarray
+        starting pixel of the cutout of each galaxy, of shape (num_galaxies, 2).
+
+    """
+    detected_positions = np.asarray(detected_positions)
+    num_components = np.asarray(num_components)
+    max_number = detected_positions.shape[1]
+
+    valid = np.arange(max_number)[None, :] < num_components[:, None]
+    field_ids, slot_ids = np.nonzero(valid)
+    starts = np.round(detected_positions[field_ids, slot_ids]).astype(np.int32) - int(
+        (cutout_size - 1) / 2
+    )
+
+    return field_ids.astype(np.int32), slot_ids.astype(np.int32), starts
+
+
+def make_cutout_dataset(
+    blended_fields,
+    field_ids,
+    starts,
+    cutout_size=45,
+    batch_size=1024,
+    linear_norm_coeff=1,
+):
+    """Create a tf.data pipeline streaming batches of normalized cutouts.
+
+    The cutouts are gathered from the fields inside the graph,
+    so that only one batch of cutouts is in memory at a time.
+    The parts of the cutouts outside of their field are set to zero.
+
+    Parameters
+    ----------
+    blended_fields: tf tensor
+        batch of channel last fields.
+    field_ids: np.ndarray
+        field of each cutout.
+    starts: np.ndarray
+        starting pixel of each cutout, of shape (num_galaxies, 2).
+    cutout_size: int
+        size of the stamps in pixels.
+    batch_size: int
+        number of cutouts in each batch.
+    linear_norm_coeff: int/list
+        bandwise linear normalizing/scaling factor applied to the cutouts.
+
+    Returns
+    -------
+    dataset: tf.data.Dataset
+        dataset of channel last cutouts of shape (batch_size, cutout_size, cutout_size, num_bands).
+
+    """
+    offsets = tf.stack(
+        tf.meshgrid(tf.range(cutout_size), tf.range(cutout_size), indexing="ij"),
+        axis=-1,
+    )
+    linear_norm_coeff = tf.cast(linear_norm_coeff, tf.float32)
+
+    field_shape = tf.shape(blended_fields)[1:3]
+
+    def cut_batch(batch_field_ids, batch_starts):
+        pixels = batch_starts[:, None, None, :] + offsets[None]
+        # pixels outside of the field are read at the border and set to zero
+        inside = tf.reduce_all((pixels >= 0) & (pixels < field_shape), axis=-1)
+        pixels = tf.clip_by_value(pixels, 0, field_shape - 1)
+        field_index = tf.broadcast_to(
+            batch_field_ids[:, None, None, None], tf.shape(pixels[..., :1])
+        )
+        cutouts = tf.gather_nd(
+            blended_fields, tf.concat([field_index, pixels], axis=-1)
+        )
+        cutouts = tf.cast(cutouts, tf.float32) * tf.cast(inside, tf.float32)[..., None]
+        return cutouts / linear_norm_coeff
+
+    dataset = tf.data.Dataset.from_tensor_slices(
+        (
+            tf.convert_to_tensor(field_ids, dtype=tf.int32),
+            tf.convert_to_tensor(starts, dtype=tf.int32),
+        )
+    )
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(cut_batch, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def amortized_inference(
+    flow_vae_net,
+    blended_fields,
+    detected_positions,
+    num_components,
+    batch_size=1024,
+    linear_norm_coeff=10000,
+    channel_last=False,
+    decode=True,
+):
+    """Deblend the galaxies with a single pass of the encoder and the decoder.
+
+    The cutouts are streamed through the networks in chunks of `batch_size`,
+    without noise estimation or optimization, for quick-look processing.
+
+    Parameters
+    ----------
+    flow_vae_net: madness_deblender.FlowVAEnet.FlowVAEnet
+        networks used for deblending.
+    blended_fields: np.ndarray/tf tensor
+        batch of blended fields.
+    detected_positions: np.ndarray
+        detected positions of shape (num_fields, max_number, 2).
+        as in array and not image
+    num_components: list
+        number of galaxies present in each field.
+    batch_size: int
+        number of galaxies encoded and decoded at a time.
+    linear_norm_coeff: int/list
+        bandwise linear normalizing/scaling factor.
+    channel_last: bool
+        if the channels/filters are the last column of the blended_fields.
+        The returned components have the same convention.
+    decode: bool
+        to decode the components. If False, only the latent distributions are returned.
+
+    Returns
+    -------
+    results: dict
+        "z_mean": mean of the latent distributions, of shape (num_fields, max_number, latent_dim).
+        "z_cov": covariance of the latent distributions, of shape (num_fields, max_number, latent_dim, latent_dim).
+        "components": predicted components, of shape (num_fields, max_number, cutout_size, cutout_size, num_bands)
+        with the bands first if `channel_last` is False.
+        Padded slots are set to zero.
+
+    """
+    t0 = time.time()
+    latent_dim = flow_vae_net.latent_dim
+    cutout_size = flow_vae_net.input_shape[0]
+    num_bands = flow_vae_net.nb_of_bands
+
+    blended_fields = tf.convert_to_tensor(blended_fields)
+    if not channel_last:
+        blended_fields = tf.transpose(blended_fields, perm=[0, 2, 3, 1])
+
+    detected_positions = np.asarray(detected_positions)
+    num_fields, max_number = detected_positions.shape[:2]
+    field_ids, slot_ids, starts = get_cutout_starts(
+        detected_positions, num_components, cutout_size=cutout_size
+    )
+    field_size = np.array(blended_fields.shape[1:3])
+    if np.any((starts < 0) | (starts + cutout_size > field_size)):
+        LOG.warning(
+            "Some galaxies are too close to the border of the field, "
+            "their cutouts are padded with zeros."
+        )
+
+    dataset = make_cutout_dataset(
+        blended_fields,
+        field_ids,
+        starts,
+        cutout_size=cutout_size,
+        batch_size=batch_size,
+        linear_norm_coeff=linear_norm_coeff,
+    )
+
+    @tf.function(reduce_retracing=True)
+    def encode_decode(cutouts):
+        z_dist = tfp.layers.MultivariateNormalTriL.new(
+            flow_vae_net.encoder(cutouts, training=False), latent_dim
+        )
+        z_mean = z_dist.mean()
+        components = (
+            flow_vae_net.decoder(z_mean, training=False) if decode else tf.zeros([0])
+        )
+        return z_mean, z_dist.covariance(), components
+
+    z_mean = np.zeros((num_fields, max_number, latent_dim), dtype=np.float32)
+    z_cov = np.zeros((num_fields, max_number, latent_dim, latent_dim), dtype=np.float32)
+    components = None
+    if decode:
+        components = np.zeros(
+            (num_fields, max_number, cutout_size, cutout_size, num_bands),
+            dtype=np.float32,
+        )
+
+    start = 0
+    for cutouts in dataset:
+        batch_z_mean, batch_z_cov, batch_components = encode_decode(cutouts)
+        end = start + batch_z_mean.shape[0]
+        index = (field_ids[start:end], slot_ids[start:end])
+        z_mean[index] = batch_z_mean.numpy()
+        z_cov[index] = batch_z_cov.numpy()
+        if decode:
+            components[index] = batch_components.numpy()
+        start = end
+
+    if decode:
+        components *= np.reshape(linear_norm_coeff, [-1])
+        if not channel_last:
+            components = np.moveaxis(components, -1, -3)
+
+    time_taken = time.time() - t0
+    LOG.info(
+        f"Amortized inference of {len(field_ids)} galaxies in {time_taken:.2f}s "
+        f"({len(field_ids) / time_taken:.0f} galaxies/s)"
+    )
+
+    return {"z_mean": z_mean, "z_cov": z_cov, "components": components}
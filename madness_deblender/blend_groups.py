@@ -0,0 +1,183 @@
+"""Split fields into independent blend groups."""
+
+import logging
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+def compute_blend_groups(detected_positions, num_components, cutout_size=45):
+    """Label the connected groups of overlapping footprints in each field.
+
+    Two galaxies are connected if their `cutout_size` x `cutout_size` footprints,
+    centered on the rounded detected positions, share at least one pixel.
+    A blend group is a connected component of this footprint-overlap graph.
+
+    Parameters
+    ----------
+    detected_positions: np.ndarray
+        detected positions of shape (num_fields, max_number, 2).
+        as in array and not image
+    num_components: list
+        number of galaxies present in each field.
+    cutout_size: int
+        size of the stamps in pixels.
+
+    Returns
+    -------
+    group_labels: np.ndarray
+        array of shape (num_fields, max_number) with the blend group of each galaxy.
+        Groups are numbered from 0 in each field and padded slots are set to -1.
+
+    """
+    detected_positions = np.asarray(detected_positions)
+    num_fields, max_number = detected_positions.shape[:2]
+    group_labels = -np.ones((num_fields, max_number), dtype=int)
+
+    for field_num in range(num_fields):
+        n = int(num_components[field_num])
+        pos = np.round(detected_positions[field_num][:n]).astype(int)
+
+        # union-find over the footprint-overlap graph
+        parent = list(range(n))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        overlaps = np.all(
+            np.abs(pos[:, None, :] - pos[None, :, :]) < cutout_size, axis=-1
+        )
+        for i, j in zip(*np.nonzero(np.triu(overlaps, k=1))):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        roots = [find(i) for i in range(n)]
+        _, group_labels[field_num][:n] = np.unique(roots, return_inverse=True)
+
+    return group_labels
+
+
+def split_into_blend_groups(
+    blended_fields,
+    detected_positions,
+    num_components,
+    cutout_size=45,
+):
+    """Convert a batch of fields into a batch of blend groups.
+
+    Each blend group gets a local sub-field which is the bounding box of the
+    footprints of its galaxies, zero-padded to a common square size so that
+    all the groups can be optimized as a single batch.
+    Pixels outside the footprints do not depend on the latent space, so the
+    loss of each group only differs by a constant from its share of the field loss.
+
+    Parameters
+    ----------
+    blended_fields: np.ndarray
+        batch of channel last blended fields.
+    detected_positions: np.ndarray
+        detected positions of shape (num_fields, max_number, 2).
+        as in array and not image
+    num_components: list
+        number of galaxies present in each field.
+    cutout_size: int
+        size of the stamps in pixels.
+
+    Returns
+    -------
+    group_fields: np.ndarray
+        batch of channel last sub-fields, one for each blend group.
+    group_positions: np.ndarray
+        detected positions of the galaxies in the sub-fields, of shape (num_groups, max_group_size, 2).
+    group_num_components: np.ndarray
+        number of galaxies in each blend group.
+    group_index: np.ndarray
+        (field, slot) of each galaxy in the original batch, of shape (num_groups, max_group_size, 2).
+        Padded slots are set to -1.
+
+    """
+    detected_positions = np.asarray(detected_positions)
+    group_labels = compute_blend_groups(
+        detected_positions, num_components, cutout_size=cutout_size
+    )
+    half_size = int((cutout_size - 1) / 2)
+
+    members = []
+    boxes = []
+    for field_num in range(len(group_labels)):
+        for group_num in range(group_labels[field_num].max() + 1):
+            slots = np.nonzero(group_labels[field_num] == group_num)[0]
+            starts = (
+                np.round(detected_positions[field_num][slots]).astype(int) - half_size
+            )
+            box_start = starts.min(axis=0)
+            box_end = starts.max(axis=0) + cutout_size
+            members.append((field_num, slots))
+            boxes.append((box_start, box_end))
+
+    num_groups = len(members)
+    max_group_size = max(len(slots) for _, slots in members)
+    sub_field_size = max(int(np.max(end - start)) for start, end in boxes)
+
+    LOG.info(
+        f"Split {len(group_labels)} fields into {num_groups} blend groups "
+        f"(largest group: {max_group_size} galaxies, sub-field size: {sub_field_size})"
+    )
+
+    group_fields = np.zeros(
+        (num_groups, sub_field_size, sub_field_size, np.shape(blended_fields)[-1]),
+        dtype=np.float32,
+    )
+    group_positions = np.zeros((num_groups, max_group_size, 2))
+    group_num_components = np.zeros(num_groups, dtype=int)
+    group_index = -np.ones((num_groups, max_group_size, 2), dtype=int)
+
+    for group_num, ((field_num, slots), (box_start, box_end)) in enumerate(
+        zip(members, boxes)
+    ):
+        box_size = box_end - box_start
+        group_fields[group_num, : box_size[0], : box_size[1]] = blended_fields[
+            field_num, box_start[0] : box_end[0], box_start[1] : box_end[1]
+        ]
+        group_positions[group_num, : len(slots)] = (
+            detected_positions[field_num][slots] - box_start
+        )
+        group_num_components[group_num] = len(slots)
+        group_index[group_num, : len(slots), 0] = field_num
+        group_index[group_num, : len(slots), 1] = slots
+
+    return group_fields, group_positions, group_num_components, group_index
+
+
+def merge_blend_groups(group_values, group_index, num_fields, max_number):
+    """Scatter per-galaxy values of blend groups back to the original batch layout.
+
+    Parameters
+    ----------
+    group_values: np.ndarray
+        values of shape (num_groups, max_group_size, ...).
+    group_index: np.ndarray
+        (field, slot) of each galaxy in the original batch, as returned by `split_into_blend_groups`.
+    num_fields: int
+        number of fields in the original batch.
+    max_number: int
+        maximum number of galaxies in a field of the original batch.
+
+    Returns
+    -------
+    values: np.ndarray
+        values of shape (num_fields, max_number, ...), with zeros in the padded slots.
+
+    """
+    group_values = np.asarray(group_values)
+    values = np.zeros(
+        (num_fields, max_number) + group_values.shape[2:], dtype=group_values.dtype
+    )
+    valid = group_index[..., 0] >= 0
+    values[group_index[valid][:, 0], group_index[valid][:, 1]] = group_values[valid]
+    return values
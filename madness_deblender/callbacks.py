@@ -1,13 +1,29 @@
 """Define callbacks for training."""
 
+import csv
+import json
+import logging
 import os
+import resource
+import sys
+import time
+from collections import deque
 
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras.backend as K
 from tensorflow.keras.callbacks import Callback
 
+LOG = logging.getLogger(__name__)
 
-def define_callbacks(weights_save_path, lr_scheduler_epochs=None, patience=40):
+
+def define_callbacks(
+    weights_save_path,
+    lr_scheduler_epochs=None,
+    patience=40,
+    backup_path=None,
+    monitor_performance=False,
+):
     """Define callbacks for a network to train.
 
     Parameters
@@ -20,6 +36,14 @@ def define_callbacks(weights_save_path, lr_scheduler_epochs=None, patience=40):
         The default is None, and a constant learning rate is used
     patience: int
         number of iterations after which training is stopped if the loss does not decrease.
+    backup_path: str
+        path at which the training state is backed up at the end of each epoch,
+        to resume training after a worker failure (see tf.keras.callbacks.BackupAndRestore).
+        With a multi-worker strategy, only the chief writes the checkpoints and the backup.
+        The default is None, and no backup is made.
+    monitor_performance: bool
+        to log the training throughput, step times, input wait and peak memory
+        to "performance.csv" in `weights_save_path` (see PerformanceMonitor).
 
     """
     checkpointer_val_mse = tf.keras.callbacks.ModelCheckpoint(
@@ -61,9 +85,197 @@ def define_callbacks(weights_save_path, lr_scheduler_epochs=None, patience=40):
 
     callbacks += [tf.keras.callbacks.TerminateOnNaN()]
 
+    if backup_path is not None:
+        callbacks += [tf.keras.callbacks.BackupAndRestore(backup_path)]
+
+    if monitor_performance:
+        callbacks += [
+            PerformanceMonitor(os.path.join(weights_save_path, "performance.csv"))
+        ]
+
     return callbacks
 
 
+def get_peak_memory():
+    """Get the peak resident memory of the process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class PerformanceMonitor(Callback):
+    """Log the training throughput, step times, input wait and peak memory.
+
+    A row is written at the end of each epoch, and every `log_freq` steps,
+    to a CSV file, or a JSON lines file if `log_path` ends with ".json" or ".jsonl".
+    Each row contains the epoch, the step (None for epoch rows), the number of images
+    per second, the 50th, 90th and 99th percentiles of the step time (s),
+    the fraction of the step time spent waiting on the input pipeline
+    and the peak resident memory of the process (MB).
+
+    The number of images and the input wait are only measured on tf.data pipelines
+    passed through `wrap_dataset`, which `FlowVAEnet` does automatically
+    (with a single replica). Otherwise, the images per second are computed from
+    `batch_size` and the input wait is not logged.
+    """
+
+    fieldnames = [
+        "epoch",
+        "step",
+        "images_per_second",
+        "step_time_p50",
+        "step_time_p90",
+        "step_time_p99",
+        "input_wait_fraction",
+        "peak_memory_mb",
+    ]
+
+    def __init__(self, log_path, log_freq=None, batch_size=None):
+        """Initialize the monitor.
+
+        Parameters
+        ----------
+        log_path: str
+            path of the CSV or JSON lines log. Rows are appended to an existing log.
+        log_freq: int
+            number of steps between two step rows. If None, only epoch rows are written.
+        batch_size: int
+            number of images per step, used when the pipeline is not wrapped.
+
+        """
+        super().__init__()
+        self.log_path = log_path
+        self.log_freq = log_freq
+        self.batch_size = batch_size
+        # (time at which the batch left the pipeline, number of images) of each batch
+        self._ready_batches = deque()
+
+    def wrap_dataset(self, dataset):
+        """Record when each batch of a tf.data pipeline is handed to the training step.
+
+        Parameters
+        ----------
+        dataset: tf.data.Dataset
+            training pipeline, whose elements are (inputs, ...) batches.
+
+        Returns
+        -------
+        dataset: tf.data.Dataset
+            the same pipeline, recording the batches.
+
+        """
+
+        def record(batch_size):
+            self._ready_batches.append((time.perf_counter(), int(batch_size)))
+            return np.int32(0)
+
+        def stamp(*batch):
+            token = tf.py_function(
+                record, [tf.shape(tf.nest.flatten(batch)[0])[0]], tf.int32
+            )
+            with tf.control_dependencies([token]):
+                batch = tf.nest.map_structure(tf.identity, batch)
+            return batch if len(batch) > 1 else batch[0]
+
+        # the map must run synchronously when the training step asks for a batch
+        options = tf.data.Options()
+        options.experimental_optimization.inject_prefetch = False
+        return dataset.map(stamp).with_options(options)
+
+    def _summarize(self, step_times, wait_times, num_images):
+        total_time = np.sum(step_times)
+        p50, p90, p99 = np.percentile(step_times, [50, 90, 99])
+        return {
+            "images_per_second": (
+                np.sum(num_images) / total_time if None not in num_images else None
+            ),
+            "step_time_p50": p50,
+            "step_time_p90": p90,
+            "step_time_p99": p99,
+            "input_wait_fraction": (
+                np.sum(wait_times) / total_time
+                if len(wait_times) == len(step_times)
+                else None
+            ),
+            "peak_memory_mb": get_peak_memory(),
+        }
+
+    def _write(self, row):
+        row = {
+            key: float(value) if isinstance(value, np.floating) else value
+            for key, value in row.items()
+        }
+        if self.log_path.endswith((".json", ".jsonl")):
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(row) + "\n")
+            return
+        write_header = not os.path.exists(self.log_path)
+        with open(self.log_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.fieldnames)
+            if write_header:
+                writer.writeheader()
+            writer.writerow(row)
+
+    def on_train_begin(self, logs=None):
+        """Create the folder of the log."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        """Reset the measurements of the epoch."""
+        self._epoch = epoch
+        self._ready_batches.clear()
+        self._epoch_stats = ([], [], [])
+        self._window_stats = ([], [], [])
+
+    def on_train_batch_begin(self, batch, logs=None):
+        """Start timing the step."""
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        """Record the step time, input wait and number of images of the step."""
+        step_time = time.perf_counter() - self._step_start
+        if self._ready_batches:
+            ready_time, num_images = self._ready_batches.popleft()
+            wait_time = [min(max(ready_time - self._step_start, 0.0), step_time)]
+        else:
+            num_images, wait_time = self.batch_size, []
+        for stats in [self._epoch_stats, self._window_stats]:
+            stats[0].append(step_time)
+            stats[1].extend(wait_time)
+            stats[2].append(num_images)
+
+        if self.log_freq is not None and (batch + 1) % self.log_freq == 0:
+            self._write(
+                {
+                    "epoch": self._epoch,
+                    "step": batch + 1,
+                    **self._summarize(*self._window_stats),
+                }
+            )
+            self._window_stats = ([], [], [])
+
+    def on_epoch_end(self, epoch, logs=None):
+        """Write the measurements of the epoch."""
+        if not self._epoch_stats[0]:
+            return
+        row = {"epoch": epoch, "step": None, **self._summarize(*self._epoch_stats)}
+        self._write(row)
+        LOG.info(
+            f"Epoch {epoch}: "
+            + (
+                f"{row['images_per_second']:.1f} images/s, "
+                if row["images_per_second"] is not None
+                else ""
+            )
+            + f"median step time {1000 * row['step_time_p50']:.1f} ms"
+            + (
+                f", {100 * row['input_wait_fraction']:.1f}% of the time waiting on input"
+                if row["input_wait_fraction"] is not None
+                else ""
+            )
+        )
+
+
 class changeAlpha(Callback):
     """Update SSIM weight over epochs."""
 
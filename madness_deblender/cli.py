@@ -0,0 +1,581 @@
+"""Command-line driver to deblend fields in resumable batches."""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from madness_deblender.runtime import (
+    auto_config,
+    configure_runtime,
+    init_worker_runtime,
+    make_cpu_queue,
+    partition_cpus,
+)
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.jsonl"
+RUN_NAME = "run.json"
+CATALOG_COLUMNS = ["field_id", "row", "col"]
+
+# deblender of the process and the arguments it was built with
+_DEBLENDER = None
+_DEBLENDER_KWARGS = None
+
+
+def _file_type(path):
+    """Infer the type of a FITS, HDF5 or NumPy file from its extension."""
+    name = path.lower()
+    if name.endswith((".fits", ".fit", ".fits.gz", ".fz")):
+        return "fits"
+    if name.endswith((".h5", ".hdf5")):
+        return "hdf5"
+    if name.endswith((".npy", ".npz")):
+        return "numpy"
+    raise ValueError(f"Unknown file type of {path}, use FITS, HDF5 or NumPy files")
+
+
+def read_fields(path, index=slice(None), key="fields"):
+    """Read blended fields from a FITS, HDF5 or NumPy file.
+
+    Only the requested fields are read, the files being memory mapped
+    (NumPy and FITS) or sliced (HDF5).
+
+    Parameters
+    ----------
+    path: str
+        path of the file, with the fields stacked along the first axis.
+    index: slice or np.ndarray
+        fields to read.
+    key: str
+        HDU (name or index) of FITS files, dataset of HDF5 files or array of .npz files.
+        Ignored for .npy files.
+
+    Returns
+    -------
+    fields: np.ndarray
+        float32 fields.
+
+    """
+    file_type = _file_type(path)
+    if file_type == "fits":
+        from astropy.io import fits
+
+        with fits.open(path, memmap=True) as hdul:
+            hdu = hdul[int(key) if str(key).isdigit() else key]
+            return np.asarray(hdu.data[index], dtype=np.float32)
+    if file_type == "hdf5":
+        import h5py
+
+        with h5py.File(path, "r") as f:
+            return np.asarray(f[key][index], dtype=np.float32)
+    if path.endswith(".npz"):
+        with np.load(path) as archive:
+            return np.asarray(archive[key][index], dtype=np.float32)
+    return np.asarray(np.load(path, mmap_mode="r")[index], dtype=np.float32)
+
+
+def count_fields(path, key="fields"):
+    """Get the number of fields in a FITS, HDF5 or NumPy file.
+
+    Parameters
+    ----------
+    path: str
+        path of the file.
+    key: str
+        HDU, dataset or array of the fields, see `read_fields`.
+
+    Returns
+    -------
+    num_fields: int
+        number of fields.
+
+    """
+    file_type = _file_type(path)
+    if file_type == "fits":
+        from astropy.io import fits
+
+        with fits.open(path, memmap=True) as hdul:
+            return hdul[int(key) if str(key).isdigit() else key].shape[0]
+    if file_type == "hdf5":
+        import h5py
+
+        with h5py.File(path, "r") as f:
+            return f[key].shape[0]
+    if path.endswith(".npz"):
+        with np.load(path) as archive:
+            return archive[key].shape[0]
+    return np.load(path, mmap_mode="r").shape[0]
+
+
+def read_catalog(path, key=None):
+    """Read a detection catalog from a FITS, HDF5 or NumPy file.
+
+    The catalog has one row per detected galaxy, with the columns "field_id"
+    (index of the field in the fields file), "row" and "col" (pixel position).
+
+    Parameters
+    ----------
+    path: str
+        FITS table, HDF5 file or group with one dataset per column, .npz archive,
+        or .npy structured array or array of shape (num_detections, 3)
+        with the columns in the order "field_id", "row", "col".
+    key: str
+        HDU of the FITS table or HDF5 group. Defaults to the first table HDU
+        or the root group.
+
+    Returns
+    -------
+    catalog: dict
+        arrays "field_id", "row" and "col".
+
+    """
+    file_type = _file_type(path)
+    if file_type == "fits":
+        from astropy.table import Table
+
+        table = Table.read(path, hdu=key) if key is not None else Table.read(path)
+        catalog = {column: np.asarray(table[column]) for column in CATALOG_COLUMNS}
+    elif file_type == "hdf5":
+        import h5py
+
+        with h5py.File(path, "r") as f:
+            group = f[key] if key is not None else f
+            catalog = {column: group[column][:] for column in CATALOG_COLUMNS}
+    elif path.endswith(".npz"):
+        with np.load(path) as archive:
+            catalog = {column: archive[column] for column in CATALOG_COLUMNS}
+    else:
+        array = np.load(path)
+        if array.dtype.names is not None:
+            catalog = {column: array[column] for column in CATALOG_COLUMNS}
+        elif array.ndim == 2 and array.shape[1] == len(CATALOG_COLUMNS):
+            catalog = dict(zip(CATALOG_COLUMNS, array.T))
+        else:
+            raise ValueError(
+                f"The catalog {path} must be a structured array or an array of shape "
+                f"(num_detections, {len(CATALOG_COLUMNS)}), got shape {array.shape}"
+            )
+    return catalog
+
+
+def group_catalog(catalog, num_fields):
+    """Gather the detections of each field.
+
+    Parameters
+    ----------
+    catalog: dict
+        arrays "field_id", "row" and "col", see `read_catalog`.
+    num_fields: int
+        number of fields.
+
+    Returns
+    -------
+    detected_positions: np.ndarray
+        (row, col) positions of shape (num_fields, max_number, 2), padded with zeros.
+        Sub-pixel positions are kept, the deblender rounds them.
+    num_components: np.ndarray
+        number of detections in each field.
+
+    """
+    field_id = np.asarray(catalog["field_id"], dtype=np.int64)
+    out_of_range = (field_id < 0) | (field_id >= num_fields)
+    if np.any(out_of_range):
+        raise ValueError(
+            f"The catalog field_id {np.unique(field_id[out_of_range])} are out of range, "
+            f"the fields are numbered from 0 to {num_fields - 1}"
+        )
+    num_components = np.bincount(field_id, minlength=num_fields)[:num_fields]
+    order = np.argsort(field_id, kind="stable")
+    field_id = field_id[order]
+    slot = np.arange(len(field_id)) - np.searchsorted(field_id, field_id)
+
+    detected_positions = np.zeros(
+        (num_fields, max(num_components.max(initial=0), 1), 2), dtype=np.float64
+    )
+    detected_positions[field_id, slot, 0] = np.asarray(catalog["row"])[order]
+    detected_positions[field_id, slot, 1] = np.asarray(catalog["col"])[order]
+    return detected_positions, num_components
+
+
+def read_manifest(output_dir):
+    """Read the completed chunks of a run.
+
+    Parameters
+    ----------
+    output_dir: str
+        output folder of the run.
+
+    Returns
+    -------
+    manifest: dict
+        record of each completed chunk, by chunk index.
+
+    """
+    manifest = {}
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # line truncated by an interrupted run
+                    continue
+                manifest[record["chunk"]] = record
+    return manifest
+
+
+def _get_deblender(deblender_kwargs):
+    """Build the deblender of the process, once for given arguments."""
+    global _DEBLENDER, _DEBLENDER_KWARGS
+    if _DEBLENDER is None or _DEBLENDER_KWARGS != deblender_kwargs:
+        from madness_deblender.deblender import Deblender
+
+        _DEBLENDER = Deblender(**deblender_kwargs)
+        _DEBLENDER_KWARGS = dict(deblender_kwargs)
+    return _DEBLENDER
+
+
+def _init_worker(deblender_kwargs, num_threads, cpu_queue=None):
+    """Set the thread budget (and CPUs) of a worker and build its deblender."""
+    init_worker_runtime(num_threads, cpu_queue)
+    _get_deblender(deblender_kwargs)
+
+
+def deblend_chunk(
+    chunk,
+    fields_path,
+    field_ids,
+    detected_positions,
+    num_components,
+    output_path,
+    fields_key="fields",
+    deblender_kwargs=None,
+    deblend_kwargs=None,
+    store_components=True,
+):
+    """Deblend a chunk of fields and write the results to their own file.
+
+    The results are first written to a temporary file, renamed when complete,
+    so that an interrupted chunk never leaves a partial output.
+
+    Parameters
+    ----------
+    chunk: int
+        index of the chunk.
+    fields_path: str
+        path of the fields, see `read_fields`.
+    field_ids: np.ndarray
+        indices of the fields of the chunk.
+    detected_positions: np.ndarray
+        (row, col) positions of the galaxies in each field of the chunk.
+    num_components: np.ndarray
+        number of galaxies in each field of the chunk.
+    output_path: str
+        path of the results (HDF5, or Zarr for ".zarr").
+    fields_key: str
+        HDU, dataset or array of the fields.
+    deblender_kwargs: dict
+        arguments of `madness_deblender.deblender.Deblender`.
+    deblend_kwargs: dict
+        arguments of `Deblender.__call__`.
+    store_components: bool
+        to store the decoded components.
+
+    Returns
+    -------
+    record: dict
+        record of the chunk for the manifest.
+
+    """
+    from madness_deblender.writer import ResultWriter
+
+    t0 = time.perf_counter()
+    deb = _get_deblender(deblender_kwargs or {})
+    fields = read_fields(fields_path, np.asarray(field_ids), key=fields_key)
+    # trim the padding of the chunk
+    max_number = max(int(np.max(num_components)), 1)
+    deb(
+        fields,
+        np.asarray(detected_positions)[:, :max_number],
+        num_components=np.asarray(num_components),
+        **(deblend_kwargs or {}),
+    )
+
+    base, extension = os.path.splitext(output_path)
+    temp_path = base + ".tmp" + extension
+    with ResultWriter(temp_path, store_components=store_components) as writer:
+        writer.write(deb, field_ids=field_ids)
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+    os.replace(temp_path, output_path)
+
+    return {
+        "chunk": chunk,
+        "path": os.path.basename(output_path),
+        "num_fields": len(field_ids),
+        "num_galaxies": int(np.sum(num_components)),
+        "time": time.perf_counter() - t0,
+    }
+
+
+def deblend_files(
+    fields_path,
+    catalog_path,
+    output_dir,
+    batch_size=100,
+    num_workers=1,
+    threads_per_worker=None,
+    pin_cpus=False,
+    fields_key="fields",
+    catalog_key=None,
+    output_format="h5",
+    deblender_kwargs=None,
+    deblend_kwargs=None,
+    store_components=True,
+):
+    """Deblend the fields of a file in chunks, skipping the chunks completed by previous runs.
+
+    Each chunk of `batch_size` fields is deblended in one call of the deblender and
+    written to its own results file in `output_dir`. Completed chunks are recorded
+    in a manifest, so that an interrupted run can be resumed by running it again.
+    Fields without detections are skipped.
+
+    Parameters
+    ----------
+    fields_path: str
+        FITS, HDF5 or NumPy file of the blended fields, see `read_fields`.
+    catalog_path: str
+        FITS, HDF5 or NumPy detection catalog, see `read_catalog`.
+    output_dir: str
+        folder of the results and the manifest.
+    batch_size: int
+        number of fields per chunk.
+    num_workers: int
+        number of worker processes, each with its own deblender.
+        With a single worker, the chunks are deblended in the current process,
+        which is then configured with `threads_per_worker` and `pin_cpus`.
+    threads_per_worker: int
+        number of TF threads of each worker process. Defaults to the TF default,
+        or to an even split of the CPUs with `pin_cpus`.
+    pin_cpus: bool
+        to pin each worker process to its own CPUs, on a single NUMA node when possible,
+        see `madness_deblender.runtime.partition_cpus`.
+    fields_key: str
+        HDU, dataset or array of the fields.
+    catalog_key: str
+        HDU or group of the catalog.
+    output_format: str
+        "h5" or "zarr".
+    deblender_kwargs: dict
+        arguments of `madness_deblender.deblender.Deblender`.
+        A survey can be given by name.
+    deblend_kwargs: dict
+        arguments of `Deblender.__call__`.
+    store_components: bool
+        to store the decoded components.
+
+    Returns
+    -------
+    manifest: dict
+        record of each completed chunk, by chunk index.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    num_fields = count_fields(fields_path, key=fields_key)
+
+    # chunks of a resumed run must have the same boundaries
+    run = {
+        "fields_path": os.path.abspath(fields_path),
+        "catalog_path": os.path.abspath(catalog_path),
+        "num_fields": num_fields,
+        "batch_size": batch_size,
+    }
+    run_path = os.path.join(output_dir, RUN_NAME)
+    if os.path.exists(run_path):
+        with open(run_path) as f:
+            previous_run = json.load(f)
+        if previous_run != run:
+            raise ValueError(
+                f"{output_dir} contains the results of a different run: {previous_run}"
+            )
+    else:
+        with open(run_path, "w") as f:
+            json.dump(run, f)
+
+    detected_positions, num_components = group_catalog(
+        read_catalog(catalog_path, key=catalog_key), num_fields
+    )
+    manifest = read_manifest(output_dir)
+
+    chunks = []
+    for chunk, start in enumerate(range(0, num_fields, batch_size)):
+        field_ids = np.arange(start, min(start + batch_size, num_fields))
+        field_ids = field_ids[num_components[field_ids] > 0]
+        if chunk in manifest or len(field_ids) == 0:
+            continue
+        chunks.append(
+            {
+                "chunk": chunk,
+                "fields_path": fields_path,
+                "field_ids": field_ids,
+                "detected_positions": detected_positions[field_ids],
+                "num_components": num_components[field_ids],
+                "output_path": os.path.join(
+                    output_dir, f"chunk_{chunk:06d}.{output_format}"
+                ),
+                "fields_key": fields_key,
+                "deblender_kwargs": deblender_kwargs,
+                "deblend_kwargs": deblend_kwargs,
+                "store_components": store_components,
+            }
+        )
+    LOG.info(
+        f"{len(manifest)} chunks already completed, {len(chunks)} chunks to deblend"
+    )
+    if not chunks:
+        return manifest
+
+    t0 = time.perf_counter()
+    num_galaxies = 0
+
+    def record_chunk(record):
+        nonlocal num_galaxies
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        with open(manifest_path, "a+b") as f:
+            # start a new line after a line truncated by an interrupted run
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.write((json.dumps(record) + "\n").encode())
+        manifest[record["chunk"]] = record
+        num_galaxies += record["num_galaxies"]
+        LOG.info(
+            f"Chunk {record['chunk']}: {record['num_galaxies']} galaxies in "
+            f"{record['time']:.1f}s ({record['num_galaxies'] / record['time']:.1f} galaxies/s), "
+            f"overall {num_galaxies / (time.perf_counter() - t0):.1f} galaxies/s"
+        )
+
+    if pin_cpus and threads_per_worker is None:
+        threads_per_worker = auto_config(num_workers)["intra_op_threads"]
+
+    if num_workers == 1:
+        if threads_per_worker is not None or pin_cpus:
+            cpu_sets = partition_cpus(1, threads_per_worker) if pin_cpus else None
+            if pin_cpus and cpu_sets is None:
+                LOG.warning(f"Not enough CPUs to pin {threads_per_worker} threads")
+            configure_runtime(
+                intra_op_threads=threads_per_worker,
+                inter_op_threads=1,
+                parallel_iterations=threads_per_worker,
+                cpus=None if cpu_sets is None else cpu_sets[0],
+            )
+        for chunk in chunks:
+            record_chunk(deblend_chunk(**chunk))
+        return manifest
+
+    context = multiprocessing.get_context("spawn")
+    cpu_queue = None
+    if pin_cpus:
+        cpu_queue = make_cpu_queue(context, num_workers, threads_per_worker)
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(deblender_kwargs or {}, threads_per_worker, cpu_queue),
+    ) as executor:
+        futures = [executor.submit(deblend_chunk, **chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            record_chunk(future.result())
+    return manifest
+
+
+def main(argv=None):
+    """Deblend the fields of a file in resumable batches."""
+    parser = argparse.ArgumentParser(
+        prog="madness-deblend", description=deblend_files.__doc__.split("\n")[0]
+    )
+    parser.add_argument("fields", help="FITS, HDF5 or NumPy file of the fields")
+    parser.add_argument(
+        "catalog",
+        help="FITS, HDF5 or NumPy detection catalog with field_id, row and col columns",
+    )
+    parser.add_argument("output_dir", help="folder of the results and the manifest")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument(
+        "--pin-cpus",
+        action="store_true",
+        help="pin each worker to its own CPUs, on a single NUMA node when possible",
+    )
+    parser.add_argument("--fields-key", default="fields")
+    parser.add_argument("--catalog-key", default=None)
+    parser.add_argument("--format", choices=["h5", "zarr"], default="h5")
+    parser.add_argument("--no-components", action="store_true")
+    parser.add_argument("--weights-path", default=None)
+    parser.add_argument("--survey", default="LSST")
+    parser.add_argument("--stamp-shape", type=int, default=45)
+    parser.add_argument("--latent-dim", type=int, default=16)
+    parser.add_argument("--num-nf-layers", type=int, default=6)
+    parser.add_argument("--max-iter", type=int, default=60)
+    parser.add_argument("--linear-norm-coeff", type=float, nargs="+", default=[10000])
+    parser.add_argument(
+        "--noise-sigma",
+        type=float,
+        nargs="+",
+        default=None,
+        help="background noise level in each band, estimated from the fields if not given",
+    )
+    parser.add_argument(
+        "--channel-last", action="store_true", help="bands are the last axis"
+    )
+    parser.add_argument("--use-blend-groups", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    manifest = deblend_files(
+        args.fields,
+        args.catalog,
+        args.output_dir,
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        pin_cpus=args.pin_cpus,
+        fields_key=args.fields_key,
+        catalog_key=args.catalog_key,
+        output_format=args.format,
+        deblender_kwargs={
+            "stamp_shape": args.stamp_shape,
+            "latent_dim": args.latent_dim,
+            "num_nf_layers": args.num_nf_layers,
+            "weights_path": args.weights_path,
+            "survey": args.survey,
+        },
+        deblend_kwargs={
+            "max_iter": args.max_iter,
+            "linear_norm_coeff": (
+                args.linear_norm_coeff[0]
+                if len(args.linear_norm_coeff) == 1
+                else args.linear_norm_coeff
+            ),
+            "noise_sigma": args.noise_sigma,
+            "channel_last": args.channel_last,
+            "use_blend_groups": args.use_blend_groups,
+        },
+        store_components=not args.no_components,
+    )
+    LOG.info(f"{len(manifest)} chunks completed in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
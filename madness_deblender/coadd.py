@@ -0,0 +1,205 @@
+"""Cut fields lazily from memory-mapped multi-band FITS images."""
+
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+LOG = logging.getLogger(__name__)
+
+
+class CoaddReader:
+    """Cut field windows from per-band FITS images without loading them in memory.
+
+    The images are memory mapped, so that only the pages covering the requested
+    windows are read. The windows are copied straight into a float32 channel last
+    batch buffer, ready for `Deblender.__call__` with `channel_last=True`.
+
+    Images with BSCALE/BZERO scaling (e.g. quantized integer coadds) are memory
+    mapped with their raw values, since astropy would load them entirely in memory
+    to scale them, and the scaling is applied to each window when it is cut.
+    Pixels equal to the BLANK value of integer images are set to NaN.
+    """
+
+    def __init__(self, paths, field_size, hdu=0):
+        """Open the images.
+
+        Parameters
+        ----------
+        paths: list
+            FITS image of each band, in the order of the survey filters.
+        field_size: int
+            height and width of the fields.
+        hdu: int or str
+            HDU of the images.
+
+        """
+        self.paths = list(paths)
+        self.field_size = field_size
+        self._hduls = [
+            fits.open(path, memmap=True, do_not_scale_image_data=True)
+            for path in self.paths
+        ]
+        self.images = [hdul[hdu].data for hdul in self._hduls]
+        # (BSCALE, BZERO, BLANK) of each image, None if the raw values are used as they are
+        self.scalings = [
+            _get_scaling(hdul[hdu].header, image)
+            for hdul, image in zip(self._hduls, self.images)
+        ]
+        shapes = {image.shape for image in self.images}
+        if len(shapes) != 1:
+            raise ValueError(f"The images of the bands have different shapes {shapes}")
+        (self.shape,) = shapes
+        self.num_bands = len(self.images)
+
+    def grid(self, overlap=0):
+        """Compute the origins of fields tiling the images.
+
+        Parameters
+        ----------
+        overlap: int
+            number of pixels shared by neighbouring fields.
+
+        Returns
+        -------
+        origins: np.ndarray
+            (row, col) of the top left corner of each field, row by row.
+
+        """
+        stride = self.field_size - overlap
+        if stride <= 0:
+            raise ValueError("The overlap must be smaller than the field size")
+        rows = np.arange(0, max(self.shape[0] - overlap, 1), stride)
+        cols = np.arange(0, max(self.shape[1] - overlap, 1), stride)
+        return np.stack(np.meshgrid(rows, cols, indexing="ij"), -1).reshape(-1, 2)
+
+    def cut(self, origins, out=None):
+        """Cut fields from the images.
+
+        Parameters
+        ----------
+        origins: np.ndarray
+            (row, col) of the top left corner of each field.
+            Parts of the fields outside of the images are set to 0.
+        out: np.ndarray
+            float32 buffer of shape (>= len(origins), field_size, field_size, num_bands)
+            to write the fields into. If None, a new array is allocated.
+
+        Returns
+        -------
+        fields: np.ndarray
+            channel last fields of shape (len(origins), field_size, field_size, num_bands).
+
+        """
+        origins = np.reshape(np.asarray(origins, dtype=np.int64), (-1, 2))
+        if out is None:
+            out = np.empty(
+                (len(origins), self.field_size, self.field_size, self.num_bands),
+                dtype=np.float32,
+            )
+        fields = out[: len(origins)]
+        height, width = self.shape
+        for i, (row, col) in enumerate(origins):
+            r0, r1 = max(row, 0), min(row + self.field_size, height)
+            c0, c1 = max(col, 0), min(col + self.field_size, width)
+            if (r0, r1, c0, c1) != (
+                row,
+                row + self.field_size,
+                col,
+                col + self.field_size,
+            ):
+                fields[i] = 0
+            if r1 <= r0 or c1 <= c0:
+                continue
+            for band, (image, scaling) in enumerate(zip(self.images, self.scalings)):
+                window = fields[i, r0 - row : r1 - row, c0 - col : c1 - col, band]
+                window[:] = image[r0:r1, c0:c1]
+                if scaling is not None:
+                    bscale, bzero, blank = scaling
+                    if blank is not None:
+                        window[image[r0:r1, c0:c1] == blank] = np.nan
+                    window *= bscale
+                    window += bzero
+        return fields
+
+    def iter_batches(self, origins, batch_size=32, prefetch=2):
+        """Iterate over batches of fields, reading the next batches in a background thread.
+
+        The batches are written into a ring of `prefetch + 1` reused buffers,
+        so a batch is only valid until the next one is requested:
+        copy it to keep it.
+
+        Parameters
+        ----------
+        origins: np.ndarray
+            (row, col) of the top left corner of each field, see `grid`.
+        batch_size: int
+            number of fields per batch.
+        prefetch: int
+            number of batches read ahead.
+
+        Yields
+        ------
+        origins: np.ndarray
+            origins of the fields of the batch.
+        fields: np.ndarray
+            channel last float32 fields of the batch.
+
+        """
+        origins = np.reshape(np.asarray(origins, dtype=np.int64), (-1, 2))
+        buffers = [
+            np.empty(
+                (batch_size, self.field_size, self.field_size, self.num_bands),
+                dtype=np.float32,
+            )
+            for _ in range(prefetch + 1)
+        ]
+        starts = iter(range(0, len(origins), batch_size))
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+
+            def submit():
+                start = next(starts, None)
+                if start is None:
+                    return
+                batch_origins = origins[start : start + batch_size]
+                buffer = buffers[(start // batch_size) % len(buffers)]
+                pending.append(
+                    (batch_origins, executor.submit(self.cut, batch_origins, buffer))
+                )
+
+            for _ in range(prefetch + 1):
+                submit()
+            while pending:
+                batch_origins, future = pending.popleft()
+                fields = future.result()
+                yield batch_origins, fields
+                # the buffer of the batch yielded before is free again
+                submit()
+
+    def close(self):
+        """Close the images."""
+        self.images = []
+        for hdul in self._hduls:
+            hdul.close()
+
+    def __enter__(self):
+        """Enter the context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the images when leaving the context manager."""
+        self.close()
+
+
+def _get_scaling(header, image):
+    """Read the BSCALE, BZERO and BLANK keywords of an image HDU."""
+    bscale = header.get("BSCALE", 1)
+    bzero = header.get("BZERO", 0)
+    if bscale == 1 and bzero == 0:
+        return None
+    blank = header.get("BLANK") if np.issubdtype(image.dtype, np.integer) else None
+    return bscale, bzero, blank
@@ -4,23 +4,40 @@ import logging
 import os
 import time
 
-import galcheat
 import numpy as np
 import sep
 import tensorflow as tf
 import tensorflow_probability as tfp
 
-from madness_deblender.extraction import extract_cutouts
+from madness_deblender.amortized import amortized_inference
+from madness_deblender.blend_groups import (
+    compute_blend_groups,
+    merge_blend_groups,
+    split_into_blend_groups,
+)
 from madness_deblender.FlowVAEnet import FlowVAEnet
-from madness_deblender.utils import get_data_dir_path
+from madness_deblender.results import LazyComponents
+from madness_deblender.runtime import get_parallel_iterations
+from madness_deblender.sampling import posterior_sampling
+from madness_deblender.uncertainties import (
+    compute_latent_hessian,
+    laplace_covariance,
+    propagate_to_components,
+)
+from madness_deblender.utils import get_data_dir_path, get_survey
+from madness_deblender.weights import (
+    is_weights_bundle,
+    load_checkpoints,
+    load_weights_bundle,
+)
 
 tfd = tfp.distributions
 
-# logging level set to INFO
-logging.basicConfig(format="%(message)s", level=logging.INFO)
-
 LOG = logging.getLogger(__name__)
 
+# alignment (in bytes) required by TF to share the memory of numpy arrays
+EIGEN_ALIGNMENT = 64
+
 
 def vectorized_compute_reconst_loss(args):
     """Compute reconstruction loss after being passed to tf.map_fn.
@@ -146,6 +163,387 @@ def compute_residual(
     return residual_field
 
 
+def gather_cutouts(fields, index_pos_to_sub):
+    """Read the pixels of the fields under the cutout of each galaxy.
+
+    Parameters
+    ----------
+    fields: tf tensor
+        channel last fields of shape (num_fields, field_size, field_size, num_bands).
+    index_pos_to_sub: tf tensor
+        positions of the pixels of each cutout in its field, see `Deblender.get_index_pos_to_sub`.
+
+    Returns
+    -------
+    cutouts: tf tensor
+        flattened cutouts of shape (num_fields, max_number, num_pixels), 0 outside of the fields.
+    inside: tf tensor
+        1 for the pixels of the cutouts inside of their field and 0 otherwise,
+        of the same shape as `cutouts`.
+
+    """
+    fields = tf.convert_to_tensor(fields, dtype=tf.float32)
+    index_pos_to_sub = tf.cast(index_pos_to_sub, tf.int32)
+    field_shape = tf.shape(fields)[1:]
+    inside = tf.cast(
+        tf.reduce_all(
+            (index_pos_to_sub >= 0) & (index_pos_to_sub < field_shape), axis=-1
+        ),
+        tf.float32,
+    )
+    # pixels outside of the fields are read at the border and set to 0
+    index_pos_to_sub = tf.clip_by_value(index_pos_to_sub, 0, field_shape - 1)
+    cutouts = tf.gather_nd(fields, index_pos_to_sub, batch_dims=1)
+    return cutouts * inside, inside
+
+
+def find_overlapping_pairs(index_pos_to_sub, num_components, cutout_size):
+    """Find the ordered pairs of overlapping cutouts in each field.
+
+    Two cutouts overlap if they share at least one pixel, as in the footprint-overlap
+    graph of `madness_deblender.blend_groups.compute_blend_groups`.
+
+    Parameters
+    ----------
+    index_pos_to_sub: tf tensor
+        positions of the pixels of each cutout in its field, see `Deblender.get_index_pos_to_sub`.
+    num_components: tf tensor
+        number of galaxies in each field.
+    cutout_size: int
+        size of the cutouts in pixels.
+
+    Returns
+    -------
+    pairs: tf tensor
+        (field, k, l) of each pair of distinct overlapping cutouts k and l, of shape (num_pairs, 3).
+        Both (field, k, l) and (field, l, k) are listed.
+    offsets: tf tensor
+        position of the cutout l relative to the cutout k, of shape (num_pairs, 2).
+
+    """
+    # the first pixel of each cutout is its starting position
+    starts = tf.cast(index_pos_to_sub[:, :, 0, :2], tf.int32)
+    max_number = starts.shape[1]
+    valid = tf.sequence_mask(num_components, max_number)
+    offsets = starts[:, None, :, :] - starts[:, :, None, :]
+    overlaps = (
+        tf.reduce_all(tf.abs(offsets) < cutout_size, axis=-1)
+        & valid[:, :, None]
+        & valid[:, None, :]
+        & ~tf.eye(max_number, dtype=tf.bool)[None]
+    )
+    pairs = tf.cast(tf.where(overlaps), tf.int32)
+    return pairs, tf.gather_nd(offsets, pairs)
+
+
+def shift_cutouts(cutouts, offsets):
+    """Move cutouts into the frame of the cutouts they overlap.
+
+    Parameters
+    ----------
+    cutouts: tf tensor
+        channel last cutouts of shape (num_pairs, cutout_size, cutout_size, num_channels).
+    offsets: tf tensor
+        position of each cutout relative to the frame it is moved to, of shape (num_pairs, 2).
+        See `find_overlapping_pairs`.
+
+    Returns
+    -------
+    shifted_cutouts: tf tensor
+        cutouts in their new frame, of the same shape, with 0 where they do not overlap it.
+
+    """
+    cutout_size = cutouts.shape[1]
+    padded = tf.pad(
+        cutouts,
+        [[0, 0], [cutout_size, cutout_size], [cutout_size, cutout_size], [0, 0]],
+    )
+    # pixel i of the new frame is pixel i - offset of the cutout
+    index = tf.range(cutout_size)[None, :] + cutout_size - offsets[:, :, None]
+    shifted_cutouts = tf.gather(padded, index[:, 0], axis=1, batch_dims=1)
+    return tf.gather(shifted_cutouts, index[:, 1], axis=2, batch_dims=1)
+
+
+def solve_amplitudes(
+    blended_fields,
+    reconstructions,
+    index_pos_to_sub,
+    num_components,
+    sig_sq,
+    ridge=1e-6,
+    nonnegative_iterations=3,
+):
+    """Solve for the non-negative bandwise amplitude of each reconstruction by weighted least squares.
+
+    For each field and band, the amplitudes `a` minimizing
+    sum((field - sum_k a_k * reconstruction_k)**2 / sig_sq) solve the normal equations
+    of a (max_number, max_number) system. Its diagonal terms are computed on each cutout,
+    and its off-diagonal terms on the overlaps of the pairs of overlapping cutouts only,
+    so that no reconstruction is embedded in a full field.
+
+    The amplitudes are constrained to be non-negative, since a galaxy cannot have
+    a negative flux: the galaxies with a negative amplitude are removed from
+    the system, which is solved again, up to `nonnegative_iterations` times,
+    and the amplitudes still negative after that are clamped to 0.
+
+    Parameters
+    ----------
+    blended_fields: tf tensor
+        normalized channel last fields of shape (num_fields, field_size, field_size, num_bands).
+    reconstructions: tf tensor
+        channel last reconstructions of shape (num_fields, max_number, cutout_size, cutout_size, num_bands).
+    index_pos_to_sub: tf tensor
+        positions of the pixels of each reconstruction in its field, see `Deblender.get_index_pos_to_sub`.
+    num_components: tf tensor
+        number of galaxies in each field.
+    sig_sq: tf tensor
+        pixel variance of the fields.
+    ridge: float
+        relative Tikhonov regularization of the normal equations.
+    nonnegative_iterations: int
+        maximum number of times the system is solved again without the negative amplitudes.
+
+    Returns
+    -------
+    amplitudes: tf tensor
+        non-negative amplitudes of shape (num_fields, max_number, num_bands), 0 in the padded slots.
+        No gradient flows through the solution: at the optimum, the gradient of the loss
+        with respect to the latent variables does not depend on it.
+
+    """
+    reconstructions = tf.convert_to_tensor(reconstructions, dtype=tf.float32)
+    mask = tf.sequence_mask(num_components, reconstructions.shape[1], dtype=tf.float32)
+
+    field_cutouts, _ = gather_cutouts(blended_fields, index_pos_to_sub)
+    weights, _ = gather_cutouts(1 / sig_sq, index_pos_to_sub)
+    weighted = reconstructions * tf.reshape(weights, tf.shape(reconstructions))
+
+    # normal equations of each field and band: diagonal terms and right hand side
+    # from each cutout, off-diagonal terms from the overlaps of the cutouts
+    diagonal = tf.reduce_sum(weighted * reconstructions, axis=[2, 3])
+    rhs = tf.reduce_sum(
+        weighted * tf.reshape(field_cutouts, tf.shape(reconstructions)), axis=[2, 3]
+    )
+    pairs, offsets = find_overlapping_pairs(
+        index_pos_to_sub, num_components, reconstructions.shape[2]
+    )
+    cross_terms = tf.reduce_sum(
+        tf.gather_nd(weighted, pairs[:, :2])
+        * shift_cutouts(
+            tf.gather_nd(reconstructions, tf.gather(pairs, [0, 2], axis=1)), offsets
+        ),
+        axis=[1, 2],
+    )
+    rhs_shape = tf.shape(rhs)
+    lhs = tf.transpose(
+        tf.scatter_nd(
+            pairs, cross_terms, tf.concat([rhs_shape[:2], rhs_shape[1:]], axis=0)
+        ),
+        [0, 3, 1, 2],
+    )
+    diagonal = tf.transpose(diagonal, [0, 2, 1])
+    rhs = tf.transpose(rhs, [0, 2, 1])
+    # regularize (empty reconstructions get a 0 amplitude)
+    diagonal = (
+        diagonal * (1 + ridge)
+        + tf.reduce_max(diagonal, axis=-1, keepdims=True) * ridge
+        + tf.keras.backend.epsilon()
+    )
+
+    # galaxies of each band in the system, starting from all but the padded slots
+    active = tf.broadcast_to(mask[:, None, :], tf.shape(rhs))
+    for _ in range(nonnegative_iterations + 1):
+        amplitudes = tf.linalg.solve(
+            tf.linalg.set_diag(
+                lhs * active[..., :, None] * active[..., None, :],
+                diagonal * active + (1 - active),
+            ),
+            (rhs * active)[..., None],
+        )[..., 0]
+        active = active * tf.cast(amplitudes > 0, tf.float32)
+    amplitudes = tf.maximum(amplitudes, 0)
+    return tf.stop_gradient(tf.transpose(amplitudes, [0, 2, 1]) * mask[:, :, None])
+
+
+def compute_galaxy_metrics(
+    blended_fields,
+    reconstructions,
+    index_pos_to_sub,
+    num_components,
+    sig_sq,
+    noise_sigma,
+    footprint_threshold=1.0,
+):
+    """Compute quality metrics of all the galaxies of a batch of fields at once.
+
+    The footprint of a galaxy is the set of pixels where its reconstruction,
+    summed over the bands, is above `footprint_threshold` times the noise level
+    of the band sum. The metrics are computed on the cutout of each galaxy,
+    where the total model is its reconstruction plus the overlapping parts of
+    the reconstructions of the overlapping cutouts (see `find_overlapping_pairs`),
+    so that the memory used scales with the number of galaxies and not with
+    the size of the fields. Pixels outside of the fields are ignored.
+
+    Parameters
+    ----------
+    blended_fields: tf tensor
+        normalized channel last fields of shape (num_fields, field_size, field_size, num_bands).
+    reconstructions: tf tensor
+        normalized channel last reconstructions of shape
+        (num_fields, max_number, cutout_size, cutout_size, num_bands).
+    index_pos_to_sub: tf tensor
+        positions of the pixels of each reconstruction in its field, see `Deblender.get_index_pos_to_sub`.
+    num_components: tf tensor
+        number of galaxies in each field.
+    sig_sq: tf tensor
+        pixel variance of the fields.
+    noise_sigma: list/array
+        normalized background noise level in each band.
+    footprint_threshold: float
+        detection threshold of the footprints, in units of the noise level.
+
+    Returns
+    -------
+    metrics: dict
+        per galaxy tensors of shape (num_fields, max_number), with zeros in the padded slots:
+        "chi2": reduced chi2 of the residuals in the footprint (all bands),
+        "flux": normalized flux of the reconstruction in each band (with a last axis of bands),
+        "blendedness": 1 - sum(model**2) / sum(model * total model), over all bands,
+        "overlap_fraction": fraction of the footprint shared with the footprints of the other galaxies,
+        "footprint_area": number of pixels of the footprint.
+
+    """
+    reconstructions = tf.convert_to_tensor(reconstructions, dtype=tf.float32)
+    cutout_shape = tf.shape(reconstructions)
+    mask = tf.sequence_mask(num_components, reconstructions.shape[1], dtype=tf.float32)
+
+    field_cutouts, inside = gather_cutouts(blended_fields, index_pos_to_sub)
+    inverse_variance, _ = gather_cutouts(1 / sig_sq, index_pos_to_sub)
+    inside = tf.reshape(inside, cutout_shape) * mask[:, :, None, None, None]
+    models = reconstructions * inside
+
+    noise_level = tf.sqrt(tf.reduce_sum(tf.square(tf.cast(noise_sigma, tf.float32))))
+    footprints = tf.cast(
+        tf.reduce_sum(models, axis=-1, keepdims=True)
+        > footprint_threshold * noise_level,
+        tf.float32,
+    )
+    footprint_area = tf.reduce_sum(footprints, axis=[2, 3, 4])
+
+    # reconstructions and footprints of the other galaxies on each cutout
+    pairs, offsets = find_overlapping_pairs(
+        index_pos_to_sub, num_components, reconstructions.shape[2]
+    )
+    others = tf.scatter_nd(
+        pairs[:, :2],
+        shift_cutouts(
+            tf.gather_nd(
+                tf.concat([models, footprints], axis=-1),
+                tf.gather(pairs, [0, 2], axis=1),
+            ),
+            offsets,
+        ),
+        cutout_shape + [0, 0, 0, 0, 1],
+    )
+    other_models, other_footprints = others[..., :-1], others[..., -1:]
+    total_models = models + other_models
+
+    residuals = tf.reshape(field_cutouts, cutout_shape) - total_models
+    chi2_map = tf.reduce_sum(
+        tf.square(residuals) * tf.reshape(inverse_variance, cutout_shape),
+        axis=-1,
+        keepdims=True,
+    )
+    num_bands = tf.cast(cutout_shape[-1], tf.float32)
+    chi2 = tf.math.divide_no_nan(
+        tf.reduce_sum(footprints * chi2_map, axis=[2, 3, 4]),
+        footprint_area * num_bands,
+    )
+
+    # written as sum(model * others) / sum(model * total model),
+    # so that empty reconstructions are not blended
+    blendedness = tf.math.divide_no_nan(
+        tf.reduce_sum(models * other_models, axis=[2, 3, 4]),
+        tf.reduce_sum(models * total_models, axis=[2, 3, 4]),
+    )
+
+    overlap_fraction = tf.math.divide_no_nan(
+        tf.reduce_sum(
+            footprints * tf.cast(other_footprints > 0, tf.float32), axis=[2, 3, 4]
+        ),
+        footprint_area,
+    )
+
+    return {
+        "chi2": chi2 * mask,
+        "flux": tf.reduce_sum(reconstructions, axis=[2, 3]) * mask[:, :, None],
+        "blendedness": blendedness * mask,
+        "overlap_fraction": overlap_fraction * mask,
+        "footprint_area": footprint_area,
+    }
+
+
+def fields_to_tensor(blended_fields):
+    """Wrap a batch of fields in a tensor, without copying it when possible.
+
+    TF tensors are used as they are, and objects implementing the DLPack protocol
+    (e.g. arrays of other frameworks) are imported through DLPack.
+    Writable C-contiguous float32 numpy arrays with the alignment of TF tensors
+    are shared through DLPack too, other arrays are copied once, in their own dtype.
+
+    Parameters
+    ----------
+    blended_fields: np.ndarray/tf tensor
+        batch of blended fields.
+
+    Returns
+    -------
+    blended_fields: tf tensor
+        the fields, in their original layout and dtype.
+
+    """
+    if isinstance(blended_fields, tf.Tensor):
+        return blended_fields
+    if not isinstance(blended_fields, np.ndarray):
+        if hasattr(blended_fields, "__dlpack__"):
+            return tf.experimental.dlpack.from_dlpack(blended_fields.__dlpack__())
+        blended_fields = np.asarray(blended_fields)
+    if (
+        blended_fields.dtype == np.float32
+        and blended_fields.flags.c_contiguous
+        and blended_fields.flags.writeable
+        and blended_fields.size > 0
+        and blended_fields.ctypes.data % EIGEN_ALIGNMENT == 0
+    ):
+        return tf.experimental.dlpack.from_dlpack(blended_fields.__dlpack__())
+    return tf.convert_to_tensor(blended_fields)
+
+
+@tf.function(reduce_retracing=True)
+def normalize_fields(blended_fields, linear_norm_coeff, channel_last=False):
+    """Convert a batch of fields to normalized channel last float32 fields, in the graph.
+
+    Parameters
+    ----------
+    blended_fields: tf tensor
+        batch of blended fields, of any real dtype.
+    linear_norm_coeff: tf tensor
+        bandwise linear normalizing/scaling factor, scalar or of shape (num_bands,).
+    channel_last: bool
+        if the channels/filters are the last axis of the blended_fields.
+
+    Returns
+    -------
+    blended_fields: tf tensor
+        normalized fields of shape (num_fields, field_size, field_size, num_bands).
+
+    """
+    blended_fields = tf.cast(blended_fields, tf.float32)
+    if not channel_last:
+        blended_fields = tf.transpose(blended_fields, perm=[0, 2, 3, 1])
+    return blended_fields / linear_norm_coeff
+
+
 class Deblender:
     """Run the deblender."""
 
@@ -161,7 +559,7 @@ class Deblender:
         num_nf_layers=6,
         weights_path=None,
         load_weights=True,
-        survey=galcheat.get_survey("LSST"),
+        survey=None,
     ):
         """Initialize class variables.
 
@@ -185,16 +583,19 @@ class Deblender:
             number of units in the dense layer
         weights_path: string
             base path to load weights.
-            flow weights are loaded from weights_path/flow6/val_loss
-            vae weights are loaded from weights_path/deblender/val_loss
-        survey: galcheat.survey object
-            galcheat survey object to fetch survey details
+            flow weights are loaded from weights_path/flow/val_loss
+            vae weights are loaded from weights_path/vae/val_loss
+            encoder weights are loaded from weights_path/deblender/val_loss
+            It can also point to a single file weights bundle (see `madness_deblender.weights`).
+        survey: galcheat.survey object or str
+            galcheat survey object to fetch survey details, or its name. Defaults to LSST.
         load_weights: bool
             Should be used as True to load pre-trained weights.
             if False, random weights are used(used for testing purposes).
 
         """
         self.latent_dim = latent_dim
+        survey = get_survey(survey)
         self.survey = survey
         self.flow_vae_net = FlowVAEnet(
             stamp_shape=stamp_shape,
@@ -212,17 +613,11 @@ class Deblender:
             if weights_path is None:
                 data_dir_path = get_data_dir_path()
                 weights_path = os.path.join(data_dir_path, survey.name)
-            self.flow_vae_net.load_flow_weights(
-                weights_path=os.path.join(weights_path, "flow/val_loss")
-            )
+            if is_weights_bundle(weights_path):
+                load_weights_bundle(self.flow_vae_net, weights_path)
+            else:
+                load_checkpoints(self.flow_vae_net, weights_path)
             self.flow_vae_net.flow_model.trainable = False
-
-            self.flow_vae_net.load_vae_weights(
-                weights_path=os.path.join(weights_path, "vae/val_loss")
-            )
-            self.flow_vae_net.load_encoder_weights(
-                weights_path=os.path.join(weights_path, "deblender/val_loss")
-            )
         self.flow_vae_net.vae_model.trainable = False
 
         self.blended_fields = None
@@ -239,6 +634,15 @@ class Deblender:
         self.optimizer = None
         self.max_iter = None
         self.z = None
+        self.group_index = None
+        self.uncertainties = None
+        self.lazy_components = None
+        self.fit_amplitudes = None
+        self.amplitudes = None
+        self.metrics = None
+        self.residual_fields = None
+        # traced loss and gradient functions, by value of use_log_prob and fit_amplitudes
+        self._loss_functions = {}
 
     def __call__(
         self,
@@ -254,13 +658,20 @@ class Deblender:
         use_debvader=True,
         optimizer=None,
         map_solution=True,
+        use_blend_groups=False,
+        lazy_components=False,
+        fit_amplitudes=False,
+        compute_metrics=False,
+        return_residuals=False,
     ):
         """Run the Deblending operation.
 
         Parameters
         ----------
-        blended_fields: np.ndarray
-            batch of blended fields.
+        blended_fields: np.ndarray/tf tensor
+            batch of blended fields. TF tensors, objects supporting DLPack and
+            aligned float32 numpy arrays are used without copying them on the host,
+            and the normalization is done in the graph (see `fields_to_tensor`).
         detected_positions: list
             List of detected positions.
             as in array and not image
@@ -286,6 +697,22 @@ class Deblender:
         map_solution: bool
             To obtain the map solution (MADNESS) or debvader solution.
             Both `map_solution` and `use_debvader` cannot be False simultaneously.
+        use_blend_groups: bool
+            Split the fields into independent groups of galaxies with overlapping footprints
+            and optimize each group on its own sub-field.
+        lazy_components: bool
+            Do not decode the components at the end of the optimization.
+            They are decoded on access through `self.lazy_components`.
+        fit_amplitudes: bool
+            Scale each reconstruction by a per-band amplitude, solved in closed form
+            by weighted least squares at each step (see `solve_amplitudes`),
+            so that the latent space optimization only has to fit the morphologies.
+            The amplitudes are stored in `self.amplitudes` and applied to the components.
+        compute_metrics: bool
+            Compute the quality metrics of each galaxy into `self.metrics`,
+            see `compute_metrics`.
+        return_residuals: bool
+            Compute the residual fields into `self.residual_fields`.
 
         """
         # tf.config.run_functions_eagerly(False)
@@ -295,38 +722,201 @@ class Deblender:
         self.use_log_prob = use_log_prob
         self.components = None
         self.channel_last = channel_last
+        self.fit_amplitudes = fit_amplitudes
+        self.amplitudes = None
+        self.metrics = None
+        self.residual_fields = None
 
         self.noise_sigma = noise_sigma
 
-        if self.channel_last:
-            self.blended_fields = tf.convert_to_tensor(
-                blended_fields / linear_norm_coeff,
-                dtype=tf.float32,
+        self.blended_fields = normalize_fields(
+            fields_to_tensor(blended_fields),
+            tf.constant(linear_norm_coeff, dtype=tf.float32),
+            channel_last=self.channel_last,
+        )
+
+        self.detected_positions = np.asarray(detected_positions)
+        self.max_number = self.detected_positions.shape[1]
+        self.num_fields = self.detected_positions.shape[0]
+
+        self.field_size = self.blended_fields.shape[1]
+        self.group_index = None
+
+        if use_blend_groups:
+            self.results = self.deblend_blend_groups(
+                convergence_criterion=convergence_criterion,
+                use_debvader=use_debvader,
+                optimizer=optimizer,
+                map_solution=map_solution,
+                decode_components=not lazy_components,
             )
         else:
-            self.blended_fields = tf.convert_to_tensor(
-                np.transpose(blended_fields, axes=[0, 2, 3, 1]) / linear_norm_coeff,
-                dtype=tf.float32,
+            self.results = self.gradient_decent(
+                convergence_criterion=convergence_criterion,
+                use_debvader=use_debvader,
+                optimizer=optimizer,
+                map_solution=map_solution,
+                decode_components=not lazy_components,
             )
 
-        self.detected_positions = np.array(detected_positions)
-        self.max_number = self.detected_positions.shape[1]
-        self.num_fields = self.detected_positions.shape[0]
+        self.lazy_components = LazyComponents(
+            self.flow_vae_net.decoder,
+            self.z,
+            self.num_components,
+            linear_norm_coeff=self.linear_norm_coeff,
+            channel_last=self.channel_last,
+            amplitudes=self.amplitudes,
+        )
 
-        self.field_size = np.shape(blended_fields)[2]
+        if compute_metrics or return_residuals:
+            self.compute_metrics(return_residuals=return_residuals)
 
-        self.results = self.gradient_decent(
-            convergence_criterion=convergence_criterion,
-            use_debvader=use_debvader,
-            optimizer=optimizer,
-            map_solution=map_solution,
+    def deblend_blend_groups(self, **kwargs):
+        """Run the gradient descent on the independent blend groups of the fields.
+
+        Galaxies whose footprints do not overlap do not interact in the loss,
+        so each connected group is deblended as a separate small field and the
+        results are merged back to the (field, slot) layout of the input.
+
+        Parameters
+        ----------
+        kwargs:
+            arguments passed to `gradient_decent`.
+
+        Returns
+        -------
+        results: list
+            variation of the loss of each blend group over deblending iterations.
+
+        """
+        if self.noise_sigma is None:
+            # the zero-padded sub-fields would bias the background estimation
+            self.noise_sigma = self.compute_noise_sigma()
+
+        field_batch = (
+            self.blended_fields,
+            self.detected_positions,
+            self.num_components,
+            self.num_fields,
+            self.max_number,
+            self.field_size,
+        )
+
+        (
+            group_fields,
+            group_positions,
+            group_num_components,
+            self.group_index,
+        ) = split_into_blend_groups(
+            self.blended_fields.numpy(),
+            self.detected_positions,
+            self.num_components.numpy(),
+            cutout_size=self.cutout_size,
+        )
+
+        self.blended_fields = tf.convert_to_tensor(group_fields, dtype=tf.float32)
+        self.detected_positions = group_positions
+        self.num_components = tf.convert_to_tensor(group_num_components, dtype=tf.int32)
+        self.num_fields, self.max_number = group_positions.shape[:2]
+        self.field_size = group_fields.shape[1]
+
+        try:
+            results = self.gradient_decent(**kwargs)
+        finally:
+            (
+                self.blended_fields,
+                self.detected_positions,
+                self.num_components,
+                self.num_fields,
+                self.max_number,
+                self.field_size,
+            ) = field_batch
+
+        self.z = tf.convert_to_tensor(
+            merge_blend_groups(
+                self.z.numpy(), self.group_index, self.num_fields, self.max_number
+            )
+        )
+        if self.amplitudes is not None:
+            self.amplitudes = tf.convert_to_tensor(
+                merge_blend_groups(
+                    self.amplitudes.numpy(),
+                    self.group_index,
+                    self.num_fields,
+                    self.max_number,
+                )
+            )
+        if self.components is not None:
+            self.components = tf.convert_to_tensor(
+                merge_blend_groups(
+                    self.components.numpy(),
+                    self.group_index,
+                    self.num_fields,
+                    self.max_number,
+                )
+            )
+
+        return results
+
+    def debvader(
+        self,
+        blended_fields,
+        detected_positions,
+        num_components,
+        batch_size=1024,
+        linear_norm_coeff=10000,
+        channel_last=False,
+        decode=True,
+    ):
+        """Deblend with the encoder only, streaming the galaxies in chunks.
+
+        This high-throughput path skips noise estimation and gradient descent.
+        See `madness_deblender.amortized.amortized_inference`.
+
+        Parameters
+        ----------
+        blended_fields: np.ndarray
+            batch of blended fields.
+        detected_positions: list
+            List of detected positions.
+            as in array and not image
+        num_components: list
+            list of number of galaxies present in the image.
+        batch_size: int
+            number of galaxies encoded and decoded at a time.
+        linear_norm_coeff: int/list
+            list stores the bandwise linear normalizing/scaling factor.
+            if int is passed, the same scaling factor is used for all.
+        channel_last: bool
+            if the channels/filters are the last column of the blended_fields
+        decode: bool
+            to decode the components along with the latent distributions.
+
+        Returns
+        -------
+        results: dict
+            latent means ("z_mean"), latent covariances ("z_cov") and components ("components").
+
+        """
+        return amortized_inference(
+            self.flow_vae_net,
+            blended_fields,
+            detected_positions,
+            num_components,
+            batch_size=batch_size,
+            linear_norm_coeff=linear_norm_coeff,
+            channel_last=channel_last,
+            decode=decode,
         )
 
     def get_components(self):
         """Return the predicted components.
 
         The final returned image has the same value of channel_last as the input image.
+        With `lazy_components`, the full component cube is decoded at each call.
         """
+        if self.components is None:
+            return self.lazy_components.to_array()
         if self.channel_last:
             return self.components
         return np.moveaxis(self.components, -1, -3)
@@ -336,6 +926,8 @@ class Deblender:
         z,
         sig_sq,
         index_pos_to_sub,
+        blended_fields=None,
+        num_components=None,
     ):
         """Compute loss at each epoch of Deblending optimization.
 
@@ -347,6 +939,11 @@ class Deblender:
             Factor for division to convert the MSE to Gaussian approx to Poisson noise.
         index_pos_to_sub:
             index position for subtraction is `use_scatter_and_sub` is True
+        blended_fields: tf tensor
+            normalized channel last fields on which the loss is computed.
+            Defaults to all the fields being deblended.
+        num_components: tf tensor
+            number of galaxies in each of the `blended_fields`.
 
         Returns
         -------
@@ -360,12 +957,17 @@ class Deblender:
             residual field after deblending.
 
         """
+        if blended_fields is None:
+            blended_fields = self.blended_fields
+            num_components = self.num_components
+        num_fields = blended_fields.shape[0]
+
         reconstructions = self.flow_vae_net.decoder(z)
 
         reconstructions = tf.reshape(
             reconstructions,
             [
-                self.num_fields,
+                num_fields,
                 self.max_number,
                 self.cutout_size,
                 self.cutout_size,
@@ -373,16 +975,28 @@ class Deblender:
             ],
         )
 
+        if self.fit_amplitudes:
+            reconstructions = (
+                reconstructions
+                * solve_amplitudes(
+                    blended_fields,
+                    reconstructions,
+                    index_pos_to_sub,
+                    num_components,
+                    sig_sq,
+                )[:, :, None, None, :]
+            )
+
         reconstruction_loss = tf.map_fn(
             vectorized_compute_reconst_loss,
             elems=(
-                self.blended_fields,
+                blended_fields,
                 reconstructions,
                 index_pos_to_sub,
-                self.num_components,
+                num_components,
                 sig_sq,
             ),
-            parallel_iterations=20,
+            parallel_iterations=get_parallel_iterations(),
             fn_output_signature=tf.TensorSpec(
                 [],
                 dtype=tf.float32,
@@ -392,7 +1006,7 @@ class Deblender:
         log_prob = self.flow_vae_net.flow(z)
 
         log_prob = tf.reduce_sum(
-            tf.reshape(log_prob, [self.num_fields, self.max_number]), axis=[1]
+            tf.reshape(log_prob, [num_fields, self.max_number]), axis=[1]
         )
 
         final_loss = reconstruction_loss
@@ -402,6 +1016,85 @@ class Deblender:
 
         return final_loss, reconstruction_loss, log_prob
 
+    def compute_metrics(self, return_residuals=False, footprint_threshold=1.0):
+        """Compute the quality metrics of all the galaxies in one batched pass.
+
+        Parameters
+        ----------
+        return_residuals: bool
+            to also compute the residual fields into `self.residual_fields`,
+            unnormalized and with the same layout as the input fields.
+        footprint_threshold: float
+            detection threshold of the footprints, in units of the noise level.
+
+        Returns
+        -------
+        metrics: dict
+            arrays of shape (num_fields, max_number), with zeros in the padded slots:
+            "chi2", "blendedness", "overlap_fraction", "footprint_area" (see `compute_galaxy_metrics`),
+            "log_prob" of the latent representation under the flow,
+            and "flux" of shape (num_fields, max_number, num_bands), unnormalized.
+
+        """
+        z = tf.reshape(self.z, [-1, self.latent_dim])
+        reconstructions = tf.reshape(
+            self.flow_vae_net.decoder(z),
+            [
+                self.num_fields,
+                self.max_number,
+                self.cutout_size,
+                self.cutout_size,
+                self.num_bands,
+            ],
+        )
+        if self.amplitudes is not None:
+            reconstructions = reconstructions * self.amplitudes[:, :, None, None, :]
+
+        noise_sigma = self.noise_sigma
+        if noise_sigma is None:
+            noise_sigma = self.compute_noise_sigma()
+
+        index_pos_to_sub = tf.convert_to_tensor(
+            self.get_index_pos_to_sub(), dtype=tf.int32
+        )
+        metrics = compute_galaxy_metrics(
+            self.blended_fields,
+            reconstructions,
+            index_pos_to_sub,
+            self.num_components,
+            self.compute_sig_sq(),
+            noise_sigma,
+            footprint_threshold=footprint_threshold,
+        )
+        metrics["log_prob"] = tf.reshape(
+            self.flow_vae_net.flow(z), [self.num_fields, self.max_number]
+        ) * tf.sequence_mask(self.num_components, self.max_number, dtype=tf.float32)
+
+        linear_norm_coeff = np.reshape(self.linear_norm_coeff, [-1]).astype(np.float32)
+        self.metrics = {name: value.numpy() for name, value in metrics.items()}
+        self.metrics["flux"] = self.metrics["flux"] * linear_norm_coeff
+
+        if return_residuals:
+            residual_fields = tf.map_fn(
+                lambda args: compute_residual(
+                    args[0], args[1], index_pos_to_sub=args[2], num_components=args[3]
+                ),
+                elems=(
+                    self.blended_fields,
+                    reconstructions,
+                    index_pos_to_sub,
+                    self.num_components,
+                ),
+                parallel_iterations=get_parallel_iterations(),
+                fn_output_signature=tf.float32,
+            )
+            residual_fields = residual_fields.numpy() * linear_norm_coeff
+            if not self.channel_last:
+                residual_fields = np.moveaxis(residual_fields, -1, -3)
+            self.residual_fields = residual_fields
+
+        return self.metrics
+
     def get_index_pos_to_sub(self):
         """Get index position to run tf.tensor_scatter_nd_sub."""
         indices = (
@@ -464,6 +1157,29 @@ class Deblender:
 
         return np.array(sig)
 
+    def compute_sig_sq(self):
+        """Compute the pixel variance used to weight the residuals.
+
+        Returns
+        -------
+        sig_sq: tf tensor
+            Factor for division to convert the MSE to Gaussian approx to Poisson noise.
+
+        """
+        noise_level = self.noise_sigma
+        if noise_level is None:
+            noise_level = self.compute_noise_sigma()
+
+        noise_level = tf.convert_to_tensor(
+            noise_level,
+            dtype=tf.float32,
+        )
+        # Calculate sigma^2 with Gaussian approximation to Poisson noise.
+        # Note here that self.postage stamp is normalized but it must be divided again
+        # to ensure that the log likelihood does not change due to scaling/normalizing
+
+        return self.blended_fields / self.linear_norm_coeff + noise_level**2
+
     def gradient_decent(
         self,
         initZ=None,
@@ -471,6 +1187,7 @@ class Deblender:
         use_debvader=True,
         optimizer=None,
         map_solution=True,
+        decode_components=True,
     ):
         """Perform the gradient descent step to separate components (galaxies).
 
@@ -487,6 +1204,8 @@ class Deblender:
         map_solution: bool
             To obtain the map solution or debvader solution.
             Both `map_solution` and `use_debvader` cannot be False at the same time.
+        decode_components: bool
+            To decode all the components into `self.components` at the end.
 
         Returns
         -------
@@ -510,35 +1229,20 @@ class Deblender:
             # use the encoder to find a good starting point.
             LOG.info("\nUsing encoder for initial point")
             t0 = time.time()
-            cutouts = np.zeros(
-                (
-                    self.num_fields * self.max_number,
-                    self.cutout_size,
-                    self.cutout_size,
-                    self.num_bands,
-                )
-            )
-            for field_num in range(self.num_fields):
-                cutouts[
-                    field_num * self.max_number : field_num * self.max_number
-                    + self.num_components[field_num]
-                ] = extract_cutouts(
-                    self.blended_fields.numpy()[field_num],
-                    pos=self.detected_positions[field_num][
-                        : self.num_components[field_num]
-                    ],
-                    cutout_size=self.cutout_size,
-                    channel_last=True,
-                )[
-                    0
-                ]
-            initZ = tfp.layers.MultivariateNormalTriL(self.latent_dim)(
-                self.flow_vae_net.encoder(cutouts)
+            initZ = amortized_inference(
+                self.flow_vae_net,
+                self.blended_fields,
+                self.detected_positions,
+                self.num_components.numpy(),
+                linear_norm_coeff=1,
+                channel_last=True,
+                decode=False,
             )
             LOG.info("Time taken for initialization: " + str(time.time() - t0))
             z = tf.Variable(
                 tf.reshape(
-                    initZ.mean(), (self.num_fields * self.max_number, self.latent_dim)
+                    initZ["z_mean"],
+                    (self.num_fields * self.max_number, self.latent_dim),
                 )
             )
 
@@ -568,30 +1272,38 @@ class Deblender:
                 dtype=tf.int32,
             )
 
-            if self.noise_sigma is None:
-                noise_level = self.compute_noise_sigma()
-
-            noise_level = tf.convert_to_tensor(
-                noise_level,
-                dtype=tf.float32,
-            )
-            # Calculate sigma^2 with Gaussian approximation to Poisson noise.
-            # Note here that self.postage stamp is normalized but it must be divided again
-            # to ensure that the log likelihood does not change due to scaling/normalizing
-
-            sig_sq = self.blended_fields / self.linear_norm_coeff + noise_level**2
-
-            results = tfp.math.minimize(
-                loss_fn=self.generate_grad_step_loss(
-                    z=z,
-                    sig_sq=sig_sq,
-                    index_pos_to_sub=index_pos_to_sub,
-                ),
-                trainable_variables=[z],
-                num_steps=self.max_iter,
-                optimizer=optimizer,
-                convergence_criterion=convergence_criterion,
-            )
+            sig_sq = self.compute_sig_sq()
+
+            # the graph of the loss and its gradient is traced once per shape of the batch,
+            # and reused by later calls with the same shapes
+            loss_and_gradient = self.get_loss_and_gradient()
+            results = []
+            convergence_state = None
+            for step in range(self.max_iter):
+                loss, gradient = loss_and_gradient(
+                    z,
+                    sig_sq,
+                    index_pos_to_sub,
+                    self.blended_fields,
+                    self.num_components,
+                )
+                optimizer.apply_gradients([(gradient, z)])
+                results.append(loss)
+                if convergence_criterion is None:
+                    continue
+                # same protocol as tfp.math.minimize: the criterion is bootstrapped
+                # at the first step, and the loop stops when all the fields converged
+                if step == 0:
+                    convergence_state = convergence_criterion.bootstrap(
+                        loss, [gradient], [tf.identity(z)]
+                    )
+                else:
+                    has_converged, convergence_state = convergence_criterion.one_step(
+                        step, loss, [gradient], [tf.identity(z)], convergence_state
+                    )
+                    if tf.reduce_all(has_converged):
+                        break
+            results = tf.stack(results)
 
             """ LOG.info(f"Final loss {output.objective_value.numpy()}")
             LOG.info("converged "+ str(output.converged.numpy()))
@@ -604,53 +1316,253 @@ class Deblender:
             LOG.info("Time taken for gradient descent: " + str(time.time() - t0))
         else:
             results = None
-        self.components = tf.reshape(
-            self.flow_vae_net.decoder(z) * self.linear_norm_coeff,
-            [
-                self.num_fields,
-                self.max_number,
-                self.cutout_size,
-                self.cutout_size,
-                self.num_bands,
-            ],
-        )
+        if self.fit_amplitudes:
+            self.amplitudes = solve_amplitudes(
+                self.blended_fields,
+                tf.reshape(
+                    self.flow_vae_net.decoder(z),
+                    [
+                        self.num_fields,
+                        self.max_number,
+                        self.cutout_size,
+                        self.cutout_size,
+                        self.num_bands,
+                    ],
+                ),
+                tf.convert_to_tensor(self.get_index_pos_to_sub(), dtype=tf.int32),
+                self.num_components,
+                self.compute_sig_sq(),
+            )
+        if decode_components:
+            self.components = tf.reshape(
+                self.flow_vae_net.decoder(z) * self.linear_norm_coeff,
+                [
+                    self.num_fields,
+                    self.max_number,
+                    self.cutout_size,
+                    self.cutout_size,
+                    self.num_bands,
+                ],
+            )
+            if self.amplitudes is not None:
+                self.components = self.components * self.amplitudes[:, :, None, None, :]
         self.z = tf.reshape(z, (self.num_fields, self.max_number, self.latent_dim))
 
         return results
 
-    def generate_grad_step_loss(
+    def compute_uncertainties(
         self,
-        z,
-        sig_sq,
-        index_pos_to_sub,
+        fields_per_batch=16,
+        pixel_uncertainties=False,
+        batch_size=256,
+        min_eigenvalue=1e-6,
     ):
-        """Return function compute training loss that has no arguments.
+        """Compute uncertainties with a Laplace approximation at the final `z`.
+
+        The Hessian of the loss in the latent space is computed in batches of fields,
+        and inverted block-wise over the blend groups of each field.
+        The latent covariances are then propagated through the decoder Jacobian.
+        Not available if the amplitudes were fitted (see `__call__`).
 
         Parameters
         ----------
-        z: tf tensor
-            latent space representations of the reconstructions.
-        sig_sq: tf tensor
-            Factor for the division to convert the MSE to Gaussian approx to Poisson noise.
-        index_pos_to_sub:
-            index position for subtraction is `use_scatter_and_sub` is True
+        fields_per_batch: int
+            number of fields for which the Hessian is computed at a time.
+        pixel_uncertainties: bool
+            to also compute the standard deviation of each pixel of the components.
+        batch_size: int
+            number of galaxies for which the decoder Jacobian is computed at a time.
+        min_eigenvalue: float
+            eigenvalues of the Hessian are floored at this value before inversion.
 
         Returns
         -------
-        training_loss: python function
-            computes loss without taking any arguments.
+        uncertainties: dict
+            "z_cov": latent covariance of each galaxy, of shape (num_fields, max_number, latent_dim, latent_dim).
+            "flux_cov": covariance of the bandwise flux of each galaxy, of shape (num_fields, max_number, num_bands, num_bands).
+            "pixel_std": standard deviation of the components with the same shape as `get_components()`,
+            only if `pixel_uncertainties` is True.
+            Padded slots are set to zero.
 
         """
+        if self.z is None:
+            raise ValueError("Run the deblender before computing uncertainties")
+        if self.fit_amplitudes:
+            raise ValueError(
+                "Uncertainties are not available with fit_amplitudes=True: the amplitudes "
+                "are solved without gradient, so the Hessian would miss their contribution "
+                "and the flux covariances would ignore them"
+            )
+
+        t0 = time.time()
+        sig_sq = self.compute_sig_sq()
+        index_pos_to_sub = tf.convert_to_tensor(
+            self.get_index_pos_to_sub(),
+            dtype=tf.int32,
+        )
+        group_labels = compute_blend_groups(
+            self.detected_positions,
+            self.num_components.numpy(),
+            cutout_size=self.cutout_size,
+        )
+        z = tf.reshape(self.z, [self.num_fields, self.max_number * self.latent_dim])
+
+        z_cov = []
+        for start in range(0, self.num_fields, fields_per_batch):
+            end = start + fields_per_batch
+
+            def loss_fn(z_batch):
+                loss, *_ = self.compute_loss(
+                    z=tf.reshape(z_batch, [-1, self.latent_dim]),
+                    sig_sq=sig_sq[start:end],
+                    index_pos_to_sub=index_pos_to_sub[start:end],
+                    blended_fields=self.blended_fields[start:end],
+                    num_components=self.num_components[start:end],
+                )
+                return loss
+
+            hessian = compute_latent_hessian(loss_fn, z[start:end])
+            z_cov.append(
+                laplace_covariance(
+                    hessian,
+                    group_labels[start:end],
+                    latent_dim=self.latent_dim,
+                    min_eigenvalue=min_eigenvalue,
+                )
+            )
+        z_cov = np.concatenate(z_cov)
+
+        valid = group_labels >= 0
+        flux_cov, pixel_var = propagate_to_components(
+            self.flow_vae_net.decoder,
+            self.z.numpy()[valid],
+            z_cov[valid],
+            batch_size=batch_size,
+            pixel_variance=pixel_uncertainties,
+        )
 
-        @tf.function
-        def training_loss():
-            """Compute training loss."""
-            loss, *_ = self.compute_loss(
-                z=z,
-                sig_sq=sig_sq,
-                index_pos_to_sub=index_pos_to_sub,
+        coeff = np.broadcast_to(
+            np.reshape(self.linear_norm_coeff, [-1]), [self.num_bands]
+        )
+        self.uncertainties = {"z_cov": z_cov}
+        self.uncertainties["flux_cov"] = np.zeros(
+            (self.num_fields, self.max_number, self.num_bands, self.num_bands),
+            dtype=np.float32,
+        )
+        self.uncertainties["flux_cov"][valid] = flux_cov * np.outer(coeff, coeff)
+
+        if pixel_uncertainties:
+            pixel_std = np.zeros(
+                (
+                    self.num_fields,
+                    self.max_number,
+                    self.cutout_size,
+                    self.cutout_size,
+                    self.num_bands,
+                ),
+                dtype=np.float32,
             )
+            pixel_std[valid] = np.sqrt(np.maximum(pixel_var, 0)) * coeff
+            if not self.channel_last:
+                pixel_std = np.moveaxis(pixel_std, -1, -3)
+            self.uncertainties["pixel_std"] = pixel_std
+
+        LOG.info("Time taken for uncertainties: " + str(time.time() - t0))
 
-            return loss
+        return self.uncertainties
 
-        return training_loss
+    def sample_posterior(
+        self,
+        num_chains=4,
+        num_results=500,
+        num_burnin_steps=200,
+        kernel="hmc",
+        step_size=1e-2,
+        num_leapfrog_steps=10,
+        target_accept_prob=0.75,
+        init_jitter=1e-2,
+        seed=None,
+    ):
+        """Sample the posterior in the latent space with chains starting at the final `z`.
+
+        The deblending loss is used as the negative log density and the chains
+        of all the fields are run in a single graph.
+        See `madness_deblender.sampling.posterior_sampling`.
+
+        Parameters
+        ----------
+        num_chains: int
+            number of chains per field.
+        num_results: int
+            number of samples drawn per chain after burn-in.
+        num_burnin_steps: int
+            number of burn-in steps, during which the step size is adapted.
+        kernel: str
+            "hmc" for Hamiltonian Monte Carlo or "nuts" for the No-U-Turn Sampler.
+        step_size: float
+            initial leapfrog step size.
+        num_leapfrog_steps: int
+            number of leapfrog steps for HMC (ignored for NUTS).
+        target_accept_prob: float
+            acceptance probability targeted by the step size adaptation.
+        init_jitter: float
+            standard deviation of the Gaussian noise added to `z` to initialize the chains.
+        seed: int
+            seed of the chains.
+
+        Returns
+        -------
+        results: dict
+            samples of `z`, acceptance rates, step sizes and effective sample sizes.
+
+        """
+        if self.z is None:
+            raise ValueError("Run the deblender before sampling the posterior")
+
+        return posterior_sampling(
+            self,
+            num_chains=num_chains,
+            num_results=num_results,
+            num_burnin_steps=num_burnin_steps,
+            kernel=kernel,
+            step_size=step_size,
+            num_leapfrog_steps=num_leapfrog_steps,
+            target_accept_prob=target_accept_prob,
+            init_jitter=init_jitter,
+            seed=seed,
+        )
+
+    def get_loss_and_gradient(self):
+        """Return the traced function computing the loss and its gradient.
+
+        A single `tf.function` is kept for each value of `use_log_prob` and
+        `fit_amplitudes`, so that its graphs are traced once per shape of the batch
+        and reused by all the calls of the deblender.
+
+        Returns
+        -------
+        loss_and_gradient: tf.function
+            function of (z, sig_sq, index_pos_to_sub, blended_fields, num_components)
+            returning the loss and its gradient with respect to the variable `z`.
+
+        """
+        key = (self.use_log_prob, self.fit_amplitudes)
+        if key not in self._loss_functions:
+
+            @tf.function
+            def loss_and_gradient(
+                z, sig_sq, index_pos_to_sub, blended_fields, num_components
+            ):
+                with tf.GradientTape() as tape:
+                    loss, *_ = self.compute_loss(
+                        z=z,
+                        sig_sq=sig_sq,
+                        index_pos_to_sub=index_pos_to_sub,
+                        blended_fields=blended_fields,
+                        num_components=num_components,
+                    )
+                return loss, tape.gradient(loss, z)
+
+            self._loss_functions[key] = loss_and_gradient
+
+        return self._loss_functions[key]
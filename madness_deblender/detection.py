@@ -0,0 +1,178 @@
+"""Detect the galaxies of batches of fields with sep."""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import sep
+
+LOG = logging.getLogger(__name__)
+
+
+def make_detection_image(field, bands=None, noise_sigma=None):
+    """Combine the bands of a field into a detection image.
+
+    Parameters
+    ----------
+    field: np.ndarray
+        channel last field of shape (height, width, num_bands).
+    bands: list
+        indices of the bands to combine. Defaults to all of them.
+    noise_sigma: list/array
+        noise level in each band. If given, the bands are weighted by their inverse
+        variance, otherwise they are summed.
+
+    Returns
+    -------
+    detection_image: np.ndarray
+        float32 C-contiguous detection image of shape (height, width).
+
+    """
+    if bands is None:
+        bands = np.arange(field.shape[-1])
+    field = np.asarray(field)[..., bands]
+    if noise_sigma is None:
+        image = np.sum(field, axis=-1)
+    else:
+        weights = 1 / np.square(np.asarray(noise_sigma, dtype=np.float32)[bands])
+        image = np.sum(field * weights, axis=-1) / np.sum(weights)
+    return np.ascontiguousarray(image, dtype=np.float32)
+
+
+def detect_field(
+    detection_image,
+    thresh=1.5,
+    minarea=5,
+    deblend_cont=0.005,
+    max_number=None,
+    edge_margin=0,
+):
+    """Detect the sources of a single detection image.
+
+    Parameters
+    ----------
+    detection_image: np.ndarray
+        float32 C-contiguous image, see `make_detection_image`.
+    thresh: float
+        detection threshold, in units of the background RMS.
+    minarea: int
+        minimum number of pixels of a source.
+    deblend_cont: float
+        minimum contrast ratio used by sep for deblending.
+    max_number: int
+        maximum number of sources kept, the brightest ones.
+    edge_margin: int
+        sources closer than `edge_margin` pixels to the border of the image are dropped.
+
+    Returns
+    -------
+    positions: np.ndarray
+        (row, col) pixel positions of the sources, from the brightest to the faintest.
+
+    """
+    background = sep.Background(detection_image)
+    sources = sep.extract(
+        detection_image - background,
+        thresh,
+        err=background.globalrms,
+        minarea=minarea,
+        deblend_cont=deblend_cont,
+    )
+    positions = np.round(np.stack([sources["y"], sources["x"]], axis=-1)).astype(
+        np.int64
+    )
+    inside = np.all(
+        (positions >= edge_margin)
+        & (positions < np.array(detection_image.shape) - edge_margin),
+        axis=-1,
+    )
+    if not np.all(inside):
+        LOG.debug(
+            f"Dropped {np.sum(~inside)} sources within {edge_margin} pixels of the border"
+        )
+    positions, flux = positions[inside], sources["flux"][inside]
+    return positions[np.argsort(-flux, kind="stable")][:max_number]
+
+
+def detect_sources(
+    blended_fields,
+    channel_last=False,
+    bands=None,
+    noise_sigma=None,
+    thresh=1.5,
+    minarea=5,
+    deblend_cont=0.005,
+    max_number=None,
+    stamp_shape=45,
+    edge_margin=None,
+    num_threads=None,
+):
+    """Detect the galaxies of a batch of fields, ready to be deblended.
+
+    The detection images are built and the sources extracted in a thread pool,
+    in the same process as the deblender, without going through a catalog file.
+    Sources whose stamp would cross the border of the field are dropped,
+    since the deblender cannot model them.
+
+    Parameters
+    ----------
+    blended_fields: np.ndarray
+        batch of blended fields.
+    channel_last: bool
+        if the channels/filters are the last axis of the blended_fields.
+    bands: list
+        indices of the bands combined into the detection image. Defaults to all of them.
+    noise_sigma: list/array
+        noise level in each band, used to weight the bands of the detection image.
+    thresh: float
+        detection threshold, in units of the background RMS.
+    minarea: int
+        minimum number of pixels of a source.
+    deblend_cont: float
+        minimum contrast ratio used by sep for deblending.
+    max_number: int
+        maximum number of galaxies kept in each field, the brightest ones.
+    stamp_shape: int
+        size of the stamps of the deblender.
+    edge_margin: int
+        sources closer than `edge_margin` pixels to the border are dropped.
+        Defaults to `stamp_shape // 2`.
+    num_threads: int
+        number of threads. Defaults to the ThreadPoolExecutor default.
+
+    Returns
+    -------
+    detected_positions: np.ndarray
+        (row, col) positions of shape (num_fields, max_number, 2), padded with zeros,
+        to be passed to `Deblender.__call__`.
+    num_components: np.ndarray
+        number of galaxies detected in each field.
+
+    """
+    if not channel_last:
+        blended_fields = np.moveaxis(blended_fields, -3, -1)
+    if edge_margin is None:
+        edge_margin = stamp_shape // 2
+
+    def detect(field):
+        return detect_field(
+            make_detection_image(field, bands=bands, noise_sigma=noise_sigma),
+            thresh=thresh,
+            minarea=minarea,
+            deblend_cont=deblend_cont,
+            max_number=max_number,
+            edge_margin=edge_margin,
+        )
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        positions = list(executor.map(detect, blended_fields))
+
+    num_components = np.array([len(p) for p in positions], dtype=np.int64)
+    detected_positions = np.zeros(
+        (len(positions), max(num_components.max(initial=0), 1), 2), dtype=np.int64
+    )
+    for i, p in enumerate(positions):
+        detected_positions[i, : len(p)] = p
+
+    LOG.info(f"Detected {num_components.sum()} galaxies in {len(positions)} fields")
+    return detected_positions, num_components
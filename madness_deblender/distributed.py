@@ -0,0 +1,114 @@
+"""Set up data-parallel distribution strategies to train the networks."""
+
+import json
+import logging
+import socket
+
+import tensorflow as tf
+
+LOG = logging.getLogger(__name__)
+
+
+def get_strategy(strategy=None):
+    """Get a tf.distribute strategy.
+
+    Parameters
+    ----------
+    strategy: str or tf.distribute.Strategy
+        "multi_worker" for a MultiWorkerMirroredStrategy, configured from the `TF_CONFIG`
+        environment variable, "mirrored" for a MirroredStrategy over the local devices,
+        a strategy instance, or None for the default (single replica) strategy.
+
+    Returns
+    -------
+    strategy: tf.distribute.Strategy
+        the distribution strategy.
+
+    """
+    if strategy is None:
+        return tf.distribute.get_strategy()
+    if isinstance(strategy, tf.distribute.Strategy):
+        return strategy
+    if strategy == "multi_worker":
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    elif strategy == "mirrored":
+        strategy = tf.distribute.MirroredStrategy()
+    else:
+        raise ValueError(
+            f"Unknown strategy {strategy}, use 'multi_worker', 'mirrored' or a tf.distribute.Strategy"
+        )
+    LOG.info(f"Number of replicas in sync: {strategy.num_replicas_in_sync}")
+    return strategy
+
+
+def is_chief(strategy):
+    """Check if the current worker is the chief, which saves the checkpoints and logs.
+
+    Parameters
+    ----------
+    strategy: tf.distribute.Strategy
+        the distribution strategy.
+
+    Returns
+    -------
+    chief: bool
+        True for the chief or if there is a single worker.
+
+    """
+    cluster_resolver = getattr(strategy, "cluster_resolver", None)
+    if cluster_resolver is None or cluster_resolver.task_type is None:
+        return True
+    return cluster_resolver.task_type == "chief" or (
+        cluster_resolver.task_type == "worker" and cluster_resolver.task_id == 0
+    )
+
+
+def make_tf_config(index, ports, host="localhost"):
+    """Build the `TF_CONFIG` of a worker in a cluster of local processes.
+
+    Parameters
+    ----------
+    index: int
+        index of the worker. Worker 0 acts as the chief.
+    ports: list
+        port of each worker, see `find_free_ports`.
+    host: str
+        host name of the workers.
+
+    Returns
+    -------
+    tf_config: str
+        JSON string to set as the `TF_CONFIG` environment variable of the worker.
+
+    """
+    return json.dumps(
+        {
+            "cluster": {"worker": [f"{host}:{port}" for port in ports]},
+            "task": {"type": "worker", "index": index},
+        }
+    )
+
+
+def find_free_ports(num_ports):
+    """Find free local ports for a cluster of local workers.
+
+    Parameters
+    ----------
+    num_ports: int
+        number of ports.
+
+    Returns
+    -------
+    ports: list
+        free ports.
+
+    """
+    sockets = []
+    for _ in range(num_ports):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(("localhost", 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
@@ -4,8 +4,6 @@ import logging
 
 import numpy as np
 
-logging.basicConfig(format="%(message)s", level=logging.INFO)
-
 LOG = logging.getLogger(__name__)
 
 
@@ -9,8 +9,6 @@ from madness_deblender.callbacks import changeAlpha
 
 tfd = tfp.distributions
 tfb = tfp.bijectors
-logging.basicConfig(format="%(message)s", level=logging.INFO)
-
 LOG = logging.getLogger(__name__)
 
 
@@ -32,7 +30,7 @@ def vae_loss_fn_mse(x, predicted_distribution):
         objective to be minimized by the minimizer.
 
     """
-    mean = predicted_distribution.sample()
+    mean = tf.cast(predicted_distribution.sample(), tf.float32)
 
     weight = tf.sqrt(tf.reduce_max(x, axis=[1, 2, 3]))
     diff = tf.subtract(mean, x)
@@ -44,8 +42,69 @@ def vae_loss_fn_mse(x, predicted_distribution):
     return objective
 
 
+def ssim(img1, img2, max_val=1, filter_size=11, filter_sigma=1.5, k1=0.01, k2=0.03):
+    """Compute the SSIM between two batches of channel last images.
+
+    Same value as `tf.image.ssim`, but the Gaussian filter is applied as two 1D
+    depthwise convolutions, to the four local moments stacked along the channels,
+    instead of five 2D convolutions.
+
+    Parameters
+    ----------
+    img1: tf tensor
+        first batch of images of shape (batch_size, height, width, num_bands).
+    img2: tf tensor
+        second batch of images of shape (batch_size, height, width, num_bands).
+    max_val: float
+        dynamic range of the images.
+    filter_size: int
+        size of the Gaussian filter.
+    filter_sigma: float
+        width of the Gaussian filter.
+    k1: float
+        constant of the luminance term.
+    k2: float
+        constant of the contrast-structure term.
+
+    Returns
+    -------
+    ssim: tf tensor
+        SSIM of each pair of images, averaged over the bands.
+
+    """
+    num_bands = img1.shape[-1]
+    coords = tf.range(filter_size, dtype=tf.float32) - (filter_size - 1) / 2
+    gauss = tf.nn.softmax(-(coords**2) / (2 * filter_sigma**2))
+    # (filter_size, 4 * num_bands) -> depthwise filters along the rows and the columns
+    kernel = tf.tile(gauss[:, None], [1, 4 * num_bands])
+    row_kernel = kernel[:, None, :, None]
+    col_kernel = kernel[None, :, :, None]
+
+    def reducer(x):
+        x = tf.nn.depthwise_conv2d(x, row_kernel, strides=[1, 1, 1, 1], padding="VALID")
+        return tf.nn.depthwise_conv2d(
+            x, col_kernel, strides=[1, 1, 1, 1], padding="VALID"
+        )
+
+    moments = reducer(tf.concat([img1, img2, img1 * img2, img1**2 + img2**2], axis=-1))
+    mean1, mean2, mean12, mean_sq = tf.split(moments, 4, axis=-1)
+
+    c1 = (k1 * max_val) ** 2
+    c2 = (k2 * max_val) ** 2
+    num0 = mean1 * mean2 * 2
+    den0 = mean1**2 + mean2**2
+    luminance = (num0 + c1) / (den0 + c1)
+    cs = (2 * mean12 - num0 + c2) / (mean_sq - den0 + c2)
+
+    return tf.reduce_mean(luminance * cs, axis=[-3, -2, -1])
+
+
 def deblender_loss_fn_wrapper(
-    sigma_cutoff, use_ssim=False, ch_alpha=None, linear_norm_coeff=10000
+    sigma_cutoff,
+    use_ssim=False,
+    ch_alpha=None,
+    linear_norm_coeff=10000,
+    jit_compile=False,
 ):
     """Input field sigma into ssim loss function.
 
@@ -60,6 +119,9 @@ def deblender_loss_fn_wrapper(
         an instance of ChangeAlpha to update the weight of SSIM over epochs.
     linear_norm_coeff: int
         linear norm coefficient used for normalizing.
+    jit_compile: bool
+        to compile the loss (including the SSIM) with XLA.
+        Use `jit_compile` in the `FlowVAEnet.train_*` methods to also fuse it into the training step.
 
     Returns
     -------
@@ -72,7 +134,7 @@ def deblender_loss_fn_wrapper(
             "Inappropriate value for changeAlpha. Must been an instance of madness_deblender.callbacks.changeAlpha"
         )
 
-    @tf.function
+    @tf.function(jit_compile=jit_compile)
     def deblender_ssim_loss_fn(y, predicted_galaxy):
         """Compute the loss under predicted distribution, weighted by the SSIM.
 
@@ -89,6 +151,8 @@ def deblender_loss_fn_wrapper(
             objective to be minimized by the minimizer.
 
         """
+        # reductions are done in float32, even if the decoder runs in mixed precision
+        predicted_galaxy = tf.cast(predicted_galaxy, tf.float32)
         loss = tf.reduce_sum(
             (y - predicted_galaxy) ** 2 / (sigma_cutoff**2 + y / linear_norm_coeff),
             axis=[1, 2, 3],
@@ -96,13 +160,13 @@ def deblender_loss_fn_wrapper(
 
         if use_ssim:
             band_normalizer = tf.reduce_max(y, axis=[1, 2], keepdims=True)
-            ssim = tf.image.ssim(
+            ssim_value = ssim(
                 y / band_normalizer,
                 predicted_galaxy / band_normalizer,
                 max_val=1,
             )
             tf.stop_gradient(ch_alpha.alpha)
-            loss = loss * (1 - ch_alpha.alpha * ssim)
+            loss = loss * (1 - ch_alpha.alpha * ssim_value)
 
         loss = tf.reduce_mean(loss)
 
@@ -111,6 +175,36 @@ def deblender_loss_fn_wrapper(
     return deblender_ssim_loss_fn
 
 
+def sample_latent(params, latent_dim):
+    """Sample the latent distribution parametrized by the output of the encoder.
+
+    Same distribution as `tfp.layers.MultivariateNormalTriL.new(params, latent_dim)`,
+    with the scale matrix built directly from tf ops, so that the gradient
+    can be compiled with XLA for batches of any size.
+
+    Parameters
+    ----------
+    params: tf tensor
+        output of the encoder, of shape (batch_size, MultivariateNormalTriL.params_size(latent_dim)).
+    latent_dim: int
+        Number of latent dimensions.
+
+    Returns
+    -------
+    z: tf tensor
+        samples of shape (batch_size, latent_dim).
+
+    """
+    loc = params[..., :latent_dim]
+    scale_tril = tfp.math.fill_triangular(params[..., latent_dim:])
+    # same diagonal transformation as tfb.FillScaleTriL,
+    # with masks since the gradients of set_diag/diag_part need static shapes in XLA
+    eye = tf.eye(latent_dim, dtype=scale_tril.dtype)
+    diag = tf.math.softplus(scale_tril) + 1e-5
+    scale_tril = scale_tril * (1 - eye) + diag * eye
+    return loc + tf.linalg.matvec(scale_tril, tf.random.normal(tf.shape(loc)))
+
+
 def deblender_encoder_loss_wrapper(
     original_encoder,
     noise_sigma,
@@ -137,14 +231,10 @@ def deblender_encoder_loss_wrapper(
     @tf.function
     def deblender_encoder_loss(y, predicted_galaxy):
 
-        z_predicted = tfp.layers.MultivariateNormalTriL(
-            latent_dim,
-        )(predicted_galaxy)
+        z_predicted = sample_latent(tf.cast(predicted_galaxy, tf.float32), latent_dim)
 
         y = y + tf.random.normal(y.shape[1:], [0] * noise_sigma.shape[0], noise_sigma)
-        z_original = tfp.layers.MultivariateNormalTriL(
-            latent_dim,
-        )(original_encoder(y)).sample()
+        z_original = sample_latent(tf.cast(original_encoder(y), tf.float32), latent_dim)
 
         l2_norm = tf.sqrt(tf.reduce_sum((z_predicted - z_original) ** 2))
         loss = tf.reduce_mean(l2_norm)
@@ -154,7 +244,42 @@ def deblender_encoder_loss_wrapper(
     return deblender_encoder_loss
 
 
-@tf.function(experimental_compile=True)
+def deblender_encoder_cached_loss_wrapper(latent_dim=16):
+    """Loss function wrapper, with teacher latent distributions read from a cache.
+
+    Same loss as `deblender_encoder_loss_wrapper`, but the targets are the parameters
+    of the latent distributions predicted by the original encoder, precomputed with
+    `madness_deblender.pipeline.build_teacher_dataset`, so that the original encoder
+    is not run at each step.
+
+    Parameters
+    ----------
+    latent_dim: int
+        Number of latent dimensions. Defaults to 16.
+
+    Return
+    ------
+    deblender_encoder_cached_loss:
+        function to compute l2 norm
+
+    """
+
+    @tf.function
+    def deblender_encoder_cached_loss(teacher_params, predicted_galaxy):
+
+        z_predicted = sample_latent(tf.cast(predicted_galaxy, tf.float32), latent_dim)
+
+        z_original = sample_latent(tf.cast(teacher_params, tf.float32), latent_dim)
+
+        l2_norm = tf.sqrt(tf.reduce_sum((z_predicted - z_original) ** 2))
+        loss = tf.reduce_mean(l2_norm)
+
+        return loss
+
+    return deblender_encoder_cached_loss
+
+
+@tf.function(jit_compile=True)
 def flow_loss_fn(x, output):
     """Compute the loss under predicted distribution.
 
@@ -171,4 +296,4 @@ def flow_loss_fn(x, output):
         objective to be minimized by the minimizer.
 
     """
-    return -tf.math.reduce_mean(output)
+    return -tf.math.reduce_mean(tf.cast(output, tf.float32))
@@ -25,6 +25,7 @@ def create_encoder(
     filters,
     kernels,
     dense_layer_units,
+    dtype=None,
 ):
     """Create the encoder.
 
@@ -40,6 +41,9 @@ def create_encoder(
         kernels used for the convolutional layers
     dense_layer_units: int
             number of units in the dense layer
+    dtype: str or tf.keras.mixed_precision.Policy
+        dtype policy of the layers, e.g. "mixed_bfloat16".
+        The output layer is always kept in float32.
 
     Returns
     -------
@@ -58,15 +62,17 @@ def create_encoder(
             activation=None,
             padding="same",
             strides=(2, 2),
+            dtype=dtype,
         )(h)
-        h = PReLU()(h)
+        h = PReLU(dtype=dtype)(h)
 
-    h = Flatten()(h)
-    h = Dense(dense_layer_units)(h)
-    h = PReLU()(h)
+    h = Flatten(dtype=dtype)(h)
+    h = Dense(dense_layer_units, dtype=dtype)(h)
+    h = PReLU(dtype=dtype)(h)
     h = Dense(
         tfp.layers.MultivariateNormalTriL.params_size(latent_dim),
         activation=None,
+        dtype="float32",
     )(h)
 
     return Model(input_layer, h, name="encoder")
@@ -78,6 +84,7 @@ def create_decoder(
     filters,
     kernels,
     dense_layer_units,
+    dtype=None,
 ):
     """Create the decoder.
 
@@ -95,6 +102,9 @@ def create_decoder(
         backgound noise-level in each band
     dense_layer_units: int
             number of units in the dense layer
+    dtype: str or tf.keras.mixed_precision.Policy
+        dtype policy of the layers, e.g. "mixed_bfloat16".
+        The output layer is always kept in float32.
 
     Returns
     -------
@@ -103,12 +113,12 @@ def create_decoder(
 
     """
     input_layer = Input(shape=(latent_dim,))
-    h = Dense(dense_layer_units, activation=None)(input_layer)
-    h = PReLU()(h)
+    h = Dense(dense_layer_units, activation=None, dtype=dtype)(input_layer)
+    h = PReLU(dtype=dtype)(h)
     w = int(np.ceil(input_shape[0] / 2 ** (len(filters))))
-    h = Dense(w * w * filters[-1], activation=None)(tf.cast(h, tf.float32))
-    h = PReLU()(h)
-    h = Reshape((w, w, filters[-1]))(h)
+    h = Dense(w * w * filters[-1], activation=None, dtype=dtype)(h)
+    h = PReLU(dtype=dtype)(h)
+    h = Reshape((w, w, filters[-1]), dtype=dtype)(h)
     for i in range(len(filters) - 1, -1, -1):
         h = Conv2DTranspose(
             filters=filters[i],
@@ -116,10 +126,13 @@ def create_decoder(
             activation=None,
             padding="same",
             strides=(2, 2),
+            dtype=dtype,
         )(h)
-        h = PReLU()(h)
-    
-    h = Conv2DTranspose(input_shape[-1], (3, 3), activation="relu", padding="same")(h)
+        h = PReLU(dtype=dtype)(h)
+
+    h = Conv2DTranspose(
+        input_shape[-1], (3, 3), activation="relu", padding="same", dtype="float32"
+    )(h)
 
     # In case the last convolutional layer does not provide an image of the size of the input image, cropp it.
     cropping = int(h.get_shape()[1] - input_shape[0])
@@ -204,6 +217,7 @@ def create_model_fvae(
     num_nf_layers=6,
     kl_prior=None,
     kl_weight=None,
+    dtype=None,
 ):
     """Create the sinmultaneously create the VAE and the flow model.
 
@@ -229,6 +243,9 @@ def create_model_fvae(
         Weight to be multiplied tot he kl_prior
     dense_layer_units: int
             number of units in the dense layer
+    dtype: str or tf.keras.mixed_precision.Policy
+        dtype policy of the encoder and decoder layers, e.g. "mixed_bfloat16".
+        The flow and the latent space distribution are always kept in float32.
 
     Returns
     -------
@@ -254,6 +271,7 @@ def create_model_fvae(
         filters_encoder,
         kernels_encoder,
         dense_layer_units,
+        dtype=dtype,
     )
 
     # create the decoder
@@ -263,6 +281,7 @@ def create_model_fvae(
         filters_decoder,
         kernels_decoder,
         dense_layer_units,
+        dtype=dtype,
     )
 
     # create the flow transformation
@@ -278,12 +297,13 @@ def create_model_fvae(
     # Build the model
     x_input = Input(shape=(input_shape))
     z = tfp.layers.MultivariateNormalTriL(
-        latent_dim, activity_regularizer=activity_regularizer, name="latent_space"
+        latent_dim,
+        activity_regularizer=activity_regularizer,
+        name="latent_space",
+        dtype="float32",
     )(encoder(x_input))
 
     vae_model = Model(inputs=x_input, outputs=decoder(z))
-    flow_model = Model(
-        inputs=x_input, outputs=flow(z)
-    )  
+    flow_model = Model(inputs=x_input, outputs=flow(z))
 
     return vae_model, flow_model, encoder, decoder, flow, td
@@ -0,0 +1,384 @@
+"""Build tf.data input pipelines to train the networks."""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import weakref
+
+import numpy as np
+import tensorflow as tf
+
+LOG = logging.getLogger(__name__)
+
+
+def _load_shard(file_name, x_col_name, y_col_name):
+    """Load the inputs and targets stored in a .npz shard."""
+    with np.load(
+        file_name.decode() if isinstance(file_name, bytes) else file_name
+    ) as shard:
+        x = shard[x_col_name].astype(np.float32)
+        y = x if y_col_name is None else shard[y_col_name].astype(np.float32)
+    return x, y
+
+
+def build_training_dataset(
+    sources,
+    batch_size=100,
+    x_col_name="blended_gal_stamps",
+    y_col_name="isolated_gal_stamps",
+    linear_norm_coeff=10000,
+    noise_sigma=None,
+    channel_last=True,
+    shuffle_buffer=1000,
+    cache=True,
+    num_parallel_files=4,
+    repeat=False,
+    seed=None,
+):
+    """Build a tf.data pipeline of (inputs, targets) batches for training.
+
+    The pipeline interleaves the shards, normalizes the images, caches them,
+    shuffles, batches, injects noise into the inputs in parallel and prefetches.
+    Noise is injected after the cache, so that each epoch sees a new realization.
+
+    Parameters
+    ----------
+    sources: list or tuple
+        list of .npz shard files, each containing the arrays `x_col_name` and `y_col_name`,
+        or a tuple of in-memory arrays (inputs, targets).
+    batch_size: int
+        number of samples per batch.
+    x_col_name: str
+        name of the inputs in the shards.
+    y_col_name: str
+        name of the targets in the shards.
+        If None, the inputs are also used as targets (e.g. for training the flow).
+    linear_norm_coeff: int/list
+        bandwise linear normalizing/scaling factor.
+    noise_sigma: list/array
+        noise level (after normalization) in each band, added to the inputs.
+        If None, no noise is added.
+    channel_last: bool
+        if the bands are the last axis of the stored images.
+        The pipeline always returns channel last images.
+    shuffle_buffer: int
+        size of the shuffle buffer. No shuffling if 0.
+    cache: bool or str
+        to cache the normalized images in memory (True) or in the file `cache`.
+    num_parallel_files: int
+        number of shards read concurrently.
+    repeat: bool
+        to repeat the dataset indefinitely.
+    seed: int
+        seed for shuffling and noise.
+
+    Returns
+    -------
+    dataset: tf.data.Dataset
+        dataset of channel last (inputs, targets) batches.
+
+    """
+    if isinstance(sources, tuple):
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (
+                np.asarray(sources[0], dtype=np.float32),
+                np.asarray(sources[1], dtype=np.float32),
+            )
+        )
+    else:
+        sources = list(sources)
+        x, y = _load_shard(sources[0], x_col_name, y_col_name)
+        x_shape, y_shape = x.shape[1:], y.shape[1:]
+
+        def read_shard(file_name):
+            x, y = tf.numpy_function(
+                lambda f: _load_shard(f, x_col_name, y_col_name),
+                [file_name],
+                [tf.float32, tf.float32],
+            )
+            x.set_shape((None,) + x_shape)
+            y.set_shape((None,) + y_shape)
+            return tf.data.Dataset.from_tensor_slices((x, y))
+
+        dataset = tf.data.Dataset.from_tensor_slices(sources)
+        if shuffle_buffer:
+            dataset = dataset.shuffle(len(sources), seed=seed)
+        dataset = dataset.interleave(
+            read_shard,
+            cycle_length=num_parallel_files,
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=False,
+        )
+
+    linear_norm_coeff = tf.cast(linear_norm_coeff, tf.float32)
+
+    def normalize(x, y):
+        if not channel_last:
+            x = tf.transpose(x, [1, 2, 0])
+            y = tf.transpose(y, [1, 2, 0])
+        return x / linear_norm_coeff, y / linear_norm_coeff
+
+    dataset = dataset.map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+
+    if cache:
+        dataset = dataset.cache("" if cache is True else cache)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.batch(batch_size)
+
+    if noise_sigma is not None:
+        noise_sigma = tf.cast(noise_sigma, tf.float32)
+        # the state of the generator carries over from one epoch to the next,
+        # unlike op-seeded random ops which restart at each iteration
+        if seed is not None:
+            rng = tf.random.Generator.from_seed(seed)
+        else:
+            rng = tf.random.Generator.from_non_deterministic_state()
+
+        def add_noise(x, y):
+            return x + rng.normal(tf.shape(x)) * noise_sigma, y
+
+        dataset = dataset.map(add_noise, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def measure_input_stall(dataset, num_batches=100, step_fn=None):
+    """Measure how long a training loop would wait on the input pipeline.
+
+    Parameters
+    ----------
+    dataset: tf.data.Dataset
+        input pipeline.
+    num_batches: int
+        number of batches to iterate over.
+    step_fn: python function
+        function called on each batch to emulate the training step.
+        If None, the pipeline is iterated as fast as possible.
+
+    Returns
+    -------
+    stats: dict
+        "num_batches": number of batches iterated,
+        "wait_time": total time spent waiting for batches (s),
+        "step_time": total time spent in `step_fn` (s),
+        "stall_fraction": fraction of the time spent waiting for batches,
+        "batches_per_second": throughput of the loop.
+
+    """
+    iterator = iter(dataset)
+    wait_time = 0.0
+    step_time = 0.0
+    count = 0
+    for _ in range(num_batches):
+        t0 = time.perf_counter()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            break
+        t1 = time.perf_counter()
+        if step_fn is not None:
+            step_fn(batch)
+        t2 = time.perf_counter()
+        wait_time += t1 - t0
+        step_time += t2 - t1
+        count += 1
+
+    total_time = wait_time + step_time
+    stats = {
+        "num_batches": count,
+        "wait_time": wait_time,
+        "step_time": step_time,
+        "stall_fraction": wait_time / total_time if total_time > 0 else 0.0,
+        "batches_per_second": count / total_time if total_time > 0 else 0.0,
+    }
+    LOG.info(
+        f"Input pipeline: {stats['batches_per_second']:.1f} batches/s, "
+        f"{100 * stats['stall_fraction']:.1f}% of the time waiting on input"
+    )
+    return stats
+
+
+def make_cache_dataset(x, y, batch_size=100, shuffle=True, seed=None):
+    """Build a tf.data pipeline reading batches from memory mapped arrays.
+
+    Only the batches being used are read, so that the workers share the
+    page cache instead of each holding a copy of the dataset.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        memory mapped inputs.
+    y: np.ndarray
+        memory mapped targets.
+    batch_size: int
+        number of samples per batch.
+    shuffle: bool
+        to shuffle the samples at each epoch.
+    seed: int
+        seed for shuffling.
+
+    Returns
+    -------
+    dataset: tf.data.Dataset
+        dataset of (inputs, targets) batches.
+
+    """
+    dataset = tf.data.Dataset.range(len(x))
+    if shuffle:
+        dataset = dataset.shuffle(len(x), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+
+    def read_batch(index):
+        # sorted indices make the reads from the memory map sequential
+        index = np.sort(index)
+        return x[index], y[index]
+
+    def load(index):
+        x_batch, y_batch = tf.numpy_function(
+            read_batch, [index], [tf.float32, tf.float32]
+        )
+        x_batch.set_shape((None,) + x.shape[1:])
+        y_batch.set_shape((None,) + y.shape[1:])
+        return x_batch, y_batch
+
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def build_teacher_dataset(
+    generator,
+    original_encoder,
+    noise_sigma,
+    num_realizations=1,
+    batch_size=100,
+    shuffle_buffer=1000,
+    seed=None,
+    cache_dir=None,
+):
+    """Cache the latent distributions of the original encoder to train the deblender encoder.
+
+    The original encoder is run once on `num_realizations` noisy versions of each isolated
+    galaxy, and the parameters of its latent distributions are stored with the blends.
+    At each epoch, one of the realizations of each galaxy is drawn as the target
+    of `madness_deblender.losses.deblender_encoder_cached_loss_wrapper`.
+
+    The blends and teacher parameters are streamed batch by batch to files in
+    `cache_dir`, which are then memory mapped and read a batch at a time
+    (see `make_cache_dataset`), so the cache is never held in memory.
+    The cache takes 4 * num_samples * (blend_size + num_realizations * num_params) bytes
+    on disk, i.e. a float32 copy of all the blends and of the teacher parameters.
+
+    Parameters
+    ----------
+    generator:
+        tf.data.Dataset, keras.utils.Sequence or tuple of arrays,
+        returning channel last and normalized (blends, isolated galaxies).
+    original_encoder: tf.keras.Model
+        Original trained encoder (VAE as a generative model).
+    noise_sigma: list/array
+        Noise level in the bands.
+    num_realizations: int
+        number of noise realizations of each isolated galaxy.
+    batch_size: int
+        number of samples per batch.
+    shuffle_buffer: int
+        to shuffle the samples at each epoch if not 0. The whole cache is shuffled.
+    seed: int
+        seed for the noise, shuffling and the choice of the realizations.
+    cache_dir: str
+        folder of the cache files, left in place for the caller to reuse or delete.
+        Defaults to a temporary folder, deleted when the returned dataset
+        (and any dataset built from it) is garbage collected.
+
+    Returns
+    -------
+    dataset: tf.data.Dataset
+        dataset of (blends, teacher_params) batches.
+
+    """
+    if isinstance(generator, tuple):
+        x_all, y_all = generator
+        generator = (
+            (x_all[i : i + batch_size], y_all[i : i + batch_size])
+            for i in range(0, len(x_all), batch_size)
+        )
+    elif isinstance(generator, tf.keras.utils.Sequence):
+        generator = (generator[i] for i in range(len(generator)))
+
+    noise_sigma = tf.cast(noise_sigma, tf.float32)
+    rng = tf.random.Generator.from_seed(seed) if seed is not None else None
+
+    @tf.function(reduce_retracing=True)
+    def teacher(y):
+        shape = tf.concat([[num_realizations], tf.shape(y)], 0)
+        noise = rng.normal(shape) if rng is not None else tf.random.normal(shape)
+        noisy = tf.reshape(
+            y[None] + noise * noise_sigma, tf.concat([[-1], tf.shape(y)[1:]], 0)
+        )
+        params = original_encoder(noisy, training=False)
+        # (num_realizations * batch, num_params) -> (batch, num_realizations, num_params)
+        params = tf.reshape(params, [num_realizations, tf.shape(y)[0], -1])
+        return tf.transpose(tf.cast(params, tf.float32), [1, 0, 2])
+
+    temporary_cache = cache_dir is None
+    if temporary_cache:
+        cache_dir = tempfile.mkdtemp(prefix="madness_teacher_")
+    os.makedirs(cache_dir, exist_ok=True)
+    inputs_path = os.path.join(cache_dir, "inputs.bin")
+    params_path = os.path.join(cache_dir, "teacher_params.bin")
+
+    t0 = time.time()
+    num_samples = 0
+    input_shape = params_shape = None
+    with open(inputs_path, "wb") as inputs_file, open(params_path, "wb") as params_file:
+        for x, y, *_ in generator:
+            x = np.asarray(x, dtype=np.float32)
+            params = teacher(tf.convert_to_tensor(y, tf.float32)).numpy()
+            inputs_file.write(x.tobytes())
+            params_file.write(params.tobytes())
+            num_samples += len(x)
+            input_shape, params_shape = x.shape[1:], params.shape[1:]
+    with open(os.path.join(cache_dir, "metadata.json"), "w") as f:
+        json.dump(
+            {
+                "num_samples": num_samples,
+                "input_shape": list(input_shape),
+                "teacher_params_shape": list(params_shape),
+            },
+            f,
+        )
+    LOG.info(
+        f"Cached {num_realizations} teacher latent distributions for "
+        f"{num_samples} galaxies in {cache_dir} in {time.time() - t0:.1f}s"
+    )
+
+    inputs = np.memmap(
+        inputs_path, dtype=np.float32, mode="r", shape=(num_samples,) + input_shape
+    )
+    teacher_params = np.memmap(
+        params_path, dtype=np.float32, mode="r", shape=(num_samples,) + params_shape
+    )
+    dataset = make_cache_dataset(
+        inputs,
+        teacher_params,
+        batch_size=batch_size,
+        shuffle=bool(shuffle_buffer),
+        seed=seed,
+    )
+
+    def draw_realization(x, params):
+        realization = tf.random.uniform(
+            tf.shape(params)[:1], maxval=num_realizations, dtype=tf.int32, seed=seed
+        )
+        return x, tf.gather(params, realization, batch_dims=1)
+
+    dataset = dataset.map(draw_realization, num_parallel_calls=tf.data.AUTOTUNE)
+    if temporary_cache:
+        weakref.finalize(dataset, shutil.rmtree, cache_dir, ignore_errors=True)
+    return dataset
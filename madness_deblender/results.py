@@ -0,0 +1,215 @@
+"""Access deblended components without materializing the full component cube."""
+
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+class LazyComponents:
+    """Decode the components from the latent space representations on access.
+
+    Only `z` is kept in memory. Stamps are decoded per galaxy or in chunks,
+    and the most recently used ones are kept in a bounded LRU cache.
+
+    Indexing follows the layout of `Deblender.get_components()`:
+    `lazy[field]` returns all the slots of a field and `lazy[field, slot]` a single stamp.
+    """
+
+    def __init__(
+        self,
+        decoder,
+        z,
+        num_components,
+        linear_norm_coeff=1,
+        channel_last=True,
+        cache_size=1024,
+        batch_size=1024,
+        amplitudes=None,
+    ):
+        """Initialize the lazy components.
+
+        Parameters
+        ----------
+        decoder: tf.keras.Model
+            decoder of the VAE.
+        z: np.ndarray/tf tensor
+            latent space representations of shape (num_fields, max_number, latent_dim).
+        num_components: list
+            number of galaxies present in each field.
+        linear_norm_coeff: int/list
+            bandwise linear normalizing/scaling factor used for deblending.
+        channel_last: bool
+            if the bands of the returned stamps are the last axis.
+        cache_size: int
+            maximum number of decoded stamps kept in the cache.
+        batch_size: int
+            number of galaxies decoded at a time.
+        amplitudes: np.ndarray/tf tensor
+            bandwise amplitudes of the stamps of shape (num_fields, max_number, num_bands),
+            see `Deblender.__call__` with `fit_amplitudes`.
+
+        """
+        self.decoder = decoder
+        self.z = np.asarray(z, dtype=np.float32)
+        self.num_components = np.asarray(num_components)
+        self.linear_norm_coeff = np.reshape(linear_norm_coeff, [-1]).astype(np.float32)
+        self.channel_last = channel_last
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.amplitudes = (
+            None if amplitudes is None else np.asarray(amplitudes, dtype=np.float32)
+        )
+
+        self.num_fields, self.max_number = self.z.shape[:2]
+        self.stamp_shape = tuple(decoder.output_shape[1:])
+
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def shape(self):
+        """Shape of the full component cube."""
+        stamp_shape = self.stamp_shape
+        if not self.channel_last:
+            stamp_shape = (stamp_shape[-1],) + stamp_shape[:-1]
+        return (self.num_fields, self.max_number) + stamp_shape
+
+    def __len__(self):
+        """Return the number of fields."""
+        return self.num_fields
+
+    def _decode(self, field_ids, slot_ids):
+        """Decode the galaxies in the given (field, slot) into channel last stamps."""
+        z = self.z[field_ids, slot_ids]
+        stamps = np.zeros((len(z),) + self.stamp_shape, dtype=np.float32)
+        for start in range(0, len(z), self.batch_size):
+            stamps[start : start + self.batch_size] = self.decoder(
+                z[start : start + self.batch_size]
+            ).numpy()
+        if self.amplitudes is not None:
+            stamps *= self.amplitudes[field_ids, slot_ids][:, None, None, :]
+        return stamps * self.linear_norm_coeff
+
+    def decode(self, field_ids, slot_ids, channel_last=None):
+        """Decode the stamps of a list of galaxies, using and filling the cache.
+
+        Parameters
+        ----------
+        field_ids: list
+            field of each galaxy.
+        slot_ids: list
+            slot of each galaxy in its field.
+        channel_last: bool
+            overrides the band axis convention of the instance.
+
+        Returns
+        -------
+        stamps: np.ndarray
+            decoded stamps, of shape (num_galaxies, ...).
+
+        """
+        keys = list(zip(np.ravel(field_ids).tolist(), np.ravel(slot_ids).tolist()))
+        missing = list(OrderedDict.fromkeys(k for k in keys if k not in self._cache))
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        decoded = {}
+        if missing:
+            decoded = dict(zip(missing, self._decode(*np.array(missing).T)))
+
+        stamps = np.zeros((len(keys),) + self.stamp_shape, dtype=np.float32)
+        for i, key in enumerate(keys):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+            else:
+                self._cache[key] = decoded[key]
+            stamps[i] = self._cache[key]
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        if channel_last is None:
+            channel_last = self.channel_last
+        if not channel_last:
+            stamps = np.moveaxis(stamps, -1, -3)
+        return stamps
+
+    def __getitem__(self, key):
+        """Decode the stamps of a field (`lazy[field]`) or of a galaxy (`lazy[field, slot]`)."""
+        if isinstance(key, tuple):
+            field, slot = key
+            return self.decode([field], [slot])[0]
+        return self.decode([key] * self.max_number, np.arange(self.max_number))
+
+    def iter_chunks(self, chunk_size=None, channel_last=None):
+        """Iterate over the galaxies of all the fields (skipping padded slots) in chunks.
+
+        The stamps are decoded directly and do not go through the cache.
+
+        Parameters
+        ----------
+        chunk_size: int
+            number of galaxies per chunk. Defaults to `batch_size`.
+        channel_last: bool
+            overrides the band axis convention of the instance.
+
+        Yields
+        ------
+        field_ids: np.ndarray
+            field of each galaxy in the chunk.
+        slot_ids: np.ndarray
+            slot of each galaxy in the chunk.
+        stamps: np.ndarray
+            decoded stamps of the chunk.
+
+        """
+        chunk_size = chunk_size or self.batch_size
+        if channel_last is None:
+            channel_last = self.channel_last
+        valid = np.arange(self.max_number)[None, :] < self.num_components[:, None]
+        field_ids, slot_ids = np.nonzero(valid)
+        for start in range(0, len(field_ids), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            stamps = self._decode(field_ids[chunk], slot_ids[chunk])
+            if not channel_last:
+                stamps = np.moveaxis(stamps, -1, -3)
+            yield field_ids[chunk], slot_ids[chunk], stamps
+
+    def fluxes(self):
+        """Compute the bandwise flux of each galaxy, decoding in chunks.
+
+        Returns
+        -------
+        fluxes: np.ndarray
+            fluxes of shape (num_fields, max_number, num_bands), with zeros in padded slots.
+
+        """
+        fluxes = np.zeros(
+            (self.num_fields, self.max_number, self.stamp_shape[-1]), dtype=np.float32
+        )
+        for field_ids, slot_ids, stamps in self.iter_chunks(channel_last=True):
+            fluxes[field_ids, slot_ids] = stamps.sum(axis=(1, 2))
+        return fluxes
+
+    def to_array(self):
+        """Materialize the full component cube, with the same layout as `Deblender.get_components()`."""
+        field_ids, slot_ids = np.indices((self.num_fields, self.max_number))
+        components = self._decode(field_ids.ravel(), slot_ids.ravel())
+        components = np.reshape(
+            components, (self.num_fields, self.max_number) + self.stamp_shape
+        )
+        if not self.channel_last:
+            components = np.moveaxis(components, -1, -3)
+        return components
+
+    def cache_info(self):
+        """Return the cache statistics."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._cache),
+            "max_size": self.cache_size,
+        }
@@ -0,0 +1,295 @@
+"""Configure the thread pools and CPU placement of the deblender runtime."""
+
+import glob
+import logging
+import os
+import re
+
+LOG = logging.getLogger(__name__)
+
+# number of fields whose reconstruction loss is computed concurrently by tf.map_fn
+_PARALLEL_ITERATIONS = 20
+
+
+def parse_cpu_list(cpu_list):
+    """Parse a Linux CPU list such as "0-3,8,10-11".
+
+    Parameters
+    ----------
+    cpu_list: str
+        comma separated CPU indices and ranges.
+
+    Returns
+    -------
+    cpus: list
+        sorted CPU indices.
+
+    """
+    cpus = set()
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def detect_topology():
+    """Detect the CPUs available to the process and their NUMA nodes.
+
+    Returns
+    -------
+    topology: dict
+        "cpus": sorted CPUs the process may run on,
+        "numa_nodes": dict mapping each NUMA node to its available CPUs.
+        Without NUMA information, all the CPUs are on node 0.
+
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+
+    numa_nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node*/cpulist"):
+        node = int(re.search(r"node(\d+)", path).group(1))
+        with open(path) as f:
+            node_cpus = [cpu for cpu in parse_cpu_list(f.read()) if cpu in cpus]
+        if node_cpus:
+            numa_nodes[node] = node_cpus
+    if not numa_nodes:
+        numa_nodes = {0: cpus}
+    return {"cpus": cpus, "numa_nodes": dict(sorted(numa_nodes.items()))}
+
+
+def partition_cpus(num_workers, threads_per_worker=None, topology=None):
+    """Split the available CPUs between worker processes.
+
+    The workers are spread over the NUMA nodes, and each one is kept on a single node
+    when the nodes have enough CPUs, so that its memory is allocated locally.
+
+    Parameters
+    ----------
+    num_workers: int
+        number of worker processes.
+    threads_per_worker: int
+        number of CPUs of each worker. Defaults to an even split of the CPUs.
+    topology: dict
+        see `detect_topology`. Detected if None.
+
+    Returns
+    -------
+    cpu_sets: list
+        CPUs of each worker, or None if there are not enough CPUs to pin the workers.
+
+    """
+    if topology is None:
+        topology = detect_topology()
+    cpus = topology["cpus"]
+    if threads_per_worker is None:
+        threads_per_worker = max(len(cpus) // num_workers, 1)
+    if num_workers * threads_per_worker > len(cpus):
+        return None
+
+    # CPU sets fitting on a single node, taken from each node in turn
+    node_sets = [
+        [
+            node_cpus[i : i + threads_per_worker]
+            for i in range(
+                0, len(node_cpus) - threads_per_worker + 1, threads_per_worker
+            )
+        ]
+        for node_cpus in topology["numa_nodes"].values()
+    ]
+    cpu_sets = []
+    for i in range(max(map(len, node_sets), default=0)):
+        cpu_sets.extend(sets[i] for sets in node_sets if i < len(sets))
+    if len(cpu_sets) >= num_workers:
+        return cpu_sets[:num_workers]
+
+    # the workers have to span several nodes
+    return [
+        cpus[i * threads_per_worker : (i + 1) * threads_per_worker]
+        for i in range(num_workers)
+    ]
+
+
+def auto_config(num_processes=1, topology=None):
+    """Choose the runtime settings of one of several deblender processes sharing a node.
+
+    Parameters
+    ----------
+    num_processes: int
+        number of deblender processes running on the node.
+    topology: dict
+        see `detect_topology`. Detected if None.
+
+    Returns
+    -------
+    config: dict
+        "intra_op_threads", "inter_op_threads" and "parallel_iterations",
+        see `configure_runtime`.
+
+    """
+    if topology is None:
+        topology = detect_topology()
+    threads = max(len(topology["cpus"]) // num_processes, 1)
+    return {
+        "intra_op_threads": threads,
+        # independent ops only oversubscribe the cores shared with other processes
+        "inter_op_threads": 1 if num_processes > 1 else min(threads, 2),
+        "parallel_iterations": threads,
+    }
+
+
+def get_parallel_iterations():
+    """Return the number of fields whose loss is computed concurrently.
+
+    Returns
+    -------
+    parallel_iterations: int
+        `parallel_iterations` of the `tf.map_fn` of `Deblender.compute_loss`.
+
+    """
+    return _PARALLEL_ITERATIONS
+
+
+def configure_runtime(
+    intra_op_threads=None,
+    inter_op_threads=None,
+    parallel_iterations=None,
+    cpus=None,
+    numa_node=None,
+    auto=False,
+    num_processes=1,
+    process_index=None,
+):
+    """Configure the thread pools and CPU affinity of the current process.
+
+    The thread counts only take effect if this is called before TensorFlow runs
+    its first operation, e.g. at the start of a worker process.
+    `parallel_iterations` applies to the deblenders traced afterwards.
+    Arguments left to None keep their current value, unless `auto` is set.
+
+    Parameters
+    ----------
+    intra_op_threads: int
+        number of threads used within an operation (and by OpenMP).
+    inter_op_threads: int
+        number of operations run concurrently.
+    parallel_iterations: int
+        number of fields whose reconstruction loss is computed concurrently.
+    cpus: list
+        CPUs the process is pinned to, on platforms supporting it (e.g. not macOS).
+    numa_node: int
+        NUMA node the process is pinned to, if `cpus` is None.
+        The memory is then allocated on this node by the first-touch policy.
+    auto: bool
+        to choose the settings left to None from the detected topology,
+        for one of `num_processes` processes, see `auto_config`.
+    num_processes: int
+        number of deblender processes running on the node, used by `auto`.
+    process_index: int
+        index of the process among the `num_processes`. With `auto`,
+        the process is pinned to its own share of the CPUs, see `partition_cpus`.
+
+    Returns
+    -------
+    config: dict
+        the settings applied, with None for the ones left unchanged.
+
+    """
+    global _PARALLEL_ITERATIONS
+
+    topology = detect_topology()
+    if numa_node is not None and cpus is None:
+        cpus = topology["numa_nodes"][numa_node]
+    if auto:
+        settings = auto_config(num_processes, topology)
+        intra_op_threads = intra_op_threads or settings["intra_op_threads"]
+        inter_op_threads = inter_op_threads or settings["inter_op_threads"]
+        parallel_iterations = parallel_iterations or settings["parallel_iterations"]
+        if cpus is None and process_index is not None:
+            cpu_sets = partition_cpus(num_processes, intra_op_threads, topology)
+            if cpu_sets is not None:
+                cpus = cpu_sets[process_index]
+
+    if cpus is not None and not hasattr(os, "sched_setaffinity"):
+        LOG.warning("CPU affinity is not supported on this platform, not pinning")
+        cpus = None
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    if intra_op_threads is not None:
+        os.environ["OMP_NUM_THREADS"] = str(intra_op_threads)
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(intra_op_threads)
+    if inter_op_threads is not None:
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(inter_op_threads)
+    if parallel_iterations is not None:
+        _PARALLEL_ITERATIONS = parallel_iterations
+
+    if intra_op_threads is not None or inter_op_threads is not None:
+        import tensorflow as tf
+
+        try:
+            if intra_op_threads is not None:
+                tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+            if inter_op_threads is not None:
+                tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        except RuntimeError as e:
+            LOG.warning(f"The TF thread pools are already initialized: {e}")
+
+    config = {
+        "intra_op_threads": intra_op_threads,
+        "inter_op_threads": inter_op_threads,
+        "parallel_iterations": parallel_iterations,
+        "cpus": None if cpus is None else sorted(cpus),
+    }
+    LOG.info(f"Runtime configuration: {config}")
+    return config
+
+
+def init_worker_runtime(num_threads, cpu_queue=None):
+    """Configure a worker process of a pool with a thread budget and its own CPUs.
+
+    Parameters
+    ----------
+    num_threads: int
+        number of TF/OpenMP threads of the worker. If None, the TF default is kept.
+    cpu_queue: multiprocessing.Queue
+        queue of CPU sets (see `partition_cpus`) from which the worker takes its own.
+
+    """
+    configure_runtime(
+        intra_op_threads=num_threads,
+        inter_op_threads=None if num_threads is None else 1,
+        parallel_iterations=num_threads,
+        cpus=None if cpu_queue is None else cpu_queue.get(),
+    )
+
+
+def make_cpu_queue(context, num_workers, threads_per_worker):
+    """Build the queue of CPU sets of the workers of a pool, see `init_worker_runtime`.
+
+    Parameters
+    ----------
+    context: multiprocessing context
+        context of the pool.
+    num_workers: int
+        number of worker processes.
+    threads_per_worker: int
+        number of CPUs of each worker. Defaults to an even split of the CPUs.
+
+    Returns
+    -------
+    cpu_queue: multiprocessing.Queue
+        queue of the CPU sets, or None if there are not enough CPUs to pin the workers.
+
+    """
+    cpu_sets = partition_cpus(num_workers, threads_per_worker)
+    if cpu_sets is None:
+        LOG.warning(f"Not enough CPUs to pin {num_workers} workers")
+        return None
+    cpu_queue = context.Queue()
+    for cpu_set in cpu_sets:
+        cpu_queue.put(cpu_set)
+    return cpu_queue
@@ -0,0 +1,256 @@
+"""Sample the posterior of the latent space representations with MCMC."""
+
+import logging
+import time
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+LOG = logging.getLogger(__name__)
+
+
+def make_target_log_prob_fn(
+    loss_fn, blended_fields, sig_sq, index_pos_to_sub, num_components, latent_dim
+):
+    """Create the log density of the chains of all the fields.
+
+    The chains are stacked along the field axis, so that a single call of the
+    loss function evaluates every (chain, field) pair in one graph.
+
+    Parameters
+    ----------
+    loss_fn: python function
+        loss function with the signature of `Deblender.compute_loss`.
+    blended_fields: tf tensor
+        normalized channel last fields.
+    sig_sq: tf tensor
+        Factor for division to convert the MSE to Gaussian approx to Poisson noise.
+    index_pos_to_sub: tf tensor
+        index position for subtraction of the reconstructions in each field.
+    num_components: tf tensor
+        number of galaxies in each field.
+    latent_dim: int
+        size of the latent space.
+
+    Returns
+    -------
+    target_log_prob_fn: python function
+        maps a state of shape (num_chains, num_fields, max_number * latent_dim)
+        to the log density of shape (num_chains, num_fields).
+
+    """
+
+    def tile(tensor, num_chains):
+        return tf.tile(tensor, [num_chains] + [1] * (len(tensor.shape) - 1))
+
+    def target_log_prob_fn(state):
+        num_chains = state.shape[0]
+        loss, *_ = loss_fn(
+            z=tf.reshape(state, [-1, latent_dim]),
+            sig_sq=tile(sig_sq, num_chains),
+            index_pos_to_sub=tile(index_pos_to_sub, num_chains),
+            blended_fields=tile(blended_fields, num_chains),
+            num_components=tile(num_components, num_chains),
+        )
+        return -tf.reshape(loss, state.shape[:2])
+
+    return target_log_prob_fn
+
+
+def sample_latent_posterior(
+    target_log_prob_fn,
+    initial_state,
+    num_results=500,
+    num_burnin_steps=200,
+    kernel="hmc",
+    step_size=1e-2,
+    num_leapfrog_steps=10,
+    target_accept_prob=0.75,
+    seed=None,
+):
+    """Run vectorized HMC/NUTS chains with an adaptive step size for each field.
+
+    Parameters
+    ----------
+    target_log_prob_fn: python function
+        log density of the state, as returned by `make_target_log_prob_fn`.
+    initial_state: tf tensor
+        initial state of shape (num_chains, num_fields, num_params).
+    num_results: int
+        number of samples drawn per chain after burn-in.
+    num_burnin_steps: int
+        number of burn-in steps, during which the step size is adapted.
+    kernel: str
+        "hmc" for Hamiltonian Monte Carlo or "nuts" for the No-U-Turn Sampler.
+    step_size: float
+        initial leapfrog step size.
+    num_leapfrog_steps: int
+        number of leapfrog steps for HMC (ignored for NUTS).
+    target_accept_prob: float
+        acceptance probability targeted by the step size adaptation.
+    seed: int
+        seed of the chains.
+
+    Returns
+    -------
+    samples: tf tensor
+        samples of shape (num_results, num_chains, num_fields, num_params).
+    is_accepted: tf tensor
+        acceptance of each step, of shape (num_results, num_chains, num_fields).
+    step_size: tf tensor
+        adapted step size of each field.
+
+    """
+    num_fields = initial_state.shape[1]
+    step_size = tf.fill([num_fields, 1], tf.constant(step_size, dtype=tf.float32))
+
+    if kernel == "hmc":
+        mcmc_kernel = tfp.mcmc.HamiltonianMonteCarlo(
+            target_log_prob_fn,
+            step_size=step_size,
+            num_leapfrog_steps=num_leapfrog_steps,
+        )
+    elif kernel == "nuts":
+        mcmc_kernel = tfp.mcmc.NoUTurnSampler(
+            target_log_prob_fn,
+            step_size=step_size,
+        )
+    else:
+        raise ValueError(f"Unknown kernel {kernel}, use 'hmc' or 'nuts'")
+
+    mcmc_kernel = tfp.mcmc.DualAveragingStepSizeAdaptation(
+        mcmc_kernel,
+        num_adaptation_steps=int(0.8 * num_burnin_steps),
+        target_accept_prob=target_accept_prob,
+    )
+
+    @tf.function
+    def run_chains():
+        return tfp.mcmc.sample_chain(
+            num_results=num_results,
+            num_burnin_steps=num_burnin_steps,
+            current_state=initial_state,
+            kernel=mcmc_kernel,
+            trace_fn=lambda _, pkr: (
+                pkr.inner_results.is_accepted,
+                pkr.new_step_size,
+            ),
+            seed=seed,
+        )
+
+    samples, (is_accepted, step_sizes) = run_chains()
+
+    return samples, is_accepted, step_sizes[-1]
+
+
+def posterior_sampling(
+    deblender,
+    num_chains=4,
+    num_results=500,
+    num_burnin_steps=200,
+    kernel="hmc",
+    step_size=1e-2,
+    num_leapfrog_steps=10,
+    target_accept_prob=0.75,
+    init_jitter=1e-2,
+    seed=None,
+):
+    """Sample the latent posterior of deblended fields starting from the MAP solution.
+
+    Parameters
+    ----------
+    deblender: madness_deblender.deblender.Deblender
+        deblender after the MAP optimization.
+    num_chains: int
+        number of chains per field.
+    num_results: int
+        number of samples drawn per chain after burn-in.
+    num_burnin_steps: int
+        number of burn-in steps, during which the step size is adapted.
+    kernel: str
+        "hmc" for Hamiltonian Monte Carlo or "nuts" for the No-U-Turn Sampler.
+    step_size: float
+        initial leapfrog step size.
+    num_leapfrog_steps: int
+        number of leapfrog steps for HMC (ignored for NUTS).
+    target_accept_prob: float
+        acceptance probability targeted by the step size adaptation.
+    init_jitter: float
+        standard deviation of the Gaussian noise added to the MAP `z` to initialize the chains.
+    seed: int
+        seed of the chains.
+
+    Returns
+    -------
+    results: dict
+        "samples": samples of `z` of shape (num_results, num_chains, num_fields, max_number, latent_dim).
+        "acceptance_rate": acceptance rate of each field.
+        "step_size": adapted step size of each field.
+        "ess": effective sample size of each latent variable, of shape (num_fields, max_number, latent_dim).
+        "ess_per_second": minimum effective sample size over the galaxies divided by the sampling time.
+
+    """
+    num_fields = deblender.num_fields
+    max_number = deblender.max_number
+    latent_dim = deblender.latent_dim
+
+    target_log_prob_fn = make_target_log_prob_fn(
+        deblender.compute_loss,
+        blended_fields=deblender.blended_fields,
+        sig_sq=deblender.compute_sig_sq(),
+        index_pos_to_sub=tf.convert_to_tensor(
+            deblender.get_index_pos_to_sub(), dtype=tf.int32
+        ),
+        num_components=deblender.num_components,
+        latent_dim=latent_dim,
+    )
+
+    z_map = tf.reshape(deblender.z, [1, num_fields, max_number * latent_dim])
+    initial_state = z_map + init_jitter * tf.random.normal(
+        [num_chains, num_fields, max_number * latent_dim], seed=seed
+    )
+
+    LOG.info("\n--- Sampling the latent space posterior ---")
+    LOG.info(f"Kernel: {kernel}, number of chains per field: {num_chains}")
+
+    t0 = time.time()
+    samples, is_accepted, final_step_size = sample_latent_posterior(
+        target_log_prob_fn,
+        initial_state,
+        num_results=num_results,
+        num_burnin_steps=num_burnin_steps,
+        kernel=kernel,
+        step_size=step_size,
+        num_leapfrog_steps=num_leapfrog_steps,
+        target_accept_prob=target_accept_prob,
+        seed=seed,
+    )
+    time_taken = time.time() - t0
+
+    ess = tfp.mcmc.effective_sample_size(
+        samples, cross_chain_dims=1 if num_chains > 1 else None
+    )
+    if num_chains == 1:
+        ess = ess[0]
+    ess = np.reshape(ess.numpy(), [num_fields, max_number, latent_dim])
+
+    valid = np.arange(max_number)[None, :] < deblender.num_components.numpy()[:, None]
+    min_ess = ess[valid].min(axis=-1)
+    ess_per_second = float(min_ess.sum() / time_taken)
+
+    LOG.info("Time taken for sampling: " + str(time_taken))
+    LOG.info(f"Effective samples per second: {ess_per_second:.2f}")
+
+    return {
+        "samples": np.reshape(
+            samples.numpy(),
+            [num_results, num_chains, num_fields, max_number, latent_dim],
+        ),
+        "acceptance_rate": tf.reduce_mean(
+            tf.cast(is_accepted, tf.float32), axis=[0, 1]
+        ).numpy(),
+        "step_size": np.reshape(final_step_size.numpy(), [num_fields]),
+        "ess": ess,
+        "ess_per_second": ess_per_second,
+    }
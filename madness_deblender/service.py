@@ -0,0 +1,345 @@
+"""Serve deblending requests from concurrent tasks with a shared deblender."""
+
+import asyncio
+import io
+import logging
+import struct
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+class _Request:
+    """Blend waiting to be deblended."""
+
+    def __init__(self, field, positions, noise_sigma, future):
+        self.field = np.asarray(field, dtype=np.float32)
+        # sub-pixel positions are rounded by the deblender
+        self.positions = np.reshape(np.asarray(positions, dtype=np.float64), (-1, 2))
+        self.noise_sigma = tuple(np.ravel(noise_sigma).tolist())
+        self.future = future
+        self.submit_time = time.perf_counter()
+
+
+class DeblendingService:
+    """Aggregate individual blends into micro-batches deblended by a single `Deblender`.
+
+    Requests are collected until `max_batch_size` blends are waiting or the oldest
+    one has waited `max_latency` seconds. They are then grouped by field shape and
+    noise level, the detected positions are padded to a power of two number of galaxies
+    (to limit the number of distinct shapes for which the deblender traces its
+    loss), and each group is deblended in one batched optimization, in a worker thread
+    so that the event loop keeps accepting requests.
+
+    The noise level of each blend must be known, either for all the requests
+    through the "noise_sigma" of `deblend_kwargs`, or given with each request,
+    so that a result does not depend on the other blends of its batch.
+
+    The service is started and stopped with `start` and `stop`, or used as an
+    asynchronous context manager, and blends are submitted with `deblend`,
+    or through a local socket with `serve`.
+    """
+
+    def __init__(
+        self,
+        deblender,
+        max_batch_size=32,
+        max_latency=0.01,
+        num_stats=10000,
+        **deblend_kwargs,
+    ):
+        """Initialize the service.
+
+        Parameters
+        ----------
+        deblender: madness_deblender.deblender.Deblender
+            deblender shared by all the requests.
+        max_batch_size: int
+            maximum number of blends deblended together.
+        max_latency: float
+            maximum time (s) a request waits for other requests before its batch is run.
+        num_stats: int
+            number of latest requests used to compute the latency statistics.
+        deblend_kwargs: dict
+            arguments of `Deblender.__call__`, such as "max_iter", "channel_last"
+            or "linear_norm_coeff", used for all the batches.
+            "noise_sigma" is the default noise level of the requests.
+
+        """
+        self.deblender = deblender
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.noise_sigma = deblend_kwargs.pop("noise_sigma", None)
+        self.deblend_kwargs = deblend_kwargs
+
+        self._queue = None
+        self._batcher = None
+        self._executor = None
+
+        self._latencies = deque(maxlen=num_stats)
+        self._batch_sizes = []
+        self._num_galaxies = 0
+        self._start_time = None
+
+    async def start(self):
+        """Start aggregating the requests."""
+        # the deblender is stateful, so a single batch is run at a time
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = asyncio.Queue()
+        self._start_time = time.perf_counter()
+        self._batcher = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Deblend the pending requests and stop the service."""
+        if self._batcher is None:
+            return
+        await self._queue.join()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._batcher = None
+        self._executor.shutdown()
+        self._executor = None
+
+    async def __aenter__(self):
+        """Start the service."""
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        """Stop the service."""
+        await self.stop()
+
+    async def deblend(self, field, positions, noise_sigma=None):
+        """Deblend a single blended field.
+
+        Parameters
+        ----------
+        field: np.ndarray
+            blended field, with the layout given by "channel_last" in `deblend_kwargs`.
+        positions: list
+            detected (row, col) positions of the galaxies in the field.
+        noise_sigma: list
+            background noise level in each band. Defaults to the "noise_sigma"
+            of `deblend_kwargs`.
+
+        Returns
+        -------
+        components: np.ndarray
+            deblended galaxies of the field, of shape (num_galaxies, ...),
+            with the layout of `Deblender.get_components()`.
+
+        """
+        if self._batcher is None:
+            raise RuntimeError("The service is not started")
+        if len(np.ravel(positions)) == 0:
+            raise ValueError("At least one detected position is required")
+        if noise_sigma is None:
+            noise_sigma = self.noise_sigma
+        if noise_sigma is None:
+            raise ValueError(
+                "The noise level is required, pass noise_sigma to the request or the service"
+            )
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(field, positions, noise_sigma, future))
+        return await future
+
+    async def _collect(self):
+        """Wait for a micro-batch of requests."""
+        requests = [await self._queue.get()]
+        deadline = requests[0].submit_time + self.max_latency
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            requests.append(request)
+        return requests
+
+    async def _run(self):
+        """Deblend the micro-batches as they are collected."""
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self._collect()
+            buckets = defaultdict(list)
+            for request in requests:
+                buckets[request.field.shape, request.noise_sigma].append(request)
+            for bucket in buckets.values():
+                try:
+                    components = await loop.run_in_executor(
+                        self._executor, self._deblend_batch, bucket
+                    )
+                except Exception as e:
+                    for request in bucket:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                else:
+                    now = time.perf_counter()
+                    for request, result in zip(bucket, components):
+                        if not request.future.done():
+                            request.future.set_result(result)
+                        self._latencies.append(now - request.submit_time)
+                    self._batch_sizes.append(len(bucket))
+                    self._num_galaxies += sum(len(r.positions) for r in bucket)
+            for _ in requests:
+                self._queue.task_done()
+
+    def _deblend_batch(self, requests):
+        """Deblend a batch of requests with fields of the same shape and noise level."""
+        num_components = [len(request.positions) for request in requests]
+        max_number = 1 << (max(num_components) - 1).bit_length()
+        positions = np.zeros((len(requests), max_number, 2))
+        for i, request in enumerate(requests):
+            positions[i, : num_components[i]] = request.positions
+
+        self.deblender(
+            np.stack([request.field for request in requests]),
+            positions,
+            num_components=num_components,
+            noise_sigma=list(requests[0].noise_sigma),
+            **self.deblend_kwargs,
+        )
+        components = np.asarray(self.deblender.get_components())
+        return [components[i, :n] for i, n in enumerate(num_components)]
+
+    def stats(self):
+        """Latency and throughput statistics of the service.
+
+        Returns
+        -------
+        stats: dict
+            "num_requests", "num_batches", "mean_batch_size",
+            "latency_p50", "latency_p90" and "latency_p99" (s),
+            and "requests_per_second" and "galaxies_per_second" since the start.
+
+        """
+        num_requests = sum(self._batch_sizes)
+        elapsed = time.perf_counter() - self._start_time if self._start_time else 0.0
+        latencies = (
+            np.percentile(self._latencies, [50, 90, 99])
+            if self._latencies
+            else [None] * 3
+        )
+        return {
+            "num_requests": num_requests,
+            "num_batches": len(self._batch_sizes),
+            "mean_batch_size": (
+                num_requests / len(self._batch_sizes) if self._batch_sizes else 0.0
+            ),
+            "latency_p50": latencies[0],
+            "latency_p90": latencies[1],
+            "latency_p99": latencies[2],
+            "requests_per_second": num_requests / elapsed if elapsed else 0.0,
+            "galaxies_per_second": self._num_galaxies / elapsed if elapsed else 0.0,
+        }
+
+    async def serve(self, host="localhost", port=0):
+        """Accept deblending requests on a local socket.
+
+        Each message is a 8 bytes little-endian length followed by a .npz archive.
+        Requests contain the arrays "field", "positions" and optionally "noise_sigma",
+        and the responses
+        "components", or "error" if the deblending failed. See `request_deblending`.
+
+        Parameters
+        ----------
+        host: str
+            host name to listen on.
+        port: int
+            port to listen on. If 0, a free port is chosen.
+
+        Returns
+        -------
+        server: asyncio.Server
+            the server, whose port is given by `server.sockets[0].getsockname()[1]`.
+
+        """
+
+        async def handle(reader, writer):
+            try:
+                while True:
+                    try:
+                        arrays = await _read_message(reader)
+                    except asyncio.IncompleteReadError:
+                        break
+                    try:
+                        response = {
+                            "components": await self.deblend(
+                                arrays["field"],
+                                arrays["positions"],
+                                arrays.get("noise_sigma"),
+                            )
+                        }
+                    except Exception as e:
+                        response = {"error": np.array(repr(e))}
+                    await _write_message(writer, response)
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+async def _read_message(reader):
+    """Read a length-prefixed .npz message."""
+    (size,) = struct.unpack("<Q", await reader.readexactly(8))
+    with np.load(io.BytesIO(await reader.readexactly(size))) as archive:
+        return dict(archive)
+
+
+async def _write_message(writer, arrays):
+    """Write a length-prefixed .npz message."""
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    writer.write(struct.pack("<Q", buffer.tell()) + buffer.getvalue())
+    await writer.drain()
+
+
+async def request_deblending(
+    field, positions, noise_sigma=None, host="localhost", port=None
+):
+    """Deblend a field with a `DeblendingService` served on a local socket.
+
+    Parameters
+    ----------
+    field: np.ndarray
+        blended field.
+    positions: list
+        detected (row, col) positions of the galaxies in the field.
+    noise_sigma: list
+        background noise level in each band. Defaults to the one of the service.
+    host: str
+        host name of the service.
+    port: int
+        port of the service.
+
+    Returns
+    -------
+    components: np.ndarray
+        deblended galaxies of the field.
+
+    """
+    request = {
+        "field": np.asarray(field, dtype=np.float32),
+        "positions": np.asarray(positions, dtype=np.float64),
+    }
+    if noise_sigma is not None:
+        request["noise_sigma"] = np.asarray(noise_sigma, dtype=np.float64)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        await _write_message(writer, request)
+        response = await _read_message(reader)
+    finally:
+        writer.close()
+    if "error" in response:
+        raise RuntimeError(f"Deblending failed: {response['error']}")
+    return response["components"]
@@ -0,0 +1,259 @@
+"""Simulate blends on the fly from a pool of isolated galaxies to train the deblender encoder."""
+
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+from madness_deblender.utils import get_survey
+
+LOG = logging.getLogger(__name__)
+
+
+def get_noise_sigma(survey=None, linear_norm_coeff=10000):
+    """Compute the normalized background noise level in each band of a survey.
+
+    The noise is dominated by the sky background, with sigma = sqrt(mean sky level).
+
+    Parameters
+    ----------
+    survey: galcheat.survey object or str
+        galcheat survey object to fetch survey details, or its name. Defaults to LSST.
+    linear_norm_coeff: int/list
+        bandwise linear normalizing/scaling factor.
+
+    Returns
+    -------
+    noise_sigma: np.ndarray
+        normalized noise level in each band.
+
+    """
+    from galcheat.utilities import mean_sky_level
+
+    survey = get_survey(survey)
+    sky_level = np.array(
+        [
+            mean_sky_level(survey, band).to_value("electron")
+            for band in survey.available_filters
+        ]
+    )
+    return (np.sqrt(sky_level) / np.asarray(linear_norm_coeff)).astype(np.float32)
+
+
+def shift_stamps(stamps, shifts):
+    """Shift a batch of stamps by sub-pixel offsets, padding with zeros.
+
+    Parameters
+    ----------
+    stamps: tf tensor
+        channel last stamps of shape (batch_size, height, width, num_bands).
+    shifts: tf tensor
+        (row, col) offset of each stamp in pixels, of shape (batch_size, 2).
+
+    Returns
+    -------
+    shifted_stamps: tf tensor
+        shifted stamps, with bilinear interpolation.
+
+    """
+    shifts = tf.cast(shifts, tf.float32)
+    ones = tf.ones_like(shifts[:, 0])
+    zeros = tf.zeros_like(shifts[:, 0])
+    # maps output pixel (x, y) to input pixel (x - col, y - row)
+    transforms = tf.stack(
+        [ones, zeros, -shifts[:, 1], zeros, ones, -shifts[:, 0], zeros, zeros], axis=1
+    )
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=stamps,
+        transforms=transforms,
+        output_shape=tf.shape(stamps)[1:3],
+        fill_value=0.0,
+        interpolation="BILINEAR",
+        fill_mode="CONSTANT",
+    )
+
+
+def simulate_blends(
+    pool,
+    batch_size,
+    seed,
+    max_number=4,
+    max_shift=15,
+    flux_range=(0.5, 2.0),
+    noise_sigma=None,
+    linear_norm_coeff=10000,
+    source_noise=True,
+):
+    """Simulate a batch of blends and their isolated central galaxies.
+
+    Each blend has a central galaxy and between 0 and `max_number - 1`
+    neighbours, randomly drawn from the pool, shifted and rescaled.
+
+    Parameters
+    ----------
+    pool: tf tensor
+        normalized channel last stamps of isolated noiseless galaxies,
+        of shape (pool_size, height, width, num_bands).
+    batch_size: int
+        number of blends.
+    seed: tf tensor
+        seed of shape (2,) of the stateless random ops.
+    max_number: int
+        maximum number of galaxies in a blend.
+    max_shift: float
+        maximum offset of the neighbours (in pixels) along each axis.
+    flux_range: tuple
+        range of the log-uniform factor by which the flux of each galaxy is rescaled.
+    noise_sigma: list/array
+        normalized background noise level in each band. If None, no noise is added.
+    linear_norm_coeff: int/list
+        bandwise linear normalizing/scaling factor of the pool,
+        used for the Gaussian approximation to the Poisson noise of the sources.
+    source_noise: bool
+        to add the Poisson noise of the sources on top of the background noise.
+
+    Returns
+    -------
+    blends: tf tensor
+        noisy blends of shape (batch_size, height, width, num_bands).
+    isolated: tf tensor
+        noiseless central galaxies of shape (batch_size, height, width, num_bands).
+
+    """
+    seeds = tf.unstack(
+        tf.random.experimental.stateless_split(tf.cast(seed, tf.int64), num=5)
+    )
+    pool_size = tf.shape(pool)[0]
+    num_neighbours = max_number - 1
+    log_flux_range = np.log(flux_range).astype(np.float32)
+
+    # galaxies of each blend, the first one being the central galaxy
+    index = tf.random.stateless_uniform(
+        [batch_size, max_number], seeds[0], maxval=pool_size, dtype=tf.int32
+    )
+    flux_scale = tf.exp(
+        tf.random.stateless_uniform(
+            [batch_size, max_number, 1, 1, 1],
+            seeds[1],
+            minval=log_flux_range[0],
+            maxval=log_flux_range[1],
+        )
+    )
+    galaxies = tf.gather(pool, index) * flux_scale
+
+    isolated = galaxies[:, 0]
+    blends = isolated
+
+    if num_neighbours > 0:
+        number = tf.random.stateless_uniform(
+            [batch_size, 1], seeds[2], maxval=num_neighbours + 1, dtype=tf.int32
+        )
+        is_present = tf.cast(tf.range(num_neighbours)[None, :] < number, tf.float32)
+        shifts = tf.random.stateless_uniform(
+            [batch_size * num_neighbours, 2],
+            seeds[3],
+            minval=-max_shift,
+            maxval=max_shift,
+        )
+        neighbours = shift_stamps(
+            tf.reshape(galaxies[:, 1:], tf.concat([[-1], tf.shape(pool)[1:]], 0)),
+            shifts,
+        )
+        neighbours = tf.reshape(neighbours, tf.shape(galaxies[:, 1:]))
+        blends = blends + tf.reduce_sum(
+            neighbours * is_present[:, :, None, None, None], axis=1
+        )
+
+    if noise_sigma is not None:
+        variance = tf.square(tf.cast(noise_sigma, tf.float32)) * tf.ones_like(blends)
+        if source_noise:
+            variance = variance + blends / tf.cast(linear_norm_coeff, tf.float32)
+        blends = blends + tf.sqrt(variance) * tf.random.stateless_normal(
+            tf.shape(blends), seeds[4]
+        )
+
+    return blends, isolated
+
+
+def build_blend_dataset(
+    pool,
+    batch_size=100,
+    num_batches=None,
+    max_number=4,
+    max_shift=15,
+    flux_range=(0.5, 2.0),
+    noise_sigma="survey",
+    survey=None,
+    linear_norm_coeff=10000,
+    source_noise=True,
+    channel_last=True,
+    seed=None,
+):
+    """Build a tf.data pipeline of simulated (blends, isolated galaxies) batches.
+
+    The blends are generated in the pipeline, so that the deblender encoder can
+    be trained on an unlimited number of blends without storing them.
+
+    Parameters
+    ----------
+    pool: np.ndarray
+        stamps of isolated noiseless galaxies (not normalized),
+        of shape (pool_size, height, width, num_bands) or (pool_size, num_bands, height, width).
+    batch_size: int
+        number of blends per batch.
+    num_batches: int
+        number of batches in an epoch. If None, the dataset is infinite.
+    max_number: int
+        maximum number of galaxies in a blend.
+    max_shift: float
+        maximum offset of the neighbours (in pixels) along each axis.
+    flux_range: tuple
+        range of the log-uniform factor by which the flux of each galaxy is rescaled.
+    noise_sigma: str or list/array
+        normalized background noise level in each band.
+        "survey" computes it from the sky level of `survey`, and None disables the noise.
+    survey: galcheat.survey object or str
+        galcheat survey object to fetch survey details, or its name. Defaults to LSST.
+    linear_norm_coeff: int/list
+        bandwise linear normalizing/scaling factor.
+    source_noise: bool
+        to add the Poisson noise of the sources on top of the background noise.
+    channel_last: bool
+        if the bands are the last axis of the pool.
+    seed: int
+        seed of the simulations.
+
+    Returns
+    -------
+    dataset: tf.data.Dataset
+        dataset of channel last (blends, isolated) batches.
+
+    """
+    pool = np.asarray(pool, dtype=np.float32)
+    if not channel_last:
+        pool = np.moveaxis(pool, 1, -1)
+    pool = tf.constant(pool / np.asarray(linear_norm_coeff, dtype=np.float32))
+
+    if isinstance(noise_sigma, str) and noise_sigma == "survey":
+        noise_sigma = get_noise_sigma(survey, linear_norm_coeff)
+
+    def simulate(seed):
+        return simulate_blends(
+            pool,
+            batch_size,
+            seed,
+            max_number=max_number,
+            max_shift=max_shift,
+            flux_range=flux_range,
+            noise_sigma=noise_sigma,
+            linear_norm_coeff=linear_norm_coeff,
+            source_noise=source_noise,
+        )
+
+    # each batch gets its own seed, so that batches are generated in parallel reproducibly
+    dataset = tf.data.Dataset.random(seed=seed).batch(2)
+    if num_batches is not None:
+        dataset = dataset.take(num_batches)
+    dataset = dataset.map(simulate, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,322 @@
+"""Train and compare many network configurations in parallel worker processes."""
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import tensorflow as tf
+
+from madness_deblender.deblender import Deblender
+from madness_deblender.losses import deblender_loss_fn_wrapper
+from madness_deblender.pipeline import make_cache_dataset
+from madness_deblender.runtime import init_worker_runtime, make_cpu_queue
+
+LOG = logging.getLogger(__name__)
+
+CACHE_ARRAYS = ["x_train", "y_train", "x_validation", "y_validation"]
+
+
+def write_dataset_cache(
+    cache_dir,
+    x_train,
+    y_train,
+    x_validation,
+    y_validation,
+    linear_norm_coeff=10000,
+    channel_last=True,
+):
+    """Write a preprocessed dataset cache shared by the workers of a sweep.
+
+    The images are normalized, converted to channel last float32
+    and stored as .npy files, which the workers memory map.
+
+    Parameters
+    ----------
+    cache_dir: str
+        folder of the cache.
+    x_train: np.ndarray
+        training inputs (blends).
+    y_train: np.ndarray
+        training targets (isolated galaxies).
+    x_validation: np.ndarray
+        validation inputs.
+    y_validation: np.ndarray
+        validation targets.
+    linear_norm_coeff: int/list
+        bandwise linear normalizing/scaling factor.
+    channel_last: bool
+        if the bands are the last axis of the images.
+
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    linear_norm_coeff = np.asarray(linear_norm_coeff, dtype=np.float32)
+    for name, array in zip(
+        CACHE_ARRAYS, [x_train, y_train, x_validation, y_validation]
+    ):
+        array = np.asarray(array, dtype=np.float32)
+        if not channel_last:
+            array = np.moveaxis(array, 1, -1)
+        np.save(os.path.join(cache_dir, name + ".npy"), array / linear_norm_coeff)
+    with open(os.path.join(cache_dir, "metadata.json"), "w") as f:
+        json.dump({"linear_norm_coeff": np.ravel(linear_norm_coeff).tolist()}, f)
+
+
+def read_dataset_cache(cache_dir):
+    """Memory map the arrays of a dataset cache.
+
+    Parameters
+    ----------
+    cache_dir: str
+        folder of the cache.
+
+    Returns
+    -------
+    cache: dict
+        read-only memory mapped arrays "x_train", "y_train", "x_validation" and "y_validation",
+        and the "metadata" dict.
+
+    """
+    cache = {
+        name: np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r")
+        for name in CACHE_ARRAYS
+    }
+    with open(os.path.join(cache_dir, "metadata.json")) as f:
+        cache["metadata"] = json.load(f)
+    return cache
+
+
+def _init_worker(num_threads, cpu_queue):
+    """Pin the thread budget (and CPUs) of a worker, before the TF runtime is initialized."""
+    init_worker_runtime(num_threads, cpu_queue)
+    tf.get_logger().setLevel("ERROR")
+
+
+def count_parameters(flow_vae_net):
+    """Count the parameters of the encoder, decoder and flow.
+
+    Parameters
+    ----------
+    flow_vae_net: madness_deblender.FlowVAEnet.FlowVAEnet
+        networks.
+
+    Returns
+    -------
+    num_params: dict
+        number of parameters of each network and in total.
+
+    """
+    num_params = {
+        network: int(getattr(flow_vae_net, network).count_params())
+        for network in ["encoder", "decoder", "flow"]
+    }
+    num_params["total"] = sum(num_params.values())
+    return num_params
+
+
+def train_configuration(
+    config,
+    cache_dir,
+    noise_sigma,
+    epochs=10,
+    flow_epochs=0,
+    batch_size=100,
+    learning_rate=1e-4,
+    num_deblend_fields=32,
+    deblend_max_iter=20,
+    seed=0,
+):
+    """Train and evaluate one configuration of the networks.
+
+    The VAE is trained on the cached dataset, then optionally the flow on cached latents.
+    The deblending speed is measured by deblending validation stamps,
+    each with a single galaxy at the center.
+
+    Parameters
+    ----------
+    config: dict
+        arguments of `madness_deblender.deblender.Deblender` describing the architecture
+        (e.g. "latent_dim", "filters_encoder" or "num_nf_layers").
+        The stamp shape is read from the cache.
+    cache_dir: str
+        folder of the dataset cache, see `write_dataset_cache`.
+    noise_sigma: list/array
+        normalized noise level in each band, used in the loss function.
+    epochs: int
+        number of epochs to train the VAE.
+    flow_epochs: int
+        number of epochs to train the flow. If 0, the flow is not trained.
+    batch_size: int
+        number of samples per batch.
+    learning_rate: float
+        learning rate of the Adam optimizer.
+    num_deblend_fields: int
+        number of validation stamps deblended to measure the speed.
+    deblend_max_iter: int
+        number of iterations of the deblender.
+    seed: int
+        seed for the initialization and shuffling.
+
+    Returns
+    -------
+    result: dict
+        "config", "val_loss" (best validation loss of the VAE), "flow_val_loss",
+        "train_time" (s), "deblend_galaxies_per_second" and "num_params".
+
+    """
+    tf.keras.utils.set_random_seed(seed)
+    cache = read_dataset_cache(cache_dir)
+    linear_norm_coeff = np.asarray(cache["metadata"]["linear_norm_coeff"])
+
+    deb = Deblender(
+        stamp_shape=cache["x_train"].shape[1],
+        load_weights=False,
+        **config,
+    )
+    flow_vae_net = deb.flow_vae_net
+
+    t0 = time.perf_counter()
+    hist = flow_vae_net.train_vae(
+        make_cache_dataset(
+            cache["x_train"], cache["y_train"], batch_size=batch_size, seed=seed
+        ),
+        make_cache_dataset(
+            cache["x_validation"],
+            cache["y_validation"],
+            batch_size=batch_size,
+            shuffle=False,
+        ),
+        callbacks=[tf.keras.callbacks.TerminateOnNaN()],
+        loss_function=deblender_loss_fn_wrapper(
+            sigma_cutoff=np.asarray(noise_sigma, dtype=np.float32),
+            linear_norm_coeff=linear_norm_coeff,
+        ),
+        optimizer=tf.keras.optimizers.Adam(learning_rate),
+        epochs=epochs,
+        verbose=0,
+    )
+    flow_val_loss = None
+    if flow_epochs > 0:
+        flow_hist = flow_vae_net.train_flow(
+            (cache["y_train"], cache["y_train"]),
+            (cache["y_validation"], cache["y_validation"]),
+            callbacks=[tf.keras.callbacks.TerminateOnNaN()],
+            optimizer=tf.keras.optimizers.Adam(learning_rate),
+            epochs=flow_epochs,
+            verbose=0,
+            cache_latents=True,
+            batch_size=batch_size,
+        )
+        flow_val_loss = float(np.min(flow_hist.history["val_loss"]))
+    train_time = time.perf_counter() - t0
+
+    # the deblender normalizes the fields itself
+    fields = np.asarray(cache["x_validation"][:num_deblend_fields]) * linear_norm_coeff
+    center = fields.shape[1] // 2
+    deblend_kwargs = {
+        "detected_positions": [[[center, center]]] * len(fields),
+        "num_components": [1] * len(fields),
+        "noise_sigma": noise_sigma,
+        "max_iter": deblend_max_iter,
+        "channel_last": True,
+        "linear_norm_coeff": linear_norm_coeff,
+        "use_log_prob": flow_epochs > 0,
+    }
+    # warm-up to trace the graphs
+    deb(
+        fields[:1],
+        **dict(
+            deblend_kwargs, detected_positions=[[[center, center]]], num_components=[1]
+        ),
+    )
+    t0 = time.perf_counter()
+    deb(fields, **deblend_kwargs)
+    deblend_time = time.perf_counter() - t0
+
+    return {
+        "config": config,
+        "val_loss": float(np.min(hist.history["val_loss"])),
+        "flow_val_loss": flow_val_loss,
+        "train_time": train_time,
+        "deblend_galaxies_per_second": len(fields) / deblend_time,
+        "num_params": count_parameters(flow_vae_net),
+    }
+
+
+def run_sweep(
+    configs,
+    cache_dir,
+    noise_sigma,
+    results_path=None,
+    num_workers=2,
+    threads_per_worker=1,
+    pin_cpus=False,
+    **kwargs,
+):
+    """Train configurations concurrently in worker processes with pinned thread budgets.
+
+    Parameters
+    ----------
+    configs: list
+        list of dicts of architecture arguments, see `train_configuration`.
+    cache_dir: str
+        folder of the dataset cache shared by the workers, see `write_dataset_cache`.
+    noise_sigma: list/array
+        normalized noise level in each band, used in the loss function.
+    results_path: str
+        JSON lines file to which the result of each configuration is appended when it completes.
+    num_workers: int
+        number of worker processes.
+    threads_per_worker: int
+        number of TF/OpenMP threads of each worker.
+    pin_cpus: bool
+        to pin each worker to its own set of `threads_per_worker` CPUs, if enough are available,
+        on a single NUMA node when possible (see `madness_deblender.runtime.partition_cpus`).
+    kwargs: dict
+        arguments of `train_configuration`.
+
+    Returns
+    -------
+    results: list
+        result of each configuration (see `train_configuration`), in the order of `configs`.
+        Failed configurations have an "error" instead of the metrics.
+
+    """
+    context = multiprocessing.get_context("spawn")
+    cpu_queue = (
+        make_cpu_queue(context, num_workers, threads_per_worker) if pin_cpus else None
+    )
+
+    LOG.info(
+        f"Sweeping {len(configs)} configurations with {num_workers} workers "
+        f"of {threads_per_worker} threads"
+    )
+    results = [None] * len(configs)
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(threads_per_worker, cpu_queue),
+    ) as executor:
+        futures = {
+            executor.submit(
+                train_configuration, config, cache_dir, noise_sigma, **kwargs
+            ): i
+            for i, config in enumerate(configs)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                LOG.warning(f"Configuration {configs[i]} failed: {e!r}")
+                results[i] = {"config": configs[i], "error": repr(e)}
+            LOG.info(f"Finished configuration {i}: {results[i]}")
+            if results_path is not None:
+                with open(results_path, "a") as f:
+                    f.write(json.dumps(results[i]) + "\n")
+
+    return results
@@ -0,0 +1,79 @@
+"""Test amortized inference."""
+
+import numpy as np
+import tensorflow_probability as tfp
+
+from madness_deblender.deblender import Deblender
+from madness_deblender.extraction import extract_cutouts
+
+
+def test_amortized_inference():
+    """Test that chunked amortized inference matches the encoder on cutouts."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+
+    data = np.random.rand(2, 6, 15, 15)
+    detected_pos = [[[9, 10], [11, 11], [5, 5]], [[10, 10], [0, 0], [0, 0]]]
+
+    results = deb.debvader(
+        data,
+        detected_pos,
+        num_components=[3, 1],
+        batch_size=2,
+        linear_norm_coeff=2,
+        channel_last=False,
+    )
+
+    cutouts = extract_cutouts(
+        data[0] / 2, detected_pos[0], cutout_size=5, channel_last=False
+    )[0]
+    z_dist = tfp.layers.MultivariateNormalTriL(4)(deb.flow_vae_net.encoder(cutouts))
+
+    np.testing.assert_allclose(results["z_mean"][0], z_dist.mean(), rtol=1e-5)
+    np.testing.assert_allclose(results["z_cov"][0], z_dist.covariance(), rtol=1e-5)
+    np.testing.assert_allclose(
+        results["components"][0],
+        np.moveaxis(deb.flow_vae_net.decoder(z_dist.mean()).numpy() * 2, -1, -3),
+        rtol=1e-5,
+    )
+
+    assert results["components"].shape == (2, 3, 6, 5, 5)
+    np.testing.assert_array_equal(results["z_mean"][1, 1:], 0)
+    np.testing.assert_array_equal(results["components"][1, 1:], 0)
+
+
+def test_amortized_inference_border():
+    """Test that the cutouts of galaxies at the border are padded with zeros."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+
+    data = np.random.rand(1, 10, 10, 6)
+    results = deb.debvader(
+        data, [[[1, 1], [9, 5]]], num_components=[2], channel_last=True
+    )
+
+    cutouts = np.zeros((2, 5, 5, 6))
+    cutouts[0, 1:, 1:] = data[0, :4, :4]
+    cutouts[1, :3] = data[0, 7:, 3:8]
+    z_dist = tfp.layers.MultivariateNormalTriL(4)(
+        deb.flow_vae_net.encoder(cutouts / 10000)
+    )
+    np.testing.assert_allclose(results["z_mean"][0], z_dist.mean(), rtol=1e-5)
@@ -0,0 +1,87 @@
+"""Test blend groups."""
+
+import numpy as np
+
+from madness_deblender.blend_groups import (
+    compute_blend_groups,
+    merge_blend_groups,
+    split_into_blend_groups,
+)
+from madness_deblender.deblender import Deblender
+
+
+def test_blend_groups():
+    """Test the decomposition of fields into blend groups."""
+    detected_pos = np.array(
+        [
+            [[10, 10], [13, 12], [30, 30], [0, 0]],
+            [[10, 10], [30, 10], [20, 10], [33, 33]],
+        ]
+    )
+    num_components = [3, 4]
+
+    group_labels = compute_blend_groups(detected_pos, num_components, cutout_size=5)
+    np.testing.assert_array_equal(group_labels, [[0, 0, 1, -1], [0, 1, 2, 3]])
+
+    # galaxies at 10 and 30 are only connected through the galaxy at 20
+    group_labels = compute_blend_groups(detected_pos, num_components, cutout_size=11)
+    np.testing.assert_array_equal(group_labels, [[0, 0, 1, -1], [0, 0, 0, 1]])
+
+    fields = np.random.rand(2, 40, 40, 3)
+    (
+        group_fields,
+        group_positions,
+        group_num_components,
+        group_index,
+    ) = split_into_blend_groups(fields, detected_pos, num_components, cutout_size=5)
+
+    np.testing.assert_array_equal(group_num_components, [2, 1, 1, 1, 1, 1])
+    assert group_fields.shape == (6, 8, 8, 3)
+    np.testing.assert_array_equal(group_positions[0], [[2, 2], [5, 4]])
+    np.testing.assert_allclose(group_fields[0, :8, :7], fields[0, 8:16, 8:15])
+    np.testing.assert_array_equal(group_fields[0, :, 7], 0)
+
+    merged = merge_blend_groups(group_positions, group_index, 2, 4)
+    np.testing.assert_array_equal(merged[0, 1], [5, 4])
+    np.testing.assert_array_equal(merged[1, 3], [2, 2])
+    np.testing.assert_array_equal(merged[0, 3], [0, 0])
+
+
+def test_deblending_blend_groups():
+    """Test deblending with blend groups."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+
+    data = np.random.rand(2, 25, 25, 6)
+    detected_pos = [[[5, 5], [7, 6], [18, 18]], [[10, 10], [0, 0], [0, 0]]]
+
+    deb(
+        blended_fields=data.copy(),
+        detected_positions=detected_pos,
+        num_components=[3, 1],
+        linear_norm_coeff=1,
+        max_iter=2,
+        channel_last=True,
+        use_blend_groups=True,
+    )
+
+    assert deb.components.shape == (2, 3, 5, 5, 6)
+    assert deb.z.shape == (2, 3, 4)
+    assert deb.blended_fields.shape == (2, 25, 25, 6)
+    np.testing.assert_array_equal(deb.components[1, 1:], 0)
+
+    # the components are decoded from the merged latent space representations
+    np.testing.assert_allclose(
+        deb.components[0, :3],
+        deb.flow_vae_net.decoder(deb.z[0, :3]).numpy(),
+        rtol=1e-5,
+    )
@@ -0,0 +1,153 @@
+"""Test the command-line batch driver."""
+
+import json
+import os
+
+import h5py
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from madness_deblender import runtime
+from madness_deblender.cli import (
+    deblend_files,
+    group_catalog,
+    read_catalog,
+    read_fields,
+    read_manifest,
+)
+from madness_deblender.writer import read_results
+
+
+def test_deblend_files(tmp_path, monkeypatch):
+    """Test deblending files in chunks and resuming an interrupted run."""
+    rng = np.random.default_rng(0)
+    fields = rng.random((6, 15, 15, 6)).astype(np.float32)
+    fields_path = os.path.join(tmp_path, "fields.npy")
+    np.save(fields_path, fields)
+
+    # the same fields in FITS and HDF5 files
+    fits.PrimaryHDU(fields).writeto(os.path.join(tmp_path, "fields.fits"))
+    with h5py.File(os.path.join(tmp_path, "fields.h5"), "w") as f:
+        f["fields"] = fields
+    for path in ["fields.fits", "fields.h5"]:
+        np.testing.assert_array_equal(
+            (
+                read_fields(os.path.join(tmp_path, path), np.array([1, 4]), key=0)
+                if path.endswith(".fits")
+                else read_fields(os.path.join(tmp_path, path), np.array([1, 4]))
+            ),
+            fields[[1, 4]],
+        )
+
+    # field 5 has no detection
+    catalog_path = os.path.join(tmp_path, "catalog.npz")
+    np.savez(
+        catalog_path,
+        field_id=np.array([3, 0, 1, 0, 2, 4, 3]),
+        row=np.array([7, 9, 10, 11, 6, 8, 5]),
+        col=np.array([7, 10, 10, 11, 6, 8, 9]),
+    )
+
+    output_dir = os.path.join(tmp_path, "results")
+    kwargs = {
+        "batch_size": 2,
+        "deblender_kwargs": {
+            "stamp_shape": 5,
+            "latent_dim": 4,
+            "filters_encoder": [1, 1, 1, 1],
+            "filters_decoder": [1, 1, 1],
+            "kernels_encoder": [1, 1, 1, 1],
+            "kernels_decoder": [1, 1, 1],
+            "dense_layer_units": 1,
+            "num_nf_layers": 1,
+            "load_weights": False,
+        },
+        "deblend_kwargs": {
+            "noise_sigma": [0.1] * 6,
+            "max_iter": 2,
+            "linear_norm_coeff": 1,
+            "channel_last": True,
+        },
+    }
+    manifest = deblend_files(fields_path, catalog_path, output_dir, **kwargs)
+    assert sorted(manifest) == [0, 1, 2]
+
+    results = [
+        read_results(os.path.join(output_dir, manifest[chunk]["path"]))
+        for chunk in sorted(manifest)
+    ]
+    field_id = np.concatenate([r["field_id"] for r in results])
+    position = np.concatenate([r["position"] for r in results])
+    np.testing.assert_array_equal(field_id, [0, 0, 1, 2, 3, 3, 4])
+    np.testing.assert_array_equal(
+        position, [[9, 10], [11, 11], [10, 10], [6, 6], [7, 7], [5, 9], [8, 8]]
+    )
+    assert results[0]["components"].shape == (3, 5, 5, 6)
+
+    # a completed run is not deblended again
+    mtime = os.path.getmtime(os.path.join(output_dir, "chunk_000000.h5"))
+    assert deblend_files(fields_path, catalog_path, output_dir, **kwargs) == manifest
+    assert os.path.getmtime(os.path.join(output_dir, "chunk_000000.h5")) == mtime
+
+    # an interrupted run only deblends the missing chunk
+    manifest_path = os.path.join(output_dir, "manifest.jsonl")
+    with open(manifest_path) as f:
+        lines = f.readlines()
+    with open(manifest_path, "w") as f:
+        f.writelines(
+            [line for line in lines if json.loads(line)["chunk"] != 1]
+            + ['{"chunk": 3, "pa']
+        )
+    assert sorted(read_manifest(output_dir)) == [0, 2]
+    # the thread budget and pinning also apply to a single process
+    cpus = sorted(os.sched_getaffinity(0))
+    parallel_iterations = runtime.get_parallel_iterations()
+    for name in ["OMP_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]:
+        monkeypatch.delenv(name, raising=False)
+    try:
+        deblend_files(
+            fields_path,
+            catalog_path,
+            output_dir,
+            threads_per_worker=1,
+            pin_cpus=True,
+            **kwargs,
+        )
+        assert runtime.get_parallel_iterations() == 1
+        assert len(os.sched_getaffinity(0)) == 1
+    finally:
+        os.sched_setaffinity(0, cpus)
+        runtime._PARALLEL_ITERATIONS = parallel_iterations
+    assert sorted(read_manifest(output_dir)) == [0, 1, 2]
+    assert os.path.getmtime(os.path.join(output_dir, "chunk_000000.h5")) == mtime
+
+    with pytest.raises(ValueError):
+        deblend_files(
+            fields_path, catalog_path, output_dir, **dict(kwargs, batch_size=3)
+        )
+
+
+def test_read_catalog(tmp_path):
+    """Test reading NumPy catalogs and grouping sub-pixel detections."""
+    array = np.array([[1, 7.4, 7.6], [0, 9, 10], [1, 10.5, 3]])
+    structured = np.zeros(3, dtype=[("field_id", int), ("row", float), ("col", float)])
+    for i, column in enumerate(["field_id", "row", "col"]):
+        structured[column] = array[:, i]
+    for name, catalog in [("plain.npy", array), ("structured.npy", structured)]:
+        np.save(os.path.join(tmp_path, name), catalog)
+        detected_positions, num_components = group_catalog(
+            read_catalog(os.path.join(tmp_path, name)), 3
+        )
+        np.testing.assert_array_equal(num_components, [1, 2, 0])
+        np.testing.assert_array_equal(
+            detected_positions,
+            [[[9, 10], [0, 0]], [[7.4, 7.6], [10.5, 3]], [[0, 0], [0, 0]]],
+        )
+
+    with pytest.raises(ValueError, match="out of range"):
+        group_catalog(read_catalog(os.path.join(tmp_path, "plain.npy")), 1)
+
+    np.save(os.path.join(tmp_path, "bad.npy"), array[:, :2])
+    with pytest.raises(ValueError, match="structured array"):
+        read_catalog(os.path.join(tmp_path, "bad.npy"))
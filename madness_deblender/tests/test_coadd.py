@@ -0,0 +1,74 @@
+"""Test cutting fields from memory-mapped FITS images."""
+
+import mmap
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from madness_deblender.coadd import CoaddReader
+
+
+def test_coadd_reader(tmp_path):
+    """Test cutting fields, including at the edges, and prefetching batches."""
+    rng = np.random.default_rng(0)
+    images = rng.random((3, 40, 50)).astype(">f4")
+    paths = []
+    for band, image in enumerate(images):
+        paths.append(os.path.join(tmp_path, f"band_{band}.fits"))
+        fits.PrimaryHDU(image).writeto(paths[-1])
+
+    # reference cut from the images padded with zeros
+    padded = np.pad(np.moveaxis(images, 0, -1), ((15, 15), (15, 15), (0, 0)))
+
+    def reference(row, col):
+        return padded[row + 15 : row + 30, col + 15 : col + 30]
+
+    with CoaddReader(paths, field_size=15) as reader:
+        assert reader.shape == (40, 50)
+        # the images are backed by the memory mapped files
+        base = reader.images[0]
+        while isinstance(base, np.ndarray):
+            base = base.base
+        assert isinstance(base, mmap.mmap)
+
+        origins = [[0, 0], [30, 40], [-5, 10], [39, -14], [100, 100]]
+        fields = reader.cut(origins)
+        assert fields.shape == (5, 15, 15, 3) and fields.dtype == np.float32
+        for field, (row, col) in zip(fields, origins[:4]):
+            np.testing.assert_array_equal(field, reference(row, col))
+        assert np.all(fields[4] == 0)
+
+        origins = reader.grid(overlap=5)
+        # fields every 10 pixels covering the images
+        assert len(origins) == 4 * 5
+        batches = [
+            (batch_origins.copy(), batch.copy())
+            for batch_origins, batch in reader.iter_batches(
+                origins, batch_size=3, prefetch=2
+            )
+        ]
+        np.testing.assert_array_equal(np.concatenate([b[0] for b in batches]), origins)
+        for batch_origins, batch in batches:
+            for field, (row, col) in zip(batch, batch_origins):
+                np.testing.assert_array_equal(field, reference(row, col))
+
+
+def test_scaled_images(tmp_path):
+    """Test that the BSCALE/BZERO scaling and BLANK values of integer images are applied."""
+    raw = np.arange(40 * 50, dtype=np.int16).reshape(40, 50)
+    raw[3, 4] = -32768
+    hdu = fits.PrimaryHDU(raw)
+    hdu.header["BSCALE"] = 0.5
+    hdu.header["BZERO"] = 10.0
+    hdu.header["BLANK"] = -32768
+    path = os.path.join(tmp_path, "scaled.fits")
+    hdu.writeto(path)
+
+    with CoaddReader([path], field_size=15) as reader:
+        assert reader.images[0].dtype.kind == "i"
+        fields = reader.cut([[0, 0], [30, 40]])
+    expected = fits.getdata(path)
+    np.testing.assert_array_equal(fields[0, ..., 0], expected[:15, :15])
+    np.testing.assert_array_equal(fields[1, :10, :10, 0], expected[30:, 40:])
+    assert np.isnan(fields[0, 3, 4, 0])
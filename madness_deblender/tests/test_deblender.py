@@ -1,8 +1,19 @@
 """Test Deblending."""
 
 import numpy as np
+import pytest
+import tensorflow as tf
+import tensorflow_probability as tfp
 
-from madness_deblender.deblender import Deblender, compute_residual
+from madness_deblender.amortized import amortized_inference
+from madness_deblender.deblender import (
+    EIGEN_ALIGNMENT,
+    Deblender,
+    compute_residual,
+    fields_to_tensor,
+    normalize_fields,
+    solve_amplitudes,
+)
 
 
 def test_deblending():
@@ -66,6 +77,72 @@ def test_deblending():
     np.testing.assert_array_equal(residual1, residual2)
 
 
+def test_convergence_criterion():
+    """Test that the optimization stops at the same step as with tfp.math.minimize."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+    data = np.random.default_rng(0).random((2, 15, 15, 6))
+    deb(
+        data,
+        [[[9, 10], [11, 11]], [[10, 10], [0, 0]]],
+        num_components=[2, 1],
+        noise_sigma=[0.1] * 6,
+        linear_norm_coeff=1,
+        max_iter=2,
+        channel_last=True,
+    )
+    deb.max_iter = 200
+
+    def convergence_criterion():
+        return tfp.optimizer.convergence_criteria.LossNotDecreasing(
+            rtol=1e-3, window_size=5, min_num_steps=10
+        )
+
+    losses = deb.gradient_decent(
+        convergence_criterion=convergence_criterion(),
+        optimizer=tf.keras.optimizers.Adam(learning_rate=0.05),
+    )
+
+    # baseline: tfp.math.minimize from the same starting point
+    z = tf.Variable(
+        tf.reshape(
+            amortized_inference(
+                deb.flow_vae_net,
+                deb.blended_fields,
+                deb.detected_positions,
+                deb.num_components.numpy(),
+                linear_norm_coeff=1,
+                channel_last=True,
+                decode=False,
+            )["z_mean"],
+            [-1, deb.latent_dim],
+        )
+    )
+    sig_sq = deb.compute_sig_sq()
+    index_pos_to_sub = tf.convert_to_tensor(deb.get_index_pos_to_sub(), tf.int32)
+    baseline_losses = tfp.math.minimize(
+        lambda: deb.compute_loss(z, sig_sq, index_pos_to_sub)[0],
+        num_steps=deb.max_iter,
+        optimizer=tf.keras.optimizers.Adam(learning_rate=0.05),
+        convergence_criterion=convergence_criterion(),
+        trainable_variables=[z],
+        return_full_length_trace=False,
+    )
+
+    assert 10 < len(losses) < deb.max_iter
+    assert len(losses) == len(baseline_losses)
+    np.testing.assert_allclose(losses, baseline_losses, rtol=1e-4)
+
+
 def test_scatter_and_sub():
     """Test scatter and sub."""
     deb = Deblender(
@@ -112,3 +189,190 @@ def test_scatter_and_sub():
     ).numpy()
 
     np.testing.assert_array_equal(residual1, residual2)
+
+
+def test_fit_amplitudes():
+    """Test solving the amplitudes of the components by weighted least squares."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+    rng = np.random.default_rng(0)
+    data = rng.random((2, 15, 15, 6))
+    detected_pos = [[[6, 7], [8, 8]], [[10, 10], [0, 0]]]
+    deb(
+        data,
+        detected_pos,
+        num_components=[2, 1],
+        noise_sigma=[0.1] * 6,
+        linear_norm_coeff=1,
+        max_iter=2,
+        channel_last=True,
+        fit_amplitudes=True,
+    )
+    assert deb.amplitudes.shape == (2, 2, 6)
+    assert np.all(deb.amplitudes[1, 1] == 0)
+    np.testing.assert_allclose(
+        deb.lazy_components.to_array(), deb.get_components(), rtol=1e-5
+    )
+
+    # overlapping reconstructions with known amplitudes are recovered exactly
+    reconstructions = rng.random((2, 2, 5, 5, 6)).astype(np.float32)
+    true_amplitudes = rng.uniform(0.5, 2, size=(2, 2, 6)).astype(np.float32)
+    true_amplitudes[1, 1] = 0
+    index_pos_to_sub = deb.get_index_pos_to_sub()
+    fields = np.zeros((2, 15, 15, 6), dtype=np.float32)
+    for i in range(2):
+        fields[i] = compute_residual(
+            fields[i],
+            -reconstructions[i] * true_amplitudes[i, :, None, None, :],
+            index_pos_to_sub=index_pos_to_sub[i],
+            num_components=[2, 1][i],
+        ).numpy()
+    amplitudes = solve_amplitudes(
+        fields,
+        reconstructions,
+        index_pos_to_sub,
+        np.array([2, 1]),
+        np.full((2, 15, 15, 6), 0.01, dtype=np.float32),
+    )
+    np.testing.assert_allclose(amplitudes, true_amplitudes, rtol=1e-4, atol=1e-6)
+
+    # the amplitudes are non-negative
+    amplitudes = solve_amplitudes(
+        -fields,
+        reconstructions,
+        index_pos_to_sub,
+        np.array([2, 1]),
+        np.full((2, 15, 15, 6), 0.01, dtype=np.float32),
+    )
+    np.testing.assert_array_equal(amplitudes, 0)
+
+
+def test_metrics():
+    """Test the batched metrics and residual fields against a per-field computation."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+    rng = np.random.default_rng(0)
+    data = rng.random((2, 6, 15, 15))
+    detected_pos = [[[6, 7], [8, 8]], [[10, 10], [0, 0]]]
+    deb(
+        data,
+        detected_pos,
+        num_components=[2, 1],
+        noise_sigma=[0.1] * 6,
+        linear_norm_coeff=2,
+        max_iter=2,
+        channel_last=False,
+        return_residuals=True,
+    )
+    metrics = deb.metrics
+    components = np.moveaxis(deb.get_components(), -3, -1)
+
+    index_pos_to_sub = deb.get_index_pos_to_sub()
+    for i in range(2):
+        residual = compute_residual(
+            np.moveaxis(data[i], 0, -1),
+            components[i],
+            index_pos_to_sub=index_pos_to_sub[i],
+            num_components=[2, 1][i],
+        ).numpy()
+        np.testing.assert_allclose(
+            deb.residual_fields[i], np.moveaxis(residual, -1, 0), rtol=1e-5, atol=1e-5
+        )
+
+    np.testing.assert_allclose(
+        metrics["flux"], components.sum(axis=(2, 3)), rtol=1e-5, atol=1e-6
+    )
+    for name in ["chi2", "blendedness", "overlap_fraction", "log_prob"]:
+        assert metrics[name].shape == (2, 2)
+        assert metrics[name][1, 1] == 0
+    # the isolated galaxy is not blended
+    assert metrics["blendedness"][1, 0] == pytest.approx(0, abs=1e-6)
+    assert metrics["overlap_fraction"][1, 0] == 0
+    assert np.all(metrics["blendedness"][0] >= 0)
+    np.testing.assert_allclose(
+        metrics["log_prob"][0],
+        deb.flow_vae_net.flow(deb.z[0]).numpy(),
+        rtol=1e-5,
+    )
+
+
+def test_field_ingestion():
+    """Test that aligned float32 buffers are shared and normalized in the graph."""
+    rng = np.random.default_rng(0)
+    data = rng.random((2, 15, 15, 6)).astype(np.float32)
+
+    # aligned float32 channel last buffer
+    size = data.size + EIGEN_ALIGNMENT // data.itemsize
+    buffer = np.empty(size, dtype=np.float32)
+    offset = (-buffer.ctypes.data % EIGEN_ALIGNMENT) // data.itemsize
+    fields = buffer[offset : offset + data.size].reshape(data.shape)
+    fields[:] = data
+    shared = fields_to_tensor(fields)
+    fields[0, 0, 0, 0] = -1
+    assert shared[0, 0, 0, 0].numpy() == -1
+    fields[0, 0, 0, 0] = data[0, 0, 0, 0]
+
+    # read-only and float64 arrays are copied
+    read_only = fields.copy()
+    read_only.flags.writeable = False
+    assert fields_to_tensor(read_only).dtype == tf.float32
+    assert fields_to_tensor(data.astype(np.float64)).dtype == tf.float64
+
+    linear_norm_coeff = np.arange(1, 7, dtype=np.float32)
+    np.testing.assert_allclose(
+        normalize_fields(
+            fields_to_tensor(np.moveaxis(data, -1, 1).astype(np.float64)),
+            tf.constant(linear_norm_coeff),
+            channel_last=False,
+        ).numpy(),
+        data / linear_norm_coeff,
+        rtol=1e-6,
+    )
+
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+    deblend_kwargs = {
+        "detected_positions": [[[6, 7], [8, 8]], [[10, 10], [0, 0]]],
+        "num_components": [2, 1],
+        "noise_sigma": [0.1] * 6,
+        "linear_norm_coeff": 2,
+        "max_iter": 2,
+        "channel_last": True,
+    }
+    components = []
+    for blended_fields in [fields, tf.constant(data), data.astype(np.float64)]:
+        deb(blended_fields, **deblend_kwargs)
+        assert deb.field_size == 15
+        components.append(deb.get_components())
+    # the loss is traced once for the three calls
+    (loss_and_gradient,) = deb._loss_functions.values()
+    assert loss_and_gradient.experimental_get_tracing_count() == 1
+    np.testing.assert_allclose(components[1], components[0], rtol=1e-5)
+    np.testing.assert_allclose(components[2], components[0], rtol=1e-5)
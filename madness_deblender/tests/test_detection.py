@@ -0,0 +1,69 @@
+"""Test the source detection stage."""
+
+import numpy as np
+
+from madness_deblender.deblender import Deblender
+from madness_deblender.detection import detect_sources
+
+
+def test_detect_sources():
+    """Test detecting galaxies in a batch of fields and deblending them."""
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[:45, :45]
+    # the third galaxy of the first field is at the border
+    true_positions = [[[10, 12], [30, 33], [0, 40]], [[22, 22]], []]
+    fields = rng.normal(0, 0.01, size=(3, 45, 45, 6)).astype(np.float32)
+    for field, positions in zip(fields, true_positions):
+        for (row, col), flux in zip(positions, [2, 1, 1.5]):
+            profile = np.exp(-((rows - row) ** 2 + (cols - col) ** 2) / 8)
+            field += flux * profile[..., None]
+
+    detected_positions, num_components = detect_sources(
+        np.moveaxis(fields, -1, -3),
+        num_threads=2,
+        noise_sigma=[0.01] * 6,
+        stamp_shape=5,
+    )
+    np.testing.assert_array_equal(num_components, [2, 1, 0])
+    assert detected_positions.shape == (3, 2, 2)
+    # sorted from the brightest galaxy, padded with zeros
+    np.testing.assert_array_equal(
+        detected_positions, [[[10, 12], [30, 33]], [[22, 22], [0, 0]], [[0, 0], [0, 0]]]
+    )
+
+    detected_positions, num_components = detect_sources(
+        fields, channel_last=True, max_number=1, bands=[0, 1], stamp_shape=5
+    )
+    np.testing.assert_array_equal(num_components, [1, 1, 0])
+    np.testing.assert_array_equal(detected_positions[:2, 0], [[10, 12], [22, 22]])
+
+    # the stamps of the default shape only fit around the center of the fields
+    np.testing.assert_array_equal(
+        detect_sources(fields, channel_last=True)[1], [0, 1, 0]
+    )
+    np.testing.assert_array_equal(
+        detect_sources(fields, channel_last=True, edge_margin=11)[0][:, 0],
+        [[30, 33], [22, 22], [0, 0]],
+    )
+
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+    deb(
+        fields[:2],
+        detected_positions[:2],
+        num_components=num_components[:2],
+        noise_sigma=[0.01] * 6,
+        linear_norm_coeff=1,
+        max_iter=2,
+        channel_last=True,
+    )
+    assert deb.get_components().shape == (2, 1, 5, 5, 6)
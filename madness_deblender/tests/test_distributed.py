@@ -0,0 +1,93 @@
+"""Test multi-worker training."""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+
+from madness_deblender.distributed import find_free_ports, make_tf_config
+
+WORKER_SCRIPT = textwrap.dedent(
+    """
+    import sys
+
+    import numpy as np
+    import tensorflow as tf
+
+    from madness_deblender.callbacks import define_callbacks
+    from madness_deblender.FlowVAEnet import FlowVAEnet
+    from madness_deblender.losses import deblender_loss_fn_wrapper
+
+    output_path = sys.argv[1]
+
+    f_net = FlowVAEnet(
+        stamp_shape=11,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        strategy="multi_worker",
+    )
+
+    data = np.random.default_rng(0).random((16, 11, 11, 6), dtype=np.float32)
+    dataset = tf.data.Dataset.from_tensor_slices((data, data)).batch(4)
+
+    with f_net.strategy.scope():
+        callbacks = define_callbacks(
+            output_path, patience=1, backup_path=output_path + "_backup"
+        )
+
+    f_net.train_vae(
+        dataset,
+        dataset,
+        callbacks=callbacks,
+        epochs=2,
+        loss_function=deblender_loss_fn_wrapper(
+            sigma_cutoff=np.array([1] * 6), linear_norm_coeff=1
+        ),
+        verbose=0,
+    )
+    np.save(
+        output_path + f"_{f_net.strategy.cluster_resolver.task_id}.npy",
+        np.concatenate([w.ravel() for w in f_net.vae_model.get_weights()]),
+    )
+    """
+)
+
+
+def test_multi_worker_training(tmp_path):
+    """Test data-parallel training with two local worker processes."""
+    script = os.path.join(tmp_path, "worker.py")
+    with open(script, "w") as f:
+        f.write(WORKER_SCRIPT)
+    output_path = os.path.join(tmp_path, "weights")
+
+    num_workers = 2
+    ports = find_free_ports(num_workers)
+    # make the package importable by the workers
+    repo_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [repo_path, os.environ.get("PYTHONPATH")])
+    )
+    workers = [
+        subprocess.Popen(
+            [sys.executable, script, output_path],
+            env=dict(env, TF_CONFIG=make_tf_config(i, ports)),
+        )
+        for i in range(num_workers)
+    ]
+    assert [worker.wait(timeout=600) for worker in workers] == [0] * num_workers
+
+    # the replicas are kept in sync
+    weights = [np.load(output_path + f"_{i}.npy") for i in range(num_workers)]
+    np.testing.assert_array_equal(weights[0], weights[1])
+
+    # only the chief writes the checkpoints
+    assert os.path.exists(os.path.join(output_path, "val_loss", "checkpoint"))
+    assert not any("workertemp" in name for name in os.listdir(tmp_path))
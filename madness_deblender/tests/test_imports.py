@@ -0,0 +1,32 @@
+"""Test that the lightweight modules do not import the heavy frameworks."""
+
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "madness_deblender",
+        "madness_deblender.extraction",
+        "madness_deblender.blend_groups",
+        "madness_deblender.results",
+        "madness_deblender.runtime",
+        "madness_deblender.cli",
+        "madness_deblender.service",
+    ],
+)
+def test_lazy_imports(module):
+    """Test importing a module in a fresh interpreter."""
+    script = (
+        f"import sys, logging; import {module}; "
+        "print(sorted({'tensorflow', 'tensorflow_probability', 'galcheat'} "
+        "& set(sys.modules)), logging.getLogger().handlers)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    ).stdout
+    # no heavy framework and no logging configuration
+    assert output.strip() == "[] []"
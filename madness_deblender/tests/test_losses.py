@@ -0,0 +1,128 @@
+"""Test the fused and XLA compiled losses."""
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from madness_deblender.callbacks import changeAlpha
+from madness_deblender.FlowVAEnet import FlowVAEnet
+from madness_deblender.losses import (
+    deblender_encoder_cached_loss_wrapper,
+    deblender_loss_fn_wrapper,
+    flow_loss_fn,
+    sample_latent,
+    ssim,
+    vae_loss_fn_mse,
+)
+
+tfd = tfp.distributions
+
+
+def test_xla_losses():
+    """Test that the fused and XLA compiled losses match the reference implementations."""
+    tf.random.set_seed(0)
+    y = tf.random.uniform((4, 11, 11, 6))
+    predicted_galaxy = y + 0.1 * tf.random.normal((4, 11, 11, 6))
+
+    ch_alpha = changeAlpha(max_epochs=2)
+    for use_ssim in [False, True]:
+        kwargs = {
+            "sigma_cutoff": np.array([1e-2] * 6),
+            "use_ssim": use_ssim,
+            "ch_alpha": ch_alpha,
+            "linear_norm_coeff": 1,
+        }
+        np.testing.assert_allclose(
+            deblender_loss_fn_wrapper(jit_compile=True, **kwargs)(y, predicted_galaxy),
+            deblender_loss_fn_wrapper(jit_compile=False, **kwargs)(y, predicted_galaxy),
+            rtol=1e-5,
+        )
+
+    log_prob = tf.random.normal((16,))
+    np.testing.assert_allclose(
+        flow_loss_fn(None, log_prob),
+        flow_loss_fn.python_function(None, log_prob),
+        atol=1e-6,
+    )
+
+    # a deterministic distribution makes the sample match
+    distribution = tfd.Deterministic(predicted_galaxy)
+    np.testing.assert_allclose(
+        tf.function(vae_loss_fn_mse.python_function, jit_compile=True)(y, distribution),
+        vae_loss_fn_mse(y, distribution),
+        rtol=1e-5,
+    )
+
+    np.testing.assert_allclose(
+        ssim(y, predicted_galaxy),
+        tf.image.ssim(y, predicted_galaxy, max_val=1),
+        atol=2e-6,
+    )
+
+    params = 0.5 * tf.random.normal((5, 14))
+    distribution = tfp.layers.MultivariateNormalTriL.new(params, 4)
+    z = sample_latent(tf.tile(params[None], [20000, 1, 1]), 4)
+    np.testing.assert_allclose(
+        tf.reduce_mean(z, axis=0), distribution.mean(), atol=0.05
+    )
+    # within 5 standard errors of the sample covariance
+    covariance = distribution.covariance().numpy()
+    variance = np.diagonal(covariance, axis1=-2, axis2=-1)
+    standard_error = np.sqrt(
+        (variance[:, :, None] * variance[:, None, :] + covariance**2) / len(z)
+    )
+    assert np.all(np.abs(tfp.stats.covariance(z) - covariance) < 5 * standard_error)
+
+
+def test_xla_training():
+    """Test XLA compiled training steps."""
+    f_net = FlowVAEnet(
+        stamp_shape=11,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+    )
+    data = np.random.rand(8, 11, 11, 6)
+
+    ch_alpha = changeAlpha(max_epochs=1)
+    hist = f_net.train_vae(
+        (data, data),
+        (data, data),
+        callbacks=[ch_alpha],
+        epochs=1,
+        loss_function=deblender_loss_fn_wrapper(
+            sigma_cutoff=np.array([1] * 6),
+            use_ssim=True,
+            ch_alpha=ch_alpha,
+            linear_norm_coeff=1,
+            jit_compile=True,
+        ),
+        verbose=0,
+    )
+    assert np.isfinite(hist.history["val_loss"][-1])
+
+    hist = f_net.train_encoder(
+        (data, f_net.encoder(data).numpy()),
+        None,
+        callbacks=[],
+        epochs=1,
+        loss_function=deblender_encoder_cached_loss_wrapper(latent_dim=4),
+        verbose=0,
+        jit_compile=True,
+    )
+    assert np.isfinite(hist.history["loss"][-1])
+
+    hist = f_net.train_flow(
+        (data, data),
+        (data, data),
+        callbacks=[],
+        epochs=1,
+        verbose=0,
+        jit_compile=True,
+        cache_latents=True,
+    )
+    assert np.isfinite(hist.history["val_loss"][-1])
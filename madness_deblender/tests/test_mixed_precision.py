@@ -0,0 +1,68 @@
+"""Test mixed precision training."""
+
+import numpy as np
+import tensorflow as tf
+
+from madness_deblender.FlowVAEnet import FlowVAEnet
+from madness_deblender.losses import deblender_loss_fn_wrapper
+
+
+def test_mixed_precision():
+    """Test that mixed precision validation losses match the float32 baseline."""
+    data = np.random.rand(8, 11, 11, 6).astype(np.float32)
+
+    losses = {}
+    weights = None
+    for dtype_policy in ["float32", "mixed_bfloat16", "mixed_float16"]:
+        f_net = FlowVAEnet(
+            stamp_shape=11,
+            latent_dim=4,
+            filters_encoder=[2, 2, 2, 2],
+            filters_decoder=[2, 2, 2],
+            kernels_encoder=[3, 3, 3, 3],
+            kernels_decoder=[3, 3, 3],
+            dense_layer_units=4,
+            num_nf_layers=1,
+            dtype_policy=dtype_policy,
+        )
+        if weights is None:
+            weights = (f_net.vae_model.get_weights(), f_net.flow.get_weights())
+        f_net.vae_model.set_weights(weights[0])
+        f_net.flow.set_weights(weights[1])
+
+        assert f_net.decoder.output.dtype == tf.float32
+        assert f_net.encoder.output.dtype == tf.float32
+        assert f_net.flow.output.dtype == tf.float32
+
+        tf.random.set_seed(0)
+        vae_hist = f_net.train_vae(
+            (data, data),
+            (data, data),
+            callbacks=[],
+            epochs=1,
+            optimizer=tf.keras.optimizers.Adam(0.0),
+            loss_function=deblender_loss_fn_wrapper(
+                sigma_cutoff=np.array([1] * 6), linear_norm_coeff=1
+            ),
+            verbose=0,
+        )
+        flow_hist = f_net.train_flow(
+            (data, data),
+            (data, data),
+            callbacks=[],
+            epochs=1,
+            optimizer=tf.keras.optimizers.Adam(0.0),
+            verbose=0,
+        )
+        losses[dtype_policy] = (
+            vae_hist.history["val_loss"][-1],
+            flow_hist.history["val_loss"][-1],
+        )
+
+        if dtype_policy == "mixed_float16":
+            assert isinstance(
+                f_net.vae_model.optimizer, tf.keras.mixed_precision.LossScaleOptimizer
+            )
+
+    for dtype_policy in ["mixed_bfloat16", "mixed_float16"]:
+        np.testing.assert_allclose(losses[dtype_policy], losses["float32"], rtol=1e-2)
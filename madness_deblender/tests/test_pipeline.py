@@ -0,0 +1,188 @@
+"""Test tf.data training pipeline."""
+
+import gc
+import glob
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from madness_deblender.FlowVAEnet import FlowVAEnet
+from madness_deblender.losses import (
+    deblender_encoder_cached_loss_wrapper,
+    deblender_encoder_loss_wrapper,
+    deblender_loss_fn_wrapper,
+)
+from madness_deblender.pipeline import (
+    build_teacher_dataset,
+    build_training_dataset,
+    measure_input_stall,
+)
+
+
+def test_training_dataset(tmp_path):
+    """Test the sharded pipeline and training the networks on it."""
+    blended = np.random.rand(12, 6, 11, 11)
+    isolated = np.random.rand(12, 6, 11, 11)
+
+    shards = []
+    for i in range(3):
+        shards.append(os.path.join(tmp_path, f"shard_{i}.npz"))
+        np.savez(
+            shards[-1],
+            blended_gal_stamps=blended[4 * i : 4 * (i + 1)],
+            isolated_gal_stamps=isolated[4 * i : 4 * (i + 1)],
+        )
+
+    dataset = build_training_dataset(
+        shards,
+        batch_size=5,
+        linear_norm_coeff=2,
+        channel_last=False,
+        shuffle_buffer=0,
+        num_parallel_files=1,
+    )
+    batches = list(dataset.as_numpy_iterator())
+    assert [len(x) for x, _ in batches] == [5, 5, 2]
+    x = np.concatenate([x for x, _ in batches])
+    np.testing.assert_allclose(
+        np.sort(x.ravel()),
+        np.sort(np.moveaxis(blended, 1, -1).ravel() / 2),
+        rtol=1e-6,
+    )
+
+    noisy_dataset = build_training_dataset(
+        (np.moveaxis(blended, 1, -1), np.moveaxis(isolated, 1, -1)),
+        batch_size=4,
+        linear_norm_coeff=1,
+        noise_sigma=np.array([1e-3] * 6),
+        seed=0,
+    )
+    x, y = next(iter(noisy_dataset))
+    assert x.shape == (4, 11, 11, 6)
+    assert 0 < np.std(x - y) < 1
+    # each pass over the seeded dataset draws a new noise realization
+    first, second = [
+        np.concatenate([x for x, _ in noisy_dataset.as_numpy_iterator()])
+        for _ in range(2)
+    ]
+    assert not np.allclose(np.sort(first.ravel()), np.sort(second.ravel()))
+
+    stats = measure_input_stall(noisy_dataset, num_batches=10)
+    assert stats["num_batches"] == 3
+    assert 0 <= stats["stall_fraction"] <= 1
+
+    f_net = FlowVAEnet(
+        stamp_shape=11,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+    )
+
+    f_net.train_vae(
+        dataset,
+        dataset,
+        callbacks=[],
+        epochs=1,
+        optimizer=tf.keras.optimizers.Adam(1e-5),
+        loss_function=deblender_loss_fn_wrapper(
+            sigma_cutoff=np.array([1] * 6), linear_norm_coeff=1
+        ),
+        verbose=0,
+    )
+
+    flow_dataset = build_training_dataset(
+        shards, batch_size=5, y_col_name=None, channel_last=False
+    )
+    hist = f_net.train_flow(
+        flow_dataset,
+        flow_dataset,
+        callbacks=[],
+        epochs=1,
+        optimizer=tf.keras.optimizers.Adam(1e-5),
+        verbose=0,
+    )
+    assert "val_loss" in hist.history
+
+    f_net.train_encoder(
+        dataset,
+        dataset,
+        callbacks=[],
+        epochs=1,
+        optimizer=tf.keras.optimizers.Adam(1e-5),
+        loss_function=deblender_encoder_loss_wrapper(
+            original_encoder=f_net.encoder,
+            noise_sigma=np.array([1e-3] * 6),
+            latent_dim=4,
+        ),
+        verbose=0,
+    )
+
+
+def test_teacher_dataset(tmp_path):
+    """Test training the deblender encoder with cached teacher latent distributions."""
+    f_net = FlowVAEnet(
+        stamp_shape=11,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+    )
+    blended = np.random.rand(10, 11, 11, 6).astype(np.float32)
+    isolated = np.random.rand(10, 11, 11, 6).astype(np.float32)
+
+    # without noise, the targets are the outputs of the original encoder
+    dataset = build_teacher_dataset(
+        (blended, isolated),
+        f_net.encoder,
+        noise_sigma=np.zeros(6),
+        num_realizations=2,
+        batch_size=4,
+        shuffle_buffer=0,
+        cache_dir=str(tmp_path),
+    )
+    # the cache is streamed to disk, with 2 realizations of the teacher parameters
+    teacher_params = f_net.encoder(isolated).numpy()
+    assert os.path.getsize(tmp_path / "inputs.bin") == blended.nbytes
+    assert os.path.getsize(tmp_path / "teacher_params.bin") == 2 * teacher_params.nbytes
+    x, params = zip(*dataset.as_numpy_iterator())
+    np.testing.assert_array_equal(np.concatenate(x), blended)
+    np.testing.assert_allclose(np.concatenate(params), teacher_params, rtol=1e-5)
+
+    dataset = build_teacher_dataset(
+        (blended, isolated),
+        f_net.encoder,
+        noise_sigma=np.array([1e-3] * 6),
+        num_realizations=3,
+        batch_size=4,
+        seed=0,
+    )
+    hist = f_net.train_encoder(
+        dataset,
+        dataset,
+        callbacks=[],
+        epochs=1,
+        loss_function=deblender_encoder_cached_loss_wrapper(latent_dim=4),
+        verbose=0,
+    )
+    assert np.isfinite(hist.history["val_loss"][-1])
+
+    # the temporary cache is deleted with the dataset
+    pattern = os.path.join(tempfile.gettempdir(), "madness_teacher_*")
+    previous_dirs = set(glob.glob(pattern))
+    dataset = build_teacher_dataset(
+        (blended, isolated), f_net.encoder, noise_sigma=np.zeros(6), batch_size=4
+    )
+    (cache_dir,) = set(glob.glob(pattern)) - previous_dirs
+    list(dataset.as_numpy_iterator())
+    del dataset
+    gc.collect()
+    assert not os.path.exists(cache_dir)
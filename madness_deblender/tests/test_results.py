@@ -0,0 +1,57 @@
+"""Test lazy components."""
+
+import numpy as np
+
+from madness_deblender.deblender import Deblender
+
+
+def test_lazy_components():
+    """Test decoding the components on access."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+
+    data = np.random.rand(2, 6, 15, 15)
+    detected_pos = [[[9, 10], [11, 11]], [[10, 10], [0, 0]]]
+
+    deb(
+        data,
+        detected_pos,
+        num_components=[2, 1],
+        linear_norm_coeff=2,
+        max_iter=2,
+        channel_last=False,
+        lazy_components=True,
+    )
+    assert deb.components is None
+
+    lazy = deb.lazy_components
+    lazy.cache_size = 2
+    components = deb.get_components()
+    assert components.shape == lazy.shape == (2, 2, 6, 5, 5)
+
+    np.testing.assert_allclose(lazy[0, 1], components[0, 1], rtol=1e-5)
+    np.testing.assert_allclose(lazy[0, 1], components[0, 1], rtol=1e-5)
+    assert lazy.cache_info() == {"hits": 1, "misses": 1, "size": 1, "max_size": 2}
+
+    # decoding the two slots of the second field evicts the first galaxy
+    np.testing.assert_allclose(lazy[1], components[1], rtol=1e-5)
+    lazy[0, 1]
+    assert lazy.cache_info() == {"hits": 1, "misses": 4, "size": 2, "max_size": 2}
+
+    chunks = list(lazy.iter_chunks(chunk_size=2))
+    assert len(chunks) == 2
+    np.testing.assert_array_equal(chunks[1][0], [1])
+    np.testing.assert_allclose(chunks[1][2][0], components[1, 0], rtol=1e-5)
+
+    fluxes = lazy.fluxes()
+    np.testing.assert_allclose(fluxes[0], components[0].sum(axis=(2, 3)), rtol=1e-5)
+    np.testing.assert_array_equal(fluxes[1, 1], 0)
@@ -0,0 +1,63 @@
+"""Test the runtime configuration."""
+
+import os
+
+from madness_deblender import runtime
+from madness_deblender.runtime import (
+    auto_config,
+    configure_runtime,
+    detect_topology,
+    get_parallel_iterations,
+    parse_cpu_list,
+    partition_cpus,
+)
+
+
+def test_partition_cpus():
+    """Test the NUMA aware partition of the CPUs between workers."""
+    assert parse_cpu_list("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+
+    topology = {
+        "cpus": list(range(8)),
+        "numa_nodes": {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]},
+    }
+    assert partition_cpus(2, 4, topology) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    # the workers alternate between the nodes
+    assert partition_cpus(2, 2, topology) == [[0, 1], [4, 5]]
+    assert partition_cpus(4, topology=topology) == [[0, 1], [4, 5], [2, 3], [6, 7]]
+    # a worker larger than a node spans several nodes
+    assert partition_cpus(1, 6, topology) == [[0, 1, 2, 3, 4, 5]]
+    assert partition_cpus(3, 3, topology) is None
+
+    assert auto_config(4, topology) == {
+        "intra_op_threads": 2,
+        "inter_op_threads": 1,
+        "parallel_iterations": 2,
+    }
+    assert auto_config(1, topology)["inter_op_threads"] == 2
+
+    topology = detect_topology()
+    assert topology["cpus"] == sorted(os.sched_getaffinity(0))
+    assert sorted(sum(topology["numa_nodes"].values(), [])) == topology["cpus"]
+
+
+def test_configure_runtime():
+    """Test setting the CPU affinity and parallel iterations of the process."""
+    cpus = sorted(os.sched_getaffinity(0))
+    parallel_iterations = get_parallel_iterations()
+    try:
+        config = configure_runtime(parallel_iterations=3, cpus=cpus[:1])
+        assert get_parallel_iterations() == 3
+        assert sorted(os.sched_getaffinity(0)) == cpus[:1]
+        assert config["cpus"] == cpus[:1]
+        assert config["intra_op_threads"] is None
+    finally:
+        os.sched_setaffinity(0, cpus)
+        runtime._PARALLEL_ITERATIONS = parallel_iterations
+
+
+def test_configure_runtime_without_affinity(monkeypatch):
+    """Test that pinning is skipped on platforms without CPU affinity."""
+    monkeypatch.delattr(os, "sched_setaffinity")
+    config = configure_runtime(cpus=[0])
+    assert config["cpus"] is None
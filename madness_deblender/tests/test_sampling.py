@@ -0,0 +1,48 @@
+"""Test posterior sampling."""
+
+import numpy as np
+
+from madness_deblender.deblender import Deblender
+
+
+def test_posterior_sampling():
+    """Test vectorized HMC chains starting from the MAP solution."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+
+    data = np.random.rand(2, 15, 15, 6)
+    detected_pos = [[[9, 10], [11, 11]], [[10, 10], [0, 0]]]
+
+    deb(
+        data,
+        detected_pos,
+        num_components=[2, 1],
+        linear_norm_coeff=1,
+        max_iter=2,
+        channel_last=True,
+    )
+
+    for kernel in ["hmc", "nuts"]:
+        results = deb.sample_posterior(
+            num_chains=3,
+            num_results=5,
+            num_burnin_steps=5,
+            kernel=kernel,
+            num_leapfrog_steps=2,
+            seed=1,
+        )
+
+        assert results["samples"].shape == (5, 3, 2, 2, 4)
+        assert results["ess"].shape == (2, 2, 4)
+        assert results["acceptance_rate"].shape == (2,)
+        assert results["step_size"].shape == (2,)
+        assert results["ess_per_second"] >= 0
@@ -0,0 +1,80 @@
+"""Test the micro-batching deblending service."""
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from madness_deblender.deblender import Deblender
+from madness_deblender.service import DeblendingService, request_deblending
+
+
+def test_service():
+    """Test deblending concurrent requests in micro-batches, in process and over a socket."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+    rng = np.random.default_rng(0)
+    fields = rng.random((5, 15, 15, 6))
+    positions = [[[9, 10], [11, 11]], [[10, 10]], [[5, 5], [9, 9], [7, 11]], [[7, 7]]]
+
+    async def run():
+        async with DeblendingService(
+            deb,
+            max_batch_size=3,
+            max_latency=0.5,
+            noise_sigma=[0.1] * 6,
+            max_iter=2,
+            linear_norm_coeff=1,
+            channel_last=True,
+        ) as service:
+            components = await asyncio.gather(
+                *[service.deblend(f, p) for f, p in zip(fields, positions)]
+            )
+            with pytest.raises(ValueError):
+                await service.deblend(fields[0], [])
+
+            # sub-pixel positions are rounded by the deblender
+            rounded_components = [
+                await service.deblend(fields[0], p, noise_sigma=[0.2] * 6)
+                for p in [[[9.6, 10.4]], [[10, 10]]]
+            ]
+
+            server = await service.serve()
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                remote_components = await request_deblending(
+                    fields[4], [[10, 10]], port=port
+                )
+                with pytest.raises(RuntimeError):
+                    # mismatched number of bands
+                    await request_deblending(fields[4, ..., :2], [[10, 10]], port=port)
+            stats = service.stats()
+        assert service._executor is None
+
+        async with DeblendingService(deb, max_iter=2, channel_last=True) as service:
+            with pytest.raises(ValueError, match="noise level"):
+                await service.deblend(fields[0], [[10, 10]])
+        return components, rounded_components, remote_components, stats
+
+    components, rounded_components, remote_components, stats = asyncio.run(run())
+
+    np.testing.assert_array_equal(rounded_components[0], rounded_components[1])
+
+    for c, p in zip(components, positions):
+        assert c.shape == (len(p), 5, 5, 6)
+    assert remote_components.shape == (1, 5, 5, 6)
+
+    assert stats["num_requests"] == 7
+    # the 4 concurrent requests are grouped in batches of at most 3
+    assert stats["num_batches"] == 5
+    assert stats["latency_p50"] <= stats["latency_p99"]
+    assert stats["galaxies_per_second"] > 0
@@ -0,0 +1,73 @@
+"""Test the blend simulator."""
+
+import galcheat
+import numpy as np
+import tensorflow as tf
+from galcheat.utilities import mean_sky_level
+
+from madness_deblender.simulator import (
+    build_blend_dataset,
+    get_noise_sigma,
+    shift_stamps,
+    simulate_blends,
+)
+
+
+def test_simulator():
+    """Test simulating blends from a pool of isolated galaxies."""
+    survey = galcheat.get_survey("LSST")
+    noise_sigma = get_noise_sigma(survey, linear_norm_coeff=100)
+    np.testing.assert_allclose(
+        noise_sigma[2],
+        np.sqrt(mean_sky_level(survey, "r").to_value("electron")) / 100,
+        rtol=1e-6,
+    )
+
+    stamps = np.zeros((2, 11, 11, 6), dtype=np.float32)
+    stamps[:, 5, 5] = 1
+    shifted = shift_stamps(tf.constant(stamps), tf.constant([[2.0, -3.0], [0.5, 0]]))
+    assert shifted[0, 7, 2, 0] == 1
+    np.testing.assert_allclose(shifted[1, 5:7, 5, 0], [0.5, 0.5])
+
+    pool = np.random.rand(5, 11, 11, 6).astype(np.float32)
+
+    # a single galaxy without noise is its own target
+    blends, isolated = simulate_blends(
+        tf.constant(pool), batch_size=4, seed=[0, 1], max_number=1
+    )
+    np.testing.assert_array_equal(blends, isolated)
+    # each target is a rescaled stamp of the pool
+    ratio = isolated.numpy()[:, None] / pool[None]
+    is_rescaled = np.all(np.isclose(ratio, ratio[..., :1, :1, :1]), axis=(2, 3, 4))
+    assert np.all(np.any(is_rescaled, axis=1))
+
+    blends, isolated = simulate_blends(
+        tf.constant(pool),
+        batch_size=64,
+        seed=[0, 1],
+        max_number=3,
+        max_shift=3,
+        flux_range=(1, 1),
+    )
+    assert np.all(blends >= isolated - 1e-6)
+    assert np.any(blends > isolated + 1e-3)
+
+    dataset = build_blend_dataset(
+        np.moveaxis(pool, -1, 1),
+        batch_size=3,
+        num_batches=2,
+        channel_last=False,
+        noise_sigma=[1e-2] * 6,
+        source_noise=False,
+        linear_norm_coeff=1,
+        max_number=1,
+        seed=0,
+    )
+    batches = list(dataset.as_numpy_iterator())
+    assert len(batches) == 2
+    assert batches[0][0].shape == (3, 11, 11, 6)
+    np.testing.assert_allclose(np.std(batches[0][0] - batches[0][1]), 1e-2, rtol=0.1)
+
+    # the simulations are reproducible
+    for (x1, y1), (x2, y2) in zip(batches, dataset.as_numpy_iterator()):
+        np.testing.assert_array_equal(x1, x2)
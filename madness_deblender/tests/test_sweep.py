@@ -0,0 +1,75 @@
+"""Test the parallel sweep runner."""
+
+import json
+import os
+
+import numpy as np
+
+from madness_deblender.sweep import read_dataset_cache, run_sweep, write_dataset_cache
+
+
+def test_sweep(tmp_path):
+    """Test sweeping two architectures in two workers sharing a dataset cache."""
+    rng = np.random.default_rng(0)
+    isolated = rng.uniform(0, 100, size=(20, 6, 11, 11)).astype(np.float32)
+    blends = isolated + rng.normal(0, 10, size=isolated.shape).astype(np.float32)
+
+    cache_dir = os.path.join(tmp_path, "cache")
+    write_dataset_cache(
+        cache_dir,
+        blends[:16],
+        isolated[:16],
+        blends[16:],
+        isolated[16:],
+        linear_norm_coeff=100,
+        channel_last=False,
+    )
+    cache = read_dataset_cache(cache_dir)
+    assert cache["x_train"].shape == (16, 11, 11, 6)
+    assert cache["x_train"].dtype == np.float32
+    np.testing.assert_allclose(
+        cache["y_validation"], np.moveaxis(isolated[16:], 1, -1) / 100, rtol=1e-6
+    )
+
+    base = {
+        "latent_dim": 4,
+        "filters_encoder": [1, 1, 1, 1],
+        "filters_decoder": [1, 1, 1],
+        "kernels_encoder": [1, 1, 1, 1],
+        "kernels_decoder": [1, 1, 1],
+        "num_nf_layers": 1,
+    }
+    configs = [
+        dict(base, dense_layer_units=1),
+        dict(base, dense_layer_units=2),
+        dict(base, unknown_argument=1),
+    ]
+    results_path = os.path.join(tmp_path, "results.jsonl")
+    results = run_sweep(
+        configs,
+        cache_dir,
+        noise_sigma=[0.1] * 6,
+        results_path=results_path,
+        num_workers=2,
+        threads_per_worker=1,
+        pin_cpus=True,
+        epochs=1,
+        flow_epochs=1,
+        batch_size=8,
+        num_deblend_fields=2,
+        deblend_max_iter=2,
+    )
+
+    for config, result in zip(configs[:2], results[:2]):
+        assert result["config"] == config
+        assert np.isfinite(result["val_loss"])
+        assert np.isfinite(result["flow_val_loss"])
+        assert result["deblend_galaxies_per_second"] > 0
+        assert result["num_params"]["total"] == sum(
+            result["num_params"][network] for network in ["encoder", "decoder", "flow"]
+        )
+    assert results[1]["num_params"]["total"] > results[0]["num_params"]["total"]
+    assert "error" in results[2]
+
+    with open(results_path) as f:
+        assert len([json.loads(line) for line in f]) == len(configs)
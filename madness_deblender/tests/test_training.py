@@ -1,12 +1,18 @@
 """Test training."""
 
+import csv
+import json
 import os
 
 import numpy as np
 import tensorflow as tf
 import tensorflow_probability as tfp
 
-from madness_deblender.callbacks import changeAlpha, define_callbacks
+from madness_deblender.callbacks import (
+    PerformanceMonitor,
+    changeAlpha,
+    define_callbacks,
+)
 from madness_deblender.FlowVAEnet import FlowVAEnet
 from madness_deblender.losses import deblender_loss_fn_wrapper
 from madness_deblender.utils import get_data_dir_path
@@ -65,3 +71,113 @@ def test_vae_training():
         ),
         verbose=2,
     )
+
+
+def test_cached_latent_flow_training(tmp_path):
+    """Test training the flow on cached latent vectors."""
+    f_net = FlowVAEnet(
+        stamp_shape=11,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+    )
+
+    data = np.random.rand(8, 11, 11, 6)
+
+    z_mean = f_net.encode_latents((data,), num_samples=0)
+    np.testing.assert_allclose(
+        z_mean, f_net.encoder(data).numpy()[:, :4], rtol=1e-5, atol=1e-6
+    )
+    assert f_net.encode_latents((data,), num_samples=3).shape == (24, 4)
+
+    weights_path = os.path.join(tmp_path, "flow")
+    hist = f_net.train_flow(
+        (data[:4], data[:4]),
+        (data[4:], data[4:]),
+        callbacks=define_callbacks(weights_path, patience=1),
+        epochs=1,
+        verbose=0,
+        cache_latents=True,
+        num_latent_samples=2,
+        batch_size=3,
+    )
+    assert "val_loss" in hist.history
+
+    # the checkpoints have the structure of the flow_model
+    f_net.flow_model.save_weights(os.path.join(tmp_path, "flow_model"))
+
+    def checkpoint_variables(path):
+        return {
+            name
+            for name, _ in tf.train.list_variables(path)
+            if "OPTIMIZER" not in name and not name.startswith("_")
+        }
+
+    assert checkpoint_variables(
+        tf.train.latest_checkpoint(os.path.join(weights_path, "val_loss"))
+    ) == checkpoint_variables(os.path.join(tmp_path, "flow_model"))
+    new_f_net = FlowVAEnet(
+        stamp_shape=11,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+    )
+    new_f_net.load_flow_weights(os.path.join(weights_path, "val_loss"))
+    for w1, w2 in zip(f_net.flow.get_weights(), new_f_net.flow.get_weights()):
+        np.testing.assert_array_equal(w1, w2)
+
+
+def test_performance_monitor(tmp_path):
+    """Test logging the training throughput and input wait."""
+    f_net = FlowVAEnet(
+        stamp_shape=11,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+    )
+
+    data = np.random.rand(10, 11, 11, 6).astype(np.float32)
+    weights_path = os.path.join(tmp_path, "vae")
+    step_log_path = os.path.join(tmp_path, "steps.jsonl")
+    f_net.train_vae(
+        tf.data.Dataset.from_tensor_slices((data[:8], data[:8])).batch(3),
+        (data[8:], data[8:]),
+        callbacks=define_callbacks(weights_path, patience=1, monitor_performance=True)
+        + [PerformanceMonitor(step_log_path, log_freq=1)],
+        loss_function=deblender_loss_fn_wrapper(
+            sigma_cutoff=np.array([1] * 6), linear_norm_coeff=1
+        ),
+        epochs=2,
+        verbose=0,
+    )
+
+    with open(os.path.join(weights_path, "performance.csv")) as f:
+        epoch_rows = list(csv.DictReader(f))
+    assert [row["epoch"] for row in epoch_rows] == ["0", "1"]
+    for row in epoch_rows:
+        assert float(row["images_per_second"]) > 0
+        assert 0 <= float(row["input_wait_fraction"]) <= 1
+        assert float(row["step_time_p50"]) <= float(row["step_time_p99"])
+        assert float(row["peak_memory_mb"]) > 0
+
+    with open(step_log_path) as f:
+        rows = [json.loads(line) for line in f]
+    # 3 steps and a summary per epoch
+    assert [row["step"] for row in rows] == [1, 2, 3, None] * 2
+    # each step row covers one step, of 3, 3 and 2 images
+    np.testing.assert_allclose(
+        [row["images_per_second"] * row["step_time_p50"] for row in rows[:3]],
+        [3, 3, 2],
+    )
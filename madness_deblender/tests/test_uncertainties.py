@@ -0,0 +1,97 @@
+"""Test Laplace approximation."""
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from madness_deblender.deblender import Deblender
+from madness_deblender.uncertainties import (
+    compute_latent_hessian,
+    laplace_covariance,
+    propagate_to_components,
+)
+
+
+def test_laplace_covariance():
+    """Test the block-wise inversion of a batch of Hessians."""
+    latent_dim = 2
+    # two fields: two overlapping galaxies and two isolated galaxies + padding
+    z = tf.random.normal([2, 3 * latent_dim])
+    precision = tf.constant(np.diag([1.0, 2.0, 3.0, 4.0, 5.0, 6.0]), dtype=tf.float32)
+
+    def loss_fn(z):
+        coupling = z[:, 0] * z[:, 2] + z[:, 2] * z[:, 4]
+        return 0.5 * tf.einsum("fi,ij,fj->f", z, precision, z) + 0.1 * coupling
+
+    hessian = compute_latent_hessian(loss_fn, z)
+    coupling = np.zeros((6, 6))
+    coupling[[0, 2, 2, 4], [2, 0, 4, 2]] = 0.1
+    np.testing.assert_allclose(hessian[0], precision + coupling, atol=1e-6)
+
+    group_labels = np.array([[0, 0, -1], [0, 1, -1]])
+    z_cov = laplace_covariance(hessian, group_labels, latent_dim=latent_dim)
+
+    expected_cov = np.linalg.inv(hessian[0, :4, :4])
+    np.testing.assert_allclose(z_cov[0, 0], expected_cov[:2, :2], rtol=1e-5)
+    np.testing.assert_allclose(z_cov[0, 1], expected_cov[2:, 2:], rtol=1e-5)
+    # cross-group terms are dropped
+    np.testing.assert_allclose(z_cov[1, 0], np.diag([1.0, 1 / 2]), rtol=1e-5)
+    np.testing.assert_array_equal(z_cov[:, 2], 0)
+
+
+def test_deblender_uncertainties():
+    """Test uncertainties at the end of deblending."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+
+    data = np.random.rand(2, 6, 15, 15)
+    detected_pos = [[[9, 10], [11, 11]], [[10, 10], [0, 0]]]
+
+    deb(
+        data,
+        detected_pos,
+        num_components=[2, 1],
+        linear_norm_coeff=1,
+        max_iter=2,
+        channel_last=False,
+    )
+    uncertainties = deb.compute_uncertainties(
+        fields_per_batch=1, pixel_uncertainties=True
+    )
+
+    assert uncertainties["z_cov"].shape == (2, 2, 4, 4)
+    assert uncertainties["flux_cov"].shape == (2, 2, 6, 6)
+    assert uncertainties["pixel_std"].shape == deb.get_components().shape
+    np.testing.assert_array_equal(uncertainties["z_cov"][1, 1], 0)
+    assert np.all(np.linalg.eigvalsh(uncertainties["z_cov"][0, 0]) > 0)
+
+    # no galaxy to propagate
+    flux_cov, pixel_var = propagate_to_components(
+        deb.flow_vae_net.decoder,
+        np.zeros((0, 4)),
+        np.zeros((0, 4, 4)),
+        pixel_variance=True,
+    )
+    assert flux_cov.shape == (0, 6, 6)
+    assert pixel_var.shape == (0, 5, 5, 6)
+
+    deb(
+        data,
+        detected_pos,
+        num_components=[2, 1],
+        linear_norm_coeff=1,
+        max_iter=2,
+        channel_last=False,
+        fit_amplitudes=True,
+    )
+    with pytest.raises(ValueError, match="fit_amplitudes"):
+        deb.compute_uncertainties()
@@ -0,0 +1,62 @@
+"""Test the weights bundle."""
+
+import os
+
+import numpy as np
+import pytest
+
+from madness_deblender.deblender import Deblender
+from madness_deblender.FlowVAEnet import FlowVAEnet
+from madness_deblender.weights import (
+    convert_checkpoints,
+    is_weights_bundle,
+    read_weights_bundle,
+)
+
+
+def test_weights_bundle(tmp_path):
+    """Test converting checkpoints to a bundle and loading it in the deblender."""
+    architecture = {
+        "stamp_shape": 5,
+        "latent_dim": 4,
+        "filters_encoder": [1, 1, 1, 1],
+        "filters_decoder": [1, 1, 1],
+        "kernels_encoder": [1, 1, 1, 1],
+        "kernels_decoder": [1, 1, 1],
+        "dense_layer_units": 1,
+        "num_nf_layers": 1,
+    }
+
+    # checkpoints of separately trained networks
+    checkpoints_path = os.path.join(tmp_path, "checkpoints")
+    for folder, model in [
+        ("flow", "flow_model"),
+        ("vae", "vae_model"),
+        ("deblender", "encoder"),
+    ]:
+        getattr(FlowVAEnet(**architecture), model).save_weights(
+            os.path.join(checkpoints_path, folder, "val_loss", "weights.ckpt")
+        )
+
+    bundle_path = os.path.join(tmp_path, "weights.bundle")
+    convert_checkpoints(
+        checkpoints_path, bundle_path, metadata={"survey": "LSST"}, **architecture
+    )
+    assert is_weights_bundle(bundle_path)
+    assert not is_weights_bundle(checkpoints_path)
+
+    header, weights = read_weights_bundle(bundle_path)
+    assert header["metadata"]["survey"] == "LSST"
+    assert isinstance(weights["decoder"][0].base, np.memmap)
+
+    deb_checkpoints = Deblender(weights_path=checkpoints_path, **architecture)
+    deb_bundle = Deblender(weights_path=bundle_path, **architecture)
+    for network in ["encoder", "decoder", "flow"]:
+        for w1, w2 in zip(
+            getattr(deb_checkpoints.flow_vae_net, network).get_weights(),
+            getattr(deb_bundle.flow_vae_net, network).get_weights(),
+        ):
+            np.testing.assert_array_equal(w1, w2)
+
+    with pytest.raises(ValueError):
+        Deblender(weights_path=bundle_path, **dict(architecture, latent_dim=3))
@@ -0,0 +1,118 @@
+"""Test result writer."""
+
+import os
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from madness_deblender.deblender import Deblender
+from madness_deblender.writer import ResultWriter, decode_components, read_results
+
+
+@pytest.mark.parametrize("extension", [".h5", ".zarr"])
+def test_result_writer(tmp_path, extension):
+    """Test streaming two batches of results to disk."""
+    if extension == ".zarr":
+        pytest.importorskip("zarr")
+
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+
+    # a positive output bias makes the reconstructions, and their footprints, non-empty
+    last_layer = [
+        layer
+        for layer in deb.flow_vae_net.decoder.layers
+        if isinstance(layer, tf.keras.layers.Conv2DTranspose)
+    ][-1]
+    last_layer.bias.assign(tf.fill(last_layer.bias.shape, 0.1))
+
+    data = np.random.rand(2, 15, 15, 6)
+    detected_pos = [[[9, 10], [11, 11]], [[10, 10], [0, 0]]]
+
+    path = os.path.join(tmp_path, "results" + extension)
+    components = []
+    with ResultWriter(path, chunk_size=2, metadata={"tract": 1}) as writer:
+        for _ in range(2):
+            deb(
+                data,
+                detected_pos,
+                num_components=[2, 1],
+                noise_sigma=[1e-3] * 6,
+                linear_norm_coeff=2,
+                max_iter=2,
+                channel_last=True,
+            )
+            writer.write(deb)
+            components.append(deb.components.numpy()[[0, 0, 1], [0, 1, 0]])
+
+    results = read_results(path)
+    np.testing.assert_array_equal(results["field_id"], [0, 0, 1, 2, 2, 3])
+    np.testing.assert_array_equal(results["slot"], [0, 1, 0, 0, 1, 0])
+    np.testing.assert_array_equal(results["fields/num_components"], [2, 1, 2, 1])
+    np.testing.assert_allclose(results["components"], np.concatenate(components))
+    assert results["z"].shape == (6, 4)
+    np.testing.assert_array_equal(results["amplitudes"], 1)
+    assert results["log_prob"].shape == (6,)
+    np.testing.assert_allclose(
+        results["chi2"][3:], deb.metrics["chi2"][[0, 0, 1], [0, 1, 0]], rtol=1e-6
+    )
+    assert np.all(results["chi2"] > 0)
+    np.testing.assert_array_equal(results["footprint_area"], 25)
+    assert results["metadata"]["tract"] == 1
+    assert results["metadata"]["linear_norm_coeff"] == [2]
+
+    np.testing.assert_allclose(
+        decode_components(path, deb.flow_vae_net),
+        results["components"],
+        rtol=1e-5,
+    )
+
+
+def test_result_writer_latents_only(tmp_path):
+    """Test storing only the latent space representations and the amplitudes."""
+    deb = Deblender(
+        stamp_shape=5,
+        latent_dim=4,
+        filters_encoder=[1, 1, 1, 1],
+        filters_decoder=[1, 1, 1],
+        kernels_encoder=[1, 1, 1, 1],
+        kernels_decoder=[1, 1, 1],
+        dense_layer_units=1,
+        num_nf_layers=1,
+        load_weights=False,
+    )
+
+    data = np.random.rand(1, 15, 15, 6)
+    deb(
+        data,
+        [[[9, 10], [11, 11]]],
+        num_components=[2],
+        linear_norm_coeff=1,
+        max_iter=2,
+        channel_last=True,
+        fit_amplitudes=True,
+    )
+
+    path = os.path.join(tmp_path, "results.h5")
+    with ResultWriter(path, store_components=False) as writer:
+        writer.write(deb, field_ids=[42])
+
+    results = read_results(path)
+    assert "components" not in results
+    np.testing.assert_allclose(results["amplitudes"], deb.amplitudes.numpy()[0])
+    np.testing.assert_array_equal(results["fields/field_id"], [42])
+    np.testing.assert_allclose(
+        decode_components(path, deb.flow_vae_net, index=[1]),
+        deb.components.numpy()[0, 1:],
+        rtol=1e-5,
+    )
@@ -0,0 +1,179 @@
+"""Laplace approximation of the posterior around the MAP solution."""
+
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+LOG = logging.getLogger(__name__)
+
+
+def compute_latent_hessian(loss_fn, z):
+    """Compute the Hessian of a batch of independent losses in the latent space.
+
+    Parameters
+    ----------
+    loss_fn: python function
+        maps `z` of shape (batch_size, num_params) to the losses of shape (batch_size,).
+        The loss of each batch element must depend only on its own parameters.
+    z: tf tensor
+        point at which the Hessian is evaluated, of shape (batch_size, num_params).
+
+    Returns
+    -------
+    hessian: tf tensor
+        Hessian of each loss, of shape (batch_size, num_params, num_params).
+
+    """
+    z = tf.convert_to_tensor(z, dtype=tf.float32)
+    with tf.GradientTape() as outer_tape:
+        outer_tape.watch(z)
+        with tf.GradientTape() as inner_tape:
+            inner_tape.watch(z)
+            loss = tf.reduce_sum(loss_fn(z))
+        grad = inner_tape.gradient(loss, z)
+    try:
+        hessian = outer_tape.batch_jacobian(grad, z)
+    except (ValueError, tf.errors.InvalidArgumentError):
+        LOG.warning("Vectorized Hessian failed, falling back to a while loop.")
+        with tf.GradientTape() as outer_tape:
+            outer_tape.watch(z)
+            with tf.GradientTape() as inner_tape:
+                inner_tape.watch(z)
+                loss = tf.reduce_sum(loss_fn(z))
+            grad = inner_tape.gradient(loss, z)
+        hessian = outer_tape.batch_jacobian(grad, z, experimental_use_pfor=False)
+
+    # symmetrize to remove round-off asymmetries
+    return (hessian + tf.linalg.matrix_transpose(hessian)) / 2
+
+
+def laplace_covariance(hessian, group_labels, latent_dim, min_eigenvalue=1e-6):
+    """Invert the Hessian of each field block-wise over its blend groups.
+
+    Galaxies in different blend groups do not share pixels, so the cross terms
+    are dropped and the padded slots are decoupled before the inversion.
+    Eigenvalues are floored at `min_eigenvalue` in case the optimization has
+    not fully converged and the Hessian is not positive definite.
+
+    Parameters
+    ----------
+    hessian: tf tensor
+        Hessian of the loss of each field, of shape (num_fields, max_number * latent_dim, max_number * latent_dim).
+    group_labels: np.ndarray
+        blend group of each galaxy, of shape (num_fields, max_number), with -1 for padded slots.
+    latent_dim: int
+        size of the latent space.
+    min_eigenvalue: float
+        smallest eigenvalue of the Hessian retained for the inversion.
+
+    Returns
+    -------
+    z_cov: np.ndarray
+        latent covariance of each galaxy, of shape (num_fields, max_number, latent_dim, latent_dim).
+        Padded slots are set to zero.
+
+    """
+    group_labels = np.asarray(group_labels)
+    num_fields, max_number = group_labels.shape
+
+    labels = np.repeat(group_labels, latent_dim, axis=1)
+    same_group = (labels[:, :, None] == labels[:, None, :]) & (labels[:, :, None] >= 0)
+    padded_diag = np.repeat(group_labels < 0, latent_dim, axis=1)
+
+    hessian = tf.where(same_group, hessian, tf.zeros_like(hessian))
+    hessian = tf.linalg.set_diag(
+        hessian,
+        tf.where(
+            padded_diag,
+            tf.ones_like(padded_diag, tf.float32),
+            tf.linalg.diag_part(hessian),
+        ),
+    )
+
+    eigenvalues, eigenvectors = tf.linalg.eigh(hessian)
+    num_clipped = int(tf.reduce_sum(tf.cast(eigenvalues < min_eigenvalue, tf.int32)))
+    if num_clipped > 0:
+        LOG.warning(
+            f"{num_clipped} eigenvalues of the Hessian were below {min_eigenvalue} and have been clipped."
+        )
+    eigenvalues = tf.maximum(eigenvalues, min_eigenvalue)
+    covariance = tf.matmul(
+        eigenvectors / eigenvalues[:, None, :], eigenvectors, transpose_b=True
+    )
+
+    covariance = np.reshape(
+        covariance.numpy(), [num_fields, max_number, latent_dim, max_number, latent_dim]
+    )
+    # diagonal blocks of the covariance of each field
+    z_cov = np.einsum("fmdme->fmde", covariance)
+    z_cov[group_labels < 0] = 0
+
+    return z_cov
+
+
+def propagate_to_components(decoder, z, z_cov, batch_size=256, pixel_variance=False):
+    """Propagate latent covariances through the linearized decoder.
+
+    Parameters
+    ----------
+    decoder: tf.keras.Model
+        decoder of the VAE.
+    z: np.ndarray
+        latent space representation of the galaxies, of shape (num_galaxies, latent_dim).
+    z_cov: np.ndarray
+        latent covariance of the galaxies, of shape (num_galaxies, latent_dim, latent_dim).
+    batch_size: int
+        number of galaxies for which the decoder Jacobian is computed at a time.
+    pixel_variance: bool
+        to also return the variance of each pixel of the decoded stamps.
+
+    Returns
+    -------
+    flux_cov: np.ndarray
+        covariance of the bandwise flux of each galaxy, of shape (num_galaxies, num_bands, num_bands).
+    pixel_var: np.ndarray
+        variance of each pixel, of shape (num_galaxies, cutout_size, cutout_size, num_bands).
+        None if `pixel_variance` is False.
+
+    """
+
+    @tf.function
+    def propagate(z_batch, z_cov_batch):
+        with tf.GradientTape() as tape:
+            tape.watch(z_batch)
+            stamps = decoder(z_batch)
+        # decoder Jacobian of shape (batch, cutout_size, cutout_size, num_bands, latent_dim)
+        jacobian = tape.batch_jacobian(stamps, z_batch)
+        flux_jacobian = tf.reduce_sum(jacobian, axis=[1, 2])
+        flux_cov = tf.einsum(
+            "nbd,nde,nce->nbc", flux_jacobian, z_cov_batch, flux_jacobian
+        )
+        if not pixel_variance:
+            return flux_cov, tf.zeros([0])
+        pixel_var = tf.einsum("nhwbd,nde,nhwbe->nhwb", jacobian, z_cov_batch, jacobian)
+        return flux_cov, pixel_var
+
+    if len(z) == 0:
+        # no galaxy to propagate, e.g. only empty fields
+        stamp_shape = tuple(decoder.output_shape[1:])
+        flux_cov = np.zeros((0, stamp_shape[-1], stamp_shape[-1]), dtype=np.float32)
+        pixel_var = (
+            np.zeros((0,) + stamp_shape, dtype=np.float32) if pixel_variance else None
+        )
+        return flux_cov, pixel_var
+
+    flux_cov = []
+    pixel_var = []
+    for start in range(0, len(z), batch_size):
+        batch_flux_cov, batch_pixel_var = propagate(
+            tf.convert_to_tensor(z[start : start + batch_size], dtype=tf.float32),
+            tf.convert_to_tensor(z_cov[start : start + batch_size], dtype=tf.float32),
+        )
+        flux_cov.append(batch_flux_cov.numpy())
+        pixel_var.append(batch_pixel_var.numpy())
+
+    flux_cov = np.concatenate(flux_cov)
+    pixel_var = np.concatenate(pixel_var) if pixel_variance else None
+
+    return flux_cov, pixel_var
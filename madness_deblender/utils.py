@@ -34,3 +34,26 @@ def get_data_dir_path():
     data_dir = os.path.join(curdir, "data")
 
     return data_dir
+
+
+def get_survey(survey=None):
+    """Fetch a galcheat survey, importing galcheat only when it is needed.
+
+    Parameters
+    ----------
+    survey: galcheat.survey object or str
+        survey, or its name. Defaults to LSST.
+
+    Returns
+    -------
+    survey: galcheat.survey object
+        galcheat survey object to fetch survey details.
+
+    """
+    if survey is None:
+        survey = "LSST"
+    if isinstance(survey, str):
+        import galcheat
+
+        survey = galcheat.get_survey(survey)
+    return survey
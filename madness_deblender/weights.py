@@ -0,0 +1,253 @@
+"""Store the weights of the networks in a single file, fast to load."""
+
+import argparse
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+import tensorflow as tf
+
+from madness_deblender.FlowVAEnet import FlowVAEnet
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b"MADNESSW"
+FORMAT_VERSION = 1
+# alignment (in bytes) of the arrays in the file
+ALIGNMENT = 64
+NETWORKS = ["encoder", "decoder", "flow"]
+
+
+def load_checkpoints(flow_vae_net, weights_path):
+    """Load the weights of the networks from the TF checkpoint folders.
+
+    The flow checkpoint is loaded first, then the VAE and finally the deblender encoder,
+    so that the encoder is the one trained for deblending.
+
+    Parameters
+    ----------
+    flow_vae_net: madness_deblender.FlowVAEnet.FlowVAEnet
+        networks to load the weights into.
+    weights_path: str
+        base path containing the "flow/val_loss", "vae/val_loss" and "deblender/val_loss" folders.
+
+    """
+    flow_vae_net.load_flow_weights(
+        weights_path=os.path.join(weights_path, "flow/val_loss")
+    )
+    flow_vae_net.load_vae_weights(
+        weights_path=os.path.join(weights_path, "vae/val_loss")
+    )
+    flow_vae_net.load_encoder_weights(
+        weights_path=os.path.join(weights_path, "deblender/val_loss")
+    )
+
+
+def is_weights_bundle(path):
+    """Check if a path points to a weights bundle.
+
+    Parameters
+    ----------
+    path: str
+        path to check.
+
+    Returns
+    -------
+    is_bundle: bool
+        True if `path` is a file starting with the bundle magic number.
+
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_weights_bundle(flow_vae_net, path, metadata=None):
+    """Save the weights of the encoder, decoder and flow in a single file.
+
+    The file starts with a magic number and the length of a JSON header,
+    followed by the header describing each array, and the raw arrays,
+    each aligned on 64 bytes so that they can be memory mapped.
+
+    Parameters
+    ----------
+    flow_vae_net: madness_deblender.FlowVAEnet.FlowVAEnet
+        networks whose weights are saved.
+    path: str
+        path of the bundle.
+    metadata: dict
+        JSON serializable metadata stored in the header.
+
+    """
+    arrays = []
+    header = {
+        "format_version": FORMAT_VERSION,
+        "metadata": {
+            "input_shape": list(flow_vae_net.input_shape),
+            "latent_dim": flow_vae_net.latent_dim,
+            "num_nf_layers": flow_vae_net.num_nf_layers,
+            **(metadata or {}),
+        },
+        "networks": {},
+    }
+
+    offset = 0
+    for network in NETWORKS:
+        model = getattr(flow_vae_net, network)
+        entries = []
+        for variable in model.weights:
+            array = np.ascontiguousarray(variable.numpy())
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+            entries.append(
+                {
+                    "name": variable.name,
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape),
+                    "offset": offset,
+                }
+            )
+            arrays.append((offset, array))
+            offset += array.nbytes
+        header["networks"][network] = entries
+
+    header_bytes = json.dumps(header).encode()
+    data_start = len(MAGIC) + 8 + len(header_bytes)
+    data_start = -(-data_start // ALIGNMENT) * ALIGNMENT
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for array_offset, array in arrays:
+            f.seek(data_start + array_offset)
+            f.write(array.tobytes())
+
+    LOG.info(f"Saved {len(arrays)} arrays ({data_start + offset} bytes) to {path}")
+
+
+def read_weights_bundle(path):
+    """Memory map the arrays of a weights bundle.
+
+    The arrays are read-only views of the file, read without parsing or copying
+    until they are used.
+
+    Parameters
+    ----------
+    path: str
+        path of the bundle.
+
+    Returns
+    -------
+    header: dict
+        header of the bundle, with the metadata and the description of the arrays.
+    weights: dict
+        read-only memory mapped arrays of each network, in the order of `model.weights`.
+
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a weights bundle")
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    if header["format_version"] != FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported weights bundle version {header['format_version']}"
+        )
+    data_start = -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    weights = {}
+    for network, entries in header["networks"].items():
+        weights[network] = [
+            np.ndarray(
+                shape=entry["shape"],
+                dtype=np.dtype(entry["dtype"]),
+                buffer=buffer,
+                offset=data_start + entry["offset"],
+            )
+            for entry in entries
+        ]
+    return header, weights
+
+
+def load_weights_bundle(flow_vae_net, path):
+    """Load the weights of the encoder, decoder and flow from a bundle.
+
+    The weights are read from a single file instead of three checkpoints,
+    and copied into the TF variables of the networks.
+
+    Parameters
+    ----------
+    flow_vae_net: madness_deblender.FlowVAEnet.FlowVAEnet
+        networks to load the weights into.
+    path: str
+        path of the bundle.
+
+    Returns
+    -------
+    metadata: dict
+        metadata stored in the bundle.
+
+    """
+    header, weights = read_weights_bundle(path)
+    for network in NETWORKS:
+        model = getattr(flow_vae_net, network)
+        shapes = [tuple(w.shape) for w in model.weights]
+        bundle_shapes = [tuple(entry["shape"]) for entry in header["networks"][network]]
+        if shapes != bundle_shapes:
+            raise ValueError(
+                f"The {network} in {path} does not match the architecture of the network"
+            )
+        model.set_weights(weights[network])
+    return header["metadata"]
+
+
+def convert_checkpoints(weights_path, output_path, metadata=None, **kwargs):
+    """Convert the TF checkpoint folders of the networks into a weights bundle.
+
+    Parameters
+    ----------
+    weights_path: str
+        base path containing the "flow/val_loss", "vae/val_loss" and "deblender/val_loss" folders.
+    output_path: str
+        path of the bundle.
+    metadata: dict
+        JSON serializable metadata stored in the header.
+    kwargs: dict
+        arguments of `madness_deblender.FlowVAEnet.FlowVAEnet` describing the architecture.
+
+    """
+    flow_vae_net = FlowVAEnet(**kwargs)
+    load_checkpoints(flow_vae_net, weights_path)
+    save_weights_bundle(flow_vae_net, output_path, metadata=metadata)
+
+
+def main():
+    """Convert the checkpoints of a survey into a weights bundle."""
+    parser = argparse.ArgumentParser(description=convert_checkpoints.__doc__)
+    parser.add_argument("weights_path", help="base path of the checkpoint folders")
+    parser.add_argument("output_path", help="path of the bundle")
+    parser.add_argument("--survey", default="LSST")
+    parser.add_argument("--stamp-shape", type=int, default=45)
+    parser.add_argument("--latent-dim", type=int, default=16)
+    parser.add_argument("--num-nf-layers", type=int, default=6)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    tf.get_logger().setLevel("ERROR")
+    convert_checkpoints(
+        args.weights_path,
+        args.output_path,
+        metadata={"survey": args.survey},
+        stamp_shape=args.stamp_shape,
+        latent_dim=args.latent_dim,
+        num_nf_layers=args.num_nf_layers,
+        survey=args.survey,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""Write deblending results to chunked, compressed on-disk stores."""
+
+import json
+import logging
+import os
+
+import numpy as np
+import tensorflow as tf
+
+LOG = logging.getLogger(__name__)
+
+# per-galaxy datasets, stored as flat tables without the padded slots
+GALAXY_DATASETS = [
+    "field_id",
+    "slot",
+    "position",
+    "z",
+    "amplitudes",
+    "log_prob",
+    "chi2",
+    "footprint_area",
+    "components",
+]
+# per-field datasets
+FIELD_DATASETS = [
+    "fields/field_id",
+    "fields/field_loss",
+    "fields/reconstruction_loss",
+    "fields/num_components",
+]
+
+
+class _HDF5Store:
+    """Appendable datasets in an HDF5 file."""
+
+    def __init__(self, path, mode, compression):
+        import h5py
+
+        self.file = h5py.File(path, mode)
+        self.compression = compression
+
+    def append(self, name, data, chunk_size):
+        if name not in self.file:
+            self.file.create_dataset(
+                name,
+                shape=(0,) + data.shape[1:],
+                maxshape=(None,) + data.shape[1:],
+                chunks=(chunk_size,) + data.shape[1:],
+                dtype=data.dtype,
+                compression=self.compression,
+                shuffle=self.compression is not None,
+            )
+        dataset = self.file[name]
+        start = dataset.shape[0]
+        dataset.resize(start + len(data), axis=0)
+        dataset[start:] = data
+
+    def read(self, name, index=slice(None)):
+        return self.file[name][index]
+
+    def keys(self):
+        return list(self.file.keys())
+
+    @property
+    def attrs(self):
+        return self.file.attrs
+
+    def close(self):
+        self.file.close()
+
+
+class _ZarrStore:
+    """Appendable arrays in a Zarr group."""
+
+    def __init__(self, path, mode, compression):
+        try:
+            import zarr
+        except ImportError as e:
+            raise ImportError(
+                "zarr is required to write Zarr stores, install it or use an HDF5 file"
+            ) from e
+
+        self.group = zarr.open_group(path, mode=mode)
+
+    def append(self, name, data, chunk_size):
+        if name not in self.group:
+            self.group.zeros(
+                name=name,
+                shape=(0,) + data.shape[1:],
+                chunks=(chunk_size,) + data.shape[1:],
+                dtype=data.dtype,
+            )
+        self.group[name].append(data)
+
+    def read(self, name, index=slice(None)):
+        return self.group[name][index]
+
+    def keys(self):
+        return list(self.group.keys())
+
+    @property
+    def attrs(self):
+        return self.group.attrs
+
+    def close(self):
+        pass
+
+
+def _open_store(path, mode, backend=None, compression="gzip"):
+    """Open an HDF5 or Zarr store, inferring the backend from the extension."""
+    if backend is None:
+        backend = "zarr" if os.path.splitext(path)[1] == ".zarr" else "hdf5"
+    if backend == "hdf5":
+        return _HDF5Store(path, mode, compression)
+    if backend == "zarr":
+        return _ZarrStore(path, mode, compression)
+    raise ValueError(f"Unknown backend {backend}, use 'hdf5' or 'zarr'")
+
+
+class ResultWriter:
+    """Stream deblending results of successive batches of fields to disk.
+
+    Galaxies are stored as flat tables without the padded slots, in chunks of
+    `chunk_size` galaxies. The components are stored channel last and
+    unnormalized, as in `Deblender.components`. The bandwise amplitudes of the
+    reconstructions (see `Deblender.__call__` with `fit_amplitudes`) are stored
+    next to `z`, with ones if they were not fitted. The loss of each galaxy is stored
+    as the `log_prob` of `z` under the flow, and the reduced `chi2` of the residuals
+    in its `footprint_area` (see `madness_deblender.deblender.compute_galaxy_metrics`).
+    """
+
+    def __init__(
+        self,
+        path,
+        backend=None,
+        store_components=True,
+        compression="gzip",
+        chunk_size=256,
+        metadata=None,
+    ):
+        """Open the store.
+
+        Parameters
+        ----------
+        path: str
+            path of the output. Stores ending with `.zarr` use Zarr, others HDF5.
+        backend: str
+            "hdf5" or "zarr", to override the choice based on the extension.
+        store_components: bool
+            to store the decoded components.
+            If False, only `z` is stored and the components can be decoded later
+            with `decode_components`.
+        compression: str
+            compression filter of the HDF5 datasets. Zarr arrays use the default codec.
+        chunk_size: int
+            number of galaxies (or fields) in each chunk.
+        metadata: dict
+            JSON serializable metadata stored with the results.
+
+        """
+        self.path = path
+        self.store_components = store_components
+        self.chunk_size = chunk_size
+        self.store = _open_store(path, "w", backend=backend, compression=compression)
+        self.metadata = dict(metadata or {})
+        self.metadata["store_components"] = store_components
+        self.num_fields_written = 0
+        self.num_galaxies_written = 0
+
+    def write(self, deblender, field_ids=None):
+        """Write the results of the last batch deblended by `deblender`.
+
+        Parameters
+        ----------
+        deblender: madness_deblender.deblender.Deblender
+            deblender after a call.
+        field_ids: list
+            identifiers of the fields in the batch.
+            Defaults to consecutive numbers following the previous batches.
+
+        """
+        num_fields, max_number = deblender.num_fields, deblender.max_number
+        num_components = deblender.num_components.numpy()
+        if field_ids is None:
+            field_ids = self.num_fields_written + np.arange(num_fields)
+        field_ids = np.asarray(field_ids, dtype=np.int64)
+
+        valid = np.arange(max_number)[None, :] < num_components[:, None]
+        field_index, slot_index = np.nonzero(valid)
+
+        z = deblender.z.numpy()
+        if deblender.amplitudes is None:
+            amplitudes = np.ones(
+                (num_fields, max_number, deblender.num_bands), dtype=np.float32
+            )
+        else:
+            amplitudes = np.asarray(deblender.amplitudes, dtype=np.float32)
+        log_prob = tf.reshape(
+            deblender.flow_vae_net.flow(tf.reshape(z, [-1, deblender.latent_dim])),
+            [num_fields, max_number],
+        ).numpy()
+
+        metrics = deblender.metrics
+        if metrics is None:
+            metrics = deblender.compute_metrics()
+
+        field_loss, reconstruction_loss, _ = deblender.compute_loss(
+            z=tf.reshape(z, [-1, deblender.latent_dim]),
+            sig_sq=deblender.compute_sig_sq(),
+            index_pos_to_sub=tf.convert_to_tensor(
+                deblender.get_index_pos_to_sub(), dtype=tf.int32
+            ),
+        )
+
+        galaxy_data = {
+            "field_id": field_ids[field_index],
+            "slot": slot_index.astype(np.int32),
+            "position": np.asarray(deblender.detected_positions, dtype=np.float32)[
+                valid
+            ],
+            "z": z[valid].astype(np.float32),
+            "amplitudes": amplitudes[valid],
+            "log_prob": log_prob[valid].astype(np.float32),
+            "chi2": metrics["chi2"][valid].astype(np.float32),
+            "footprint_area": metrics["footprint_area"][valid].astype(np.float32),
+        }
+        if self.store_components and deblender.components is None:
+            galaxy_data["components"] = np.zeros(
+                (len(field_index),) + tuple(deblender.flow_vae_net.input_shape),
+                dtype=np.float32,
+            )
+            start = 0
+            for *_, stamps in deblender.lazy_components.iter_chunks(channel_last=True):
+                galaxy_data["components"][start : start + len(stamps)] = stamps
+                start += len(stamps)
+        elif self.store_components:
+            galaxy_data["components"] = np.asarray(
+                tf.gather_nd(
+                    deblender.components, np.stack([field_index, slot_index], -1)
+                ),
+                dtype=np.float32,
+            )
+        for name, data in galaxy_data.items():
+            self.store.append(name, data, self.chunk_size)
+
+        field_data = {
+            "field_id": field_ids,
+            "field_loss": field_loss.numpy(),
+            "reconstruction_loss": reconstruction_loss.numpy(),
+            "num_components": num_components.astype(np.int32),
+        }
+        for name, data in field_data.items():
+            self.store.append("fields/" + name, data, self.chunk_size)
+
+        if self.num_fields_written == 0:
+            self.metadata.update(
+                {
+                    "latent_dim": deblender.latent_dim,
+                    "cutout_size": deblender.cutout_size,
+                    "num_bands": deblender.num_bands,
+                    "linear_norm_coeff": np.reshape(
+                        deblender.linear_norm_coeff, [-1]
+                    ).tolist(),
+                    "survey": deblender.survey.name,
+                }
+            )
+            self.store.attrs["metadata"] = json.dumps(self.metadata)
+
+        self.num_fields_written += num_fields
+        self.num_galaxies_written += len(field_index)
+
+        LOG.info(
+            f"Wrote {len(field_index)} galaxies from {num_fields} fields to {self.path}"
+        )
+
+    def close(self):
+        """Close the store."""
+        self.store.close()
+
+    def __enter__(self):
+        """Enter the context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the store when leaving the context manager."""
+        self.close()
+
+
+def read_results(path, datasets=None, index=slice(None), backend=None):
+    """Read deblending results written by `ResultWriter`.
+
+    Parameters
+    ----------
+    path: str
+        path of the store.
+    datasets: list
+        names of the datasets to read. Defaults to all of them.
+        Per-field datasets are prefixed by "fields/".
+    index: slice or np.ndarray
+        galaxies to read.
+    backend: str
+        "hdf5" or "zarr", to override the choice based on the extension.
+
+    Returns
+    -------
+    results: dict
+        arrays of the requested datasets and the "metadata" dict.
+
+    """
+    store = _open_store(path, "r", backend=backend)
+    try:
+        if datasets is None:
+            datasets = [
+                name for name in GALAXY_DATASETS if name in store.keys()
+            ] + FIELD_DATASETS
+        results = {}
+        for name in datasets:
+            results[name] = store.read(
+                name, slice(None) if name.startswith("fields/") else index
+            )
+        results["metadata"] = json.loads(store.attrs["metadata"])
+    finally:
+        store.close()
+
+    return results
+
+
+def decode_components(
+    path, flow_vae_net, index=slice(None), batch_size=1024, backend=None
+):
+    """Decode components from the latent space representations stored on disk.
+
+    The decoded stamps are scaled by the stored amplitudes, so that they match the
+    components of the deblender. Stores written without amplitudes are decoded as is.
+
+    Parameters
+    ----------
+    path: str
+        path of the store.
+    flow_vae_net: madness_deblender.FlowVAEnet.FlowVAEnet
+        networks with the decoder used for deblending.
+    index: slice or np.ndarray
+        galaxies to decode.
+    batch_size: int
+        number of galaxies decoded at a time.
+    backend: str
+        "hdf5" or "zarr", to override the choice based on the extension.
+
+    Returns
+    -------
+    components: np.ndarray
+        channel last components of shape (num_galaxies, cutout_size, cutout_size, num_bands).
+
+    """
+    store = _open_store(path, "r", backend=backend)
+    try:
+        datasets = [name for name in ["z", "amplitudes"] if name in store.keys()]
+    finally:
+        store.close()
+    results = read_results(path, datasets=datasets, index=index, backend=backend)
+    linear_norm_coeff = np.asarray(results["metadata"]["linear_norm_coeff"])
+
+    components = np.zeros(
+        (len(results["z"]),) + tuple(flow_vae_net.input_shape), dtype=np.float32
+    )
+    for start in range(0, len(results["z"]), batch_size):
+        components[start : start + batch_size] = flow_vae_net.decoder(
+            results["z"][start : start + batch_size]
+        ).numpy()
+
+    components *= linear_norm_coeff
+    if "amplitudes" in results:
+        components *= results["amplitudes"][:, None, None, :]
+    return components